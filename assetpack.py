@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Compact, memory-mapped sound asset pack for the Mindstorms puppy gadget.
+
+The WAV clips are downmixed to mono (the EV3 has a single speaker), optionally
+downsampled and IMA ADPCM compressed into independently decodable blocks. A
+pack starts with an index header::
+
+    magic 'PUPK', version, clip count, source key
+    per clip: name, codec, channels, framerate, frames, block frames, offset, length
+
+followed by the block data. Clips are stream-decoded one block at a time and
+the decoded blocks are kept in an LRU cache with a fixed memory budget. The
+source key is a CRC-32 of the WAV files and the build options: a pack is
+rebuilt when its WAVs change, whatever their mtimes say after a git checkout
+or a copy to the brick.
+
+Usage::
+
+    python3 assetpack.py build sounds.pack angry_bark.wav cute_bark.wav coffin_dance.wav
+    python3 assetpack.py report sounds.pack angry_bark.wav cute_bark.wav coffin_dance.wav
+"""
+
+import collections
+import mmap
+import os
+import struct
+import threading
+import wave
+import zlib
+
+try:
+    import audioop
+except ImportError:
+    # audioop was removed in Python 3.13, pcm.py has the same IMA ADPCM codec
+    import pcm as audioop
+
+from audio import convert
+
+MAGIC = b'PUPK'
+VERSION = 2
+
+CODEC_PCM = 0
+CODEC_ADPCM = 1
+
+_HEADER = struct.Struct('<4sHHI')
+_ENTRY = struct.Struct('<BBHIIIQQ')
+# ADPCM decoder state stored in front of every block: previous sample, step index
+_BLOCK_STATE = struct.Struct('<hBx')
+
+
+def source_key(wavs, framerate=None, codec=CODEC_ADPCM, block_frames=4096):
+    """
+    Returns the CRC-32 of the WAV files and the build options a pack is made with.
+    The files are read in chunks, never whole.
+    """
+    key = zlib.crc32(repr((framerate, codec, block_frames)).encode('utf-8'))
+    for wav_path in wavs:
+        key = zlib.crc32(os.path.basename(wav_path).encode('utf-8'), key)
+        with open(wav_path, 'rb') as wav:
+            for chunk in iter(lambda: wav.read(65536), b''):
+                key = zlib.crc32(chunk, key)
+    return key & 0xFFFFFFFF
+
+
+def build(path, wavs, framerate=None, codec=CODEC_ADPCM, block_frames=4096):
+    """
+    Writes an asset pack from WAV files.
+    :param path: the pack file to write
+    :param wavs: the 16 bit PCM WAV files, clip names are the file names without extension
+    :param framerate: if given, clips are resampled to this rate
+    :param codec: CODEC_ADPCM for 4:1 compression or CODEC_PCM for raw samples
+    :param block_frames: the number of frames per independently decodable block
+    """
+    key = source_key(wavs, framerate, codec, block_frames)
+    entries = []
+    blocks = []
+    offset = 0
+    for wav_path in wavs:
+        with wave.open(wav_path, 'rb') as wav:
+            if wav.getsampwidth() != 2:
+                raise ValueError("{}: only 16 bit PCM is supported".format(wav_path))
+            rate = framerate or wav.getframerate()
+            pcm = convert(wav.readframes(wav.getnframes()), wav.getframerate(), wav.getnchannels(), rate, 1)
+
+        nframes = len(pcm) // 2
+        start = offset
+        state = None
+        for position in range(0, len(pcm), block_frames * 2):
+            chunk = pcm[position:position + block_frames * 2]
+            if codec == CODEC_ADPCM:
+                # ADPCM packs two samples per byte, pad an odd last block with silence
+                if len(chunk) % 4:
+                    chunk += bytes(2)
+                valprev, index = state or (0, 0)
+                encoded, state = audioop.lin2adpcm(chunk, 2, state)
+                chunk = _BLOCK_STATE.pack(valprev, index) + encoded
+            blocks.append(chunk)
+            offset += len(chunk)
+        name = os.path.splitext(os.path.basename(wav_path))[0].encode('utf-8')
+        entries.append((name, rate, nframes, start, offset - start))
+
+    # Block offsets start after the index
+    index_size = _HEADER.size + sum(2 + len(entry[0]) + _ENTRY.size for entry in entries)
+    with open(path + '.tmp', 'wb') as pack:
+        pack.write(_HEADER.pack(MAGIC, VERSION, len(entries), key))
+        for name, rate, nframes, start, length in entries:
+            pack.write(struct.pack('<H', len(name)) + name)
+            pack.write(_ENTRY.pack(codec, 1, 0, rate, nframes, block_frames, index_size + start, length))
+        for block in blocks:
+            pack.write(block)
+    os.rename(path + '.tmp', path)
+
+
+class BlockCache:
+    """
+    LRU cache of decoded blocks bounded by a memory budget in bytes.
+    """
+
+    def __init__(self, budget=512 * 1024):
+        self.budget = budget
+        self.resident = 0
+        self.peak = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._blocks = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, decode):
+        """
+        Returns a decoded block, decoding and caching it on a miss.
+        :param key: the block key
+        :param decode: a callable returning the decoded block
+        """
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is not None:
+                self._blocks.move_to_end(key)
+                self.hits += 1
+                return block
+        block = decode()
+        with self._lock:
+            self.misses += 1
+            if key not in self._blocks:
+                self._blocks[key] = block
+                self.resident += len(block)
+            while self.resident > self.budget and len(self._blocks) > 1:
+                _, evicted = self._blocks.popitem(last=False)
+                self.resident -= len(evicted)
+                self.evictions += 1
+            self.peak = max(self.peak, self.resident)
+        return block
+
+    def stats(self):
+        return {
+            'budget': self.budget,
+            'resident': self.resident,
+            'peak': self.peak,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class PackedClip:
+    """
+    A clip of an asset pack, decoded block by block on demand. Plays through the AudioEngine like a Clip.
+    """
+
+    def __init__(self, pack, name, codec, channels, framerate, nframes, block_frames, offset, length):
+        self.pack = pack
+        self.name = name
+        self.codec = codec
+        self.channels = channels
+        self.framerate = framerate
+        self.frame_size = 2 * channels
+        self.size = nframes * self.frame_size
+        self.block_bytes = block_frames * self.frame_size
+        self.offset = offset
+        self.length = length
+        # Encoded size of a full block
+        if codec == CODEC_ADPCM:
+            self._encoded_block = _BLOCK_STATE.size + block_frames // 2
+        else:
+            self._encoded_block = self.block_bytes
+
+    @property
+    def duration(self):
+        return self.size / float(self.frame_size * self.framerate)
+
+    def read(self, position, size):
+        """
+        Returns up to ``size`` bytes of PCM starting at byte ``position``.
+        """
+        end = min(position + size, self.size)
+        parts = []
+        while position < end:
+            block, skip = divmod(position, self.block_bytes)
+            data = self.pack.cache.get((self.name, block), lambda: self._decode(block))
+            part = data[skip:skip + end - position]
+            if not part:
+                break
+            parts.append(part)
+            position += len(part)
+        return b''.join(parts)
+
+    def _decode(self, block):
+        start = self.offset + block * self._encoded_block
+        stop = min(start + self._encoded_block, self.offset + self.length)
+        data = self.pack.data[start:stop]
+        if self.codec == CODEC_ADPCM:
+            state = _BLOCK_STATE.unpack_from(data)
+            data, _ = audioop.adpcm2lin(data[_BLOCK_STATE.size:], 2, state)
+        # The last block may decode a padding sample
+        return data[:min(self.block_bytes, self.size - block * self.block_bytes)]
+
+
+class AssetPack:
+    """
+    A memory-mapped asset pack.
+    """
+
+    def __init__(self, path, budget=512 * 1024):
+        """
+        :param path: the pack file
+        :param budget: the memory budget for decoded blocks in bytes
+        """
+        self.path = path
+        self.cache = BlockCache(budget)
+        with open(path, 'rb') as pack:
+            self.data = mmap.mmap(pack.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < _HEADER.size:
+            raise ValueError("{}: not an asset pack".format(path))
+        magic, version, count, self.key = _HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{}: not a version {} asset pack".format(path, VERSION))
+
+        self.clips = collections.OrderedDict()
+        position = _HEADER.size
+        for _ in range(count):
+            name_length, = struct.unpack_from('<H', self.data, position)
+            position += 2
+            name = self.data[position:position + name_length].decode('utf-8')
+            position += name_length
+            codec, channels, _, rate, nframes, block_frames, offset, length = _ENTRY.unpack_from(
+                self.data, position)
+            position += _ENTRY.size
+            self.clips[name] = PackedClip(self, name, codec, channels, rate, nframes, block_frames, offset, length)
+
+    @classmethod
+    def open_or_build(cls, path, wavs, budget=512 * 1024, **options):
+        """
+        Opens a pack, building it first if it is missing, of another version or made from other WAV files or
+        options.
+        :param options: passed on to build()
+        """
+        key = source_key(wavs, **options)
+        try:
+            pack = cls(path, budget)
+        except (OSError, ValueError):
+            pack = None
+        if pack is not None and pack.key == key:
+            return pack
+        if pack is not None:
+            pack.close()
+        build(path, wavs, **options)
+        return cls(path, budget)
+
+    @property
+    def framerate(self):
+        return next(iter(self.clips.values())).framerate
+
+    def close(self):
+        self.data.close()
+
+
+def _peak_rss():
+    """
+    Returns the peak resident set size of this process in kB.
+    ru_maxrss survives exec, so it would include the RSS of the parent process.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _measure(mode, pack_path, wavs):
+    """
+    Loads the sounds one way, plays every clip to the end and prints load time and peak RSS.
+    """
+    import time
+
+    from audio import AudioEngine, NullSink
+
+    start = time.monotonic()
+    if mode == 'wav':
+        engine = AudioEngine(sink=NullSink(22050, 2, realtime=False))
+        for wav in wavs:
+            engine.load(wav)
+    else:
+        pack = AssetPack(pack_path)
+        engine = AudioEngine(framerate=pack.framerate, channels=1,
+                             sink=NullSink(pack.framerate, 1, realtime=False))
+        for clip in pack.clips.values():
+            engine.add(clip)
+    load_time = time.monotonic() - start
+
+    for name in engine.clips:
+        engine.play(name).wait()
+    engine.close()
+    print("{} {:.4f}".format(_peak_rss(), load_time))
+
+
+if __name__ == '__main__':
+    import subprocess
+    import sys
+
+    if len(sys.argv) < 4 or sys.argv[1] not in ('build', 'report', '_measure'):
+        print(__doc__)
+        sys.exit(1)
+
+    if sys.argv[1] == 'build':
+        build(sys.argv[2], sys.argv[3:])
+        print("{}: {} bytes from {} bytes of WAV".format(
+            sys.argv[2], os.path.getsize(sys.argv[2]), sum(os.path.getsize(wav) for wav in sys.argv[3:])))
+
+    elif sys.argv[1] == '_measure':
+        _measure(sys.argv[2], sys.argv[3], sys.argv[4:])
+
+    else:
+        pack_path, wavs = sys.argv[2], sys.argv[3:]
+        AssetPack.open_or_build(pack_path, wavs).close()
+        # Each way of loading runs in its own process so the peak RSS figures are independent
+        results = {}
+        for mode in ('wav', 'pack'):
+            output = subprocess.check_output([sys.executable, '-W', 'ignore', __file__, '_measure', mode,
+                                              pack_path] + wavs)
+            rss, load_time = output.decode().split()
+            results[mode] = int(rss), float(load_time)
+        for mode, (rss, load_time) in sorted(results.items()):
+            print("{:5s} peak RSS {:6d} kB, load {:7.1f} ms".format(mode, rss, load_time * 1000))
+        print("saved {} kB peak RSS and {:.1f} ms load time".format(
+            results['wav'][0] - results['pack'][0], (results['wav'][1] - results['pack'][1]) * 1000))
@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+"""
+Audio engine for the Mindstorms puppy gadget.
+
+The bundled WAV clips are decoded once into PCM buffers and written to a single
+long-lived output stream, instead of forking ``aplay`` and reading the file from
+the SD card for every bark. Several clips can play at once: a software mixer sums
+the voices, so a bark overlays the music instead of waiting for it to finish.
+"""
+
+import fcntl
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+import wave
+
+try:
+    import audioop
+except ImportError:
+    # audioop was removed in Python 3.13, pcm.py does the same 16 bit sample math
+    import pcm as audioop
+
+try:
+    import numpy
+except ImportError:
+    # The ev3dev image does not ship NumPy, audioop does the same sample math in C
+    numpy = None
+
+from commands import _Timing
+from sensors import _thread_cpu_time
+
+logger = logging.getLogger(__name__)
+
+# Linux fcntl to resize a pipe, not exported by the fcntl module of older Pythons
+F_SETPIPE_SZ = 1031
+# Minimum seconds between two restarts of a failing aplay
+APLAY_RESTART_DELAY = 1.0
+
+# If set, called with (framerate, channels) to create the default output sink, e.g. by the simulator
+sink_factory = None
+
+
+def mix(chunks, size):
+    """
+    Sums 16 bit PCM chunks into one chunk with saturation.
+    :param chunks: a list of (pcm, gain) pairs, chunks shorter than ``size`` are padded with silence
+    :param size: the size of the output chunk in bytes
+    :return: the mixed chunk
+    """
+    if numpy is not None:
+        out = numpy.zeros(size // 2, dtype=numpy.float32)
+        for pcm, gain in chunks:
+            samples = numpy.frombuffer(pcm, dtype=numpy.int16)
+            out[:len(samples)] += samples * numpy.float32(gain)
+        return numpy.clip(out, -32768, 32767).astype(numpy.int16).tobytes()
+
+    out = None
+    for pcm, gain in chunks:
+        if len(pcm) < size:
+            pcm += bytes(size - len(pcm))
+        if gain != 1.0:
+            pcm = audioop.mul(pcm, 2, gain)
+        out = pcm if out is None else audioop.add(out, pcm, 2)
+    return out if out is not None else bytes(size)
+
+
+def convert(pcm, framerate, channels, to_framerate, to_channels):
+    """
+    Converts 16 bit PCM between mono and stereo and between sample rates.
+    """
+    if channels == 2 and to_channels == 1:
+        pcm = audioop.tomono(pcm, 2, 0.5, 0.5)
+    if framerate != to_framerate:
+        pcm, _ = audioop.ratecv(pcm, 2, min(channels, to_channels), framerate, to_framerate, None)
+    if channels == 1 and to_channels == 2:
+        pcm = audioop.tostereo(pcm, 2, 1, 1)
+    return pcm
+
+
+class Clip:
+    """
+    A decoded sound clip held in memory as signed 16 bit little endian PCM.
+    """
+
+    def __init__(self, name, pcm, framerate, channels):
+        self.name = name
+        self.pcm = pcm
+        self.framerate = framerate
+        self.channels = channels
+        self.frame_size = 2 * channels
+
+    @classmethod
+    def from_wav(cls, path, name=None, framerate=None, channels=None):
+        """
+        Decodes a 16 bit PCM WAV file.
+        :param path: the WAV file
+        :param name: the clip name, defaults to the file name without extension
+        :param framerate: if given, the clip is resampled to this rate
+        :param channels: if given, the clip is converted to this number of channels
+        """
+        if name is None:
+            name = os.path.splitext(os.path.basename(path))[0]
+        with wave.open(path, 'rb') as wav:
+            if wav.getsampwidth() != 2:
+                raise ValueError("{}: only 16 bit PCM is supported".format(path))
+            pcm = wav.readframes(wav.getnframes())
+            rate, nchannels = wav.getframerate(), wav.getnchannels()
+        if framerate is not None or channels is not None:
+            pcm = convert(pcm, rate, nchannels, framerate or rate, channels or nchannels)
+            rate, nchannels = framerate or rate, channels or nchannels
+        return cls(name, pcm, rate, nchannels)
+
+    @property
+    def size(self):
+        return len(self.pcm)
+
+    @property
+    def duration(self):
+        return self.size / float(self.frame_size * self.framerate)
+
+    def read(self, position, size):
+        """
+        Returns up to ``size`` bytes of PCM starting at byte ``position``.
+        """
+        return self.pcm[position:position + size]
+
+
+class AplaySink:
+    """
+    Streams raw PCM to one ``aplay`` process that stays open for the lifetime of the gadget.
+    If aplay exits, the chunk is lost and a new aplay is started for the next one.
+    """
+
+    realtime = True
+
+    def __init__(self, framerate, channels, buffer_time=50000, pipe_size=4096):
+        """
+        :param framerate: the sample rate in Hz
+        :param channels: the number of channels
+        :param buffer_time: the ALSA buffer time in microseconds
+        :param pipe_size: the size of the pipe to aplay in bytes, keeps queued audio short
+        """
+        self._args = ['aplay', '-q', '-t', 'raw', '-f', 'S16_LE', '-r', str(framerate), '-c', str(channels),
+                      '--buffer-time={}'.format(buffer_time), '-']
+        self._pipe_size = pipe_size
+        self._process = None
+        self._started_at = None
+        self.restarts = 0
+        self._start()
+
+    def _start(self):
+        self._started_at = time.monotonic()
+        self._process = subprocess.Popen(self._args, stdin=subprocess.PIPE)
+        try:
+            fcntl.fcntl(self._process.stdin.fileno(), F_SETPIPE_SZ, self._pipe_size)
+        except OSError:
+            pass
+
+    def write(self, data):
+        try:
+            self._process.stdin.write(data)
+            self._process.stdin.flush()
+        except (OSError, ValueError) as error:
+            # aplay exited or never started, e.g. the sound device was busy
+            self.restarts += 1
+            logger.error("Writing to aplay failed ({}), restarting it".format(error))
+            if self._process.poll() is None:
+                self._process.kill()
+            self.close()
+            time.sleep(max(0.0, self._started_at + APLAY_RESTART_DELAY - time.monotonic()))
+            try:
+                self._start()
+            except OSError:
+                logger.exception("Restarting aplay failed")
+                self._started_at = time.monotonic()
+
+    def close(self):
+        try:
+            self._process.stdin.close()
+        except OSError:
+            pass
+        self._process.wait()
+
+
+class FileSink:
+    """
+    Writes the output stream to a WAV file, for testing without audio hardware.
+    """
+
+    def __init__(self, path, framerate, channels, realtime=False):
+        """
+        :param realtime: if set, writes are paced to the playback rate like a sound card
+        """
+        self._wav = wave.open(path, 'wb')
+        self._wav.setnchannels(channels)
+        self._wav.setsampwidth(2)
+        self._wav.setframerate(framerate)
+        self._bytes_per_second = framerate * channels * 2
+        self.realtime = realtime
+
+    def write(self, data):
+        self._wav.writeframes(data)
+        if self.realtime:
+            time.sleep(len(data) / float(self._bytes_per_second))
+
+    def close(self):
+        self._wav.close()
+
+
+class NullSink:
+    """
+    Discards the output stream, for testing without audio hardware.
+    """
+
+    def __init__(self, framerate, channels, realtime=True):
+        """
+        :param realtime: if set, writes are paced to the playback rate like a sound card
+        """
+        self._bytes_per_second = framerate * channels * 2
+        self.realtime = realtime
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        if self.realtime:
+            time.sleep(len(data) / float(self._bytes_per_second))
+
+    def close(self):
+        pass
+
+
+class _Voice:
+    def __init__(self, clip, gain, duck, triggered_at, on_done):
+        self.clip = clip
+        self.gain = gain
+        self.duck = duck
+        self.position = 0
+        self.triggered_at = triggered_at
+        self.on_done = on_done
+        self.done = threading.Event()
+
+
+class AudioEngine:
+    """
+    Plays preloaded clips through one output stream without blocking the caller.
+    Overlapping clips are mixed, up to ``max_voices`` at a time.
+    """
+
+    def __init__(self, framerate=22050, channels=2, sink=None, chunk_frames=512, max_voices=4,
+                 duck_gain=0.3):
+        """
+        :param framerate: the sample rate of the output stream, clips must match it
+        :param channels: the number of channels of the output stream, clips must match it
+        :param sink: the output sink, defaults to sink_factory, aplay if it is installed or a NullSink
+        :param chunk_frames: the number of frames written to the sink at a time
+        :param max_voices: the maximum number of clips playing at once, the oldest one is dropped
+        :param duck_gain: the gain applied to the other voices while a ducking voice plays
+        """
+        self.framerate = framerate
+        self.channels = channels
+        self.chunk_bytes = chunk_frames * 2 * channels
+        self.max_voices = max_voices
+        self.duck_gain = duck_gain
+        if sink is None:
+            if sink_factory is not None:
+                sink = sink_factory(framerate, channels)
+            elif shutil.which('aplay'):
+                sink = AplaySink(framerate, channels)
+            else:
+                logger.info("aplay not found, audio goes to a null sink")
+                sink = NullSink(framerate, channels)
+        self.sink = sink
+        self.clips = {}
+
+        self._voices = []
+        self._finished = []
+        self._cond = threading.Condition()
+        self._running = True
+        self.latency = _Timing()
+        self.mix_cpu = 0.0
+        self.mixed_seconds = 0.0
+        self.plays = 0
+        self.cancelled = 0
+        self._thread = threading.Thread(target=self._run, name="audio", daemon=True)
+        self._thread.start()
+
+    def load(self, path, name=None):
+        """
+        Decodes a WAV file into memory, converted to the format of the output stream.
+        :return: the clip name
+        """
+        start = time.monotonic()
+        clip = Clip.from_wav(path, name, self.framerate, self.channels)
+        self.add(clip)
+        logger.info("Loaded {} ({:.1f}s) in {:.0f}ms".format(
+            clip.name, clip.duration, (time.monotonic() - start) * 1000))
+        return clip.name
+
+    def add(self, clip):
+        """
+        Makes a clip playable. Any object with the ``read`` and ``size`` members of Clip will do,
+        as long as its format matches the output stream.
+        """
+        if (clip.framerate, clip.channels) != (self.framerate, self.channels):
+            raise ValueError("{}: {} Hz x{} does not match the output stream ({} Hz x{})".format(
+                clip.name, clip.framerate, clip.channels, self.framerate, self.channels))
+        self.clips[clip.name] = clip
+
+    def play(self, name, gain=1.0, duck=False, on_done=None):
+        """
+        Starts playing a clip on top of whatever is playing and returns straight away.
+        :param name: the clip name
+        :param gain: the volume of the clip, 1.0 is unchanged
+        :param duck: if set, the other voices are turned down while this clip plays
+        :param on_done: called with no arguments on the audio thread when the clip finished or was cancelled
+        :return: an event that is set once the clip finished or was cancelled
+        """
+        voice = _Voice(self.clips[name], gain, duck, time.monotonic(), on_done)
+        with self._cond:
+            while len(self._voices) >= self.max_voices:
+                self._cancel(self._voices[0])
+            self._voices.append(voice)
+            self.plays += 1
+            self._cond.notify()
+        return voice.done
+
+    def stop(self, name=None):
+        """
+        Cancels the playing clips.
+        :param name: if given, only the voices playing this clip are cancelled
+        """
+        with self._cond:
+            for voice in list(self._voices):
+                if name is None or voice.clip.name == name:
+                    self._cancel(voice)
+
+    @property
+    def playing(self):
+        return bool(self._voices)
+
+    def close(self):
+        """
+        Stops the audio thread and closes the output stream.
+        """
+        with self._cond:
+            for voice in list(self._voices):
+                self._cancel(voice)
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+        self.sink.close()
+
+    def stats(self):
+        """
+        Returns the play counters, the trigger to first sample latency and the mixing cost.
+        ``mix_cpu_per_second`` is the CPU time spent mixing one second of audio.
+        """
+        return {
+            'plays': self.plays,
+            'cancelled': self.cancelled,
+            'voices': len(self._voices),
+            'latency': self.latency.as_dict(),
+            'mix_cpu_per_second': self.mix_cpu / self.mixed_seconds if self.mixed_seconds else 0.0,
+        }
+
+    def _cancel(self, voice):
+        self.cancelled += 1
+        self._voices.remove(voice)
+        voice.done.set()
+        if voice.on_done is not None:
+            self._finished.append(voice.on_done)
+            self._cond.notify()
+
+    def _render(self):
+        """
+        Mixes the next chunk of every playing voice, or returns None when nothing is playing.
+        Must be called with the condition held.
+        """
+        if not self._voices:
+            return None
+        ducked = any(voice.duck for voice in self._voices)
+        now = time.monotonic()
+        chunks = []
+        for voice in list(self._voices):
+            if voice.position == 0:
+                self.latency.add(now - voice.triggered_at)
+            end = voice.position + self.chunk_bytes
+            gain = voice.gain if voice.duck or not ducked else voice.gain * self.duck_gain
+            chunks.append((voice.clip.read(voice.position, self.chunk_bytes), gain))
+            voice.position = end
+            if end >= voice.clip.size:
+                self._voices.remove(voice)
+                voice.done.set()
+                if voice.on_done is not None:
+                    # Run the callback outside the lock on the audio thread
+                    self._finished.append(voice.on_done)
+
+        cpu_start = _thread_cpu_time()
+        if len(chunks) == 1 and chunks[0][1] == 1.0 and len(chunks[0][0]) == self.chunk_bytes:
+            chunk = chunks[0][0]
+        else:
+            chunk = mix(chunks, self.chunk_bytes)
+        self.mix_cpu += _thread_cpu_time() - cpu_start
+        self.mixed_seconds += self.chunk_bytes / float(self.framerate * self.channels * 2)
+        return chunk
+
+    def _run(self):
+        running = True
+        while running:
+            with self._cond:
+                while self._running and not self._voices and not self._finished:
+                    self._cond.wait()
+                running = self._running
+                chunk = self._render() if running else None
+                finished, self._finished = self._finished, []
+            if chunk:
+                try:
+                    self.sink.write(chunk)
+                except Exception:
+                    logger.exception("Audio output failed")
+            for callback in finished:
+                try:
+                    callback()
+                except Exception:
+                    logger.exception("Audio callback failed")
+
+
+if __name__ == '__main__':
+    # Report the trigger to first sample latency and the cost of mixing on this CPU
+    import sys
+
+    voices = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    engine = AudioEngine(sink=NullSink(22050, 2, realtime=False), max_voices=voices)
+    for path in ('angry_bark.wav', 'cute_bark.wav', 'coffin_dance.wav'):
+        engine.load(path)
+
+    for name in ['angry_bark', 'cute_bark'] * 5:
+        engine.play(name).wait()
+    print("Single clips: {}".format(engine.stats()))
+
+    engine.close()
+
+    # Mix the whole song with itself on every voice, as if all voices were busy
+    pcm = engine.clips['coffin_dance'].read(0, engine.clips['coffin_dance'].size)
+    size = engine.chunk_bytes
+    cpu_start = time.process_time()
+    for position in range(0, len(pcm), size):
+        chunk = pcm[position:position + size]
+        mix([(chunk, 1.0 / voices)] * voices, size)
+    cpu = time.process_time() - cpu_start
+    seconds = engine.clips['coffin_dance'].duration
+    print("{} voices with {}: {:.1f}ms CPU per mixed second ({:.2%} of one core)".format(
+        voices, 'numpy' if numpy is not None else 'audioop', cpu / seconds * 1000, cpu / seconds))
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+Offline beat and onset index of the gadget's sound clips.
+
+Each WAV the gadget dances to is analysed once, on a development machine or at
+install time, and its index is stored next to it as ``<name>.beats``. When a clip starts playing,
+the gadget only loads that file, so the dance lands on the song's beats and no
+audio analysis ever runs on the brick.
+
+The analysis:
+1. Build an onset strength envelope. With NumPy this is the spectral flux of
+   a windowed FFT. Without NumPy it is the rise in log energy per hop, which is
+   computed with audioop, or pcm.py where audioop is missing.
+2. Estimate the tempo from the autocorrelation of the envelope, weighted
+   towards 120 bpm.
+3. Track the beats by dynamic programming: the chain of envelope frames with
+   the most onset strength, every gap between two beats penalised by how far
+   it is from the tempo's period. The beats follow small tempo changes instead
+   of a fixed grid.
+
+An index file starts with a header::
+
+    magic 'PUPB', version, bpm, beat count, onset count, source size, source CRC-32
+
+followed by the beat times and then the onset times, as float32 seconds from
+the start of the clip.
+
+Usage::
+
+    python3 beats.py build coffin_dance.wav
+    python3 beats.py show coffin_dance.wav
+    python3 beats.py check
+"""
+
+import array
+import math
+import os
+import struct
+import sys
+import wave
+import zlib
+
+try:
+    import audioop
+except ImportError:
+    # audioop was removed in Python 3.13, pcm.py does the same 16 bit sample math
+    import pcm as audioop
+
+try:
+    import numpy
+except ImportError:
+    # The ev3dev image does not ship NumPy, the analysis falls back to audioop and plain Python
+    numpy = None
+
+from audio import convert
+
+MAGIC = b'PUPB'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sHxxfIIQI')
+
+# The clip is analysed at this rate, beats need no more than 5 kHz of bandwidth
+ANALYSIS_RATE = 11025
+# FFT size and hop in samples, a hop is 11.6 ms
+FRAME = 1024
+HOP = 128
+MIN_BPM = 60
+MAX_BPM = 200
+PREFERRED_BPM = 120
+
+
+class BeatIndex:
+    """
+    The tempo, beat times and onset times of a clip, in seconds from its start.
+    """
+
+    def __init__(self, bpm, beats, onsets):
+        self.bpm = bpm
+        self.beats = array.array('f', beats)
+        self.onsets = array.array('f', onsets)
+
+    def save(self, path, source):
+        """
+        Writes the index.
+        :param source: the analysed WAV file, its size and CRC-32 tell when the index is stale
+        """
+        with open(source, 'rb') as wav:
+            data = wav.read()
+        with open(path + '.tmp', 'wb') as index:
+            index.write(_HEADER.pack(MAGIC, VERSION, self.bpm, len(self.beats), len(self.onsets),
+                                     len(data), zlib.crc32(data)))
+            index.write(_little_endian(self.beats).tobytes())
+            index.write(_little_endian(self.onsets).tobytes())
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path, source=None, verify=False):
+        """
+        Reads an index.
+        :param source: if given, the WAV file the index must be up to date with. The sizes are compared,
+            mtimes are not kept by a git checkout or a copy to the brick
+        :param verify: also compare the CRC-32 of the source, which reads it whole
+        :return: the BeatIndex, or None if the file is missing, of another version or stale
+        """
+        try:
+            with open(path, 'rb') as index:
+                data = index.read()
+        except OSError:
+            return None
+        if len(data) < _HEADER.size:
+            return None
+        magic, version, bpm, nbeats, nonsets, size, crc = _HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            return None
+        if source is not None:
+            try:
+                if os.path.getsize(source) != size:
+                    return None
+                if verify:
+                    with open(source, 'rb') as wav:
+                        if zlib.crc32(wav.read()) != crc:
+                            return None
+            except OSError:
+                return None
+        times = array.array('f')
+        times.frombytes(data[_HEADER.size:_HEADER.size + 4 * (nbeats + nonsets)])
+        times = _little_endian(times)
+        return cls(bpm, times[:nbeats], times[nbeats:])
+
+
+def _little_endian(times):
+    if sys.byteorder == 'big':
+        times = array.array('f', times)
+        times.byteswap()
+    return times
+
+
+def index_path(wav_path):
+    """
+    Returns the index file of a WAV file: the same name with a .beats extension.
+    """
+    return os.path.splitext(wav_path)[0] + '.beats'
+
+
+def load_for(wav_path, verify=False):
+    """
+    Returns the up to date index of a WAV file, or None if it has not been built. Never analyses.
+    """
+    return BeatIndex.load(index_path(wav_path), wav_path, verify)
+
+
+def onset_envelope(pcm, framerate):
+    """
+    Returns the onset strength per hop of 16 bit mono PCM at ANALYSIS_RATE, and the hop duration in seconds.
+    """
+    if numpy is not None:
+        samples = numpy.frombuffer(pcm, dtype='<i2').astype(numpy.float32) / 32768.0
+        if len(samples) < FRAME:
+            samples = numpy.pad(samples, (0, FRAME - len(samples)))
+        frames = numpy.lib.stride_tricks.sliding_window_view(samples, FRAME)[::HOP]
+        spectrum = numpy.abs(numpy.fft.rfft(frames * numpy.hanning(FRAME), axis=1))
+        spectrum = numpy.log1p(100.0 * spectrum)
+        flux = numpy.maximum(numpy.diff(spectrum, axis=0), 0.0).sum(axis=1)
+        envelope = numpy.concatenate(([0.0], flux))
+        # Remove the slowly varying loudness so quiet and loud passages count the same
+        local = numpy.convolve(envelope, numpy.ones(16) / 16.0, mode='same')
+        return numpy.maximum(envelope - local, 0.0).tolist(), HOP / float(framerate)
+
+    # The first difference of the signal is a high pass that brings out drums and clicks over the bass and pads
+    treble = audioop.add(pcm, audioop.mul(b'\0\0' + pcm[:-2], 2, -1.0), 2)
+    envelope = [0.0]
+    previous = None
+    for position in range(0, len(pcm), 2 * HOP):
+        energies = (math.log(1.0 + audioop.rms(pcm[position:position + 2 * HOP], 2)),
+                    math.log(1.0 + audioop.rms(treble[position:position + 2 * HOP], 2)))
+        if previous is not None:
+            envelope.append(sum(max(0.0, energy - last) for energy, last in zip(energies, previous)))
+        previous = energies
+    local = _moving_average(envelope, 16)
+    return [max(0.0, value - mean) for value, mean in zip(envelope, local)], HOP / float(framerate)
+
+
+def _moving_average(values, size):
+    sums = [0.0]
+    for value in values:
+        sums.append(sums[-1] + value)
+    half = size // 2
+    return [(sums[min(len(values), i + half)] - sums[max(0, i - half)]) / size for i in range(len(values))]
+
+
+def estimate_period(envelope, hop):
+    """
+    Returns the beat period in hops, the autocorrelation peak between MIN_BPM and MAX_BPM
+    weighted by a log-normal prior around PREFERRED_BPM.
+    """
+    shortest = max(1, int(60.0 / MAX_BPM / hop))
+    longest = min(len(envelope) - 2, int(math.ceil(60.0 / MIN_BPM / hop)))
+    if longest <= shortest:
+        return None
+    # Smooth the envelope so a period falling between two hops still correlates
+    smooth = [envelope[0]] + [(envelope[i - 1] + 2 * envelope[i] + envelope[i + 1]) / 4.0
+                              for i in range(1, len(envelope) - 1)] + [envelope[-1]]
+    lags = range(shortest - 1, longest + 2)
+    if numpy is not None:
+        values = numpy.asarray(smooth)
+        correlation = [float(numpy.dot(values[:-lag], values[lag:])) for lag in lags]
+    else:
+        correlation = [sum(a * b for a, b in zip(smooth, smooth[lag:])) for lag in lags]
+
+    best, best_score = None, 0.0
+    for index in range(1, len(correlation) - 1):
+        bpm = 60.0 / (lags[index] * hop)
+        score = correlation[index] * math.exp(-0.5 * (math.log2(bpm / PREFERRED_BPM) / 0.9) ** 2)
+        if score > best_score:
+            best, best_score = index, score
+    if best is None:
+        return None
+    return lags[best] + _peak_offset(correlation, best)
+
+
+def _peak_offset(values, index):
+    # The fractional offset of the top of a parabola through a peak and its neighbours
+    if not 0 < index < len(values) - 1:
+        return 0.0
+    left, middle, right = values[index - 1], values[index], values[index + 1]
+    denominator = left - 2 * middle + right
+    return 0.5 * (left - right) / denominator if denominator else 0.0
+
+
+def track_beats(envelope, period, tightness=100.0):
+    """
+    Returns the beat positions in hops, by dynamic programming: the chain of onsets with the most strength,
+    penalising every gap between two beats by how far it is from the period in log scale.
+    """
+    count = len(envelope)
+    deviation = math.sqrt(sum(value * value for value in envelope) / count) or 1.0
+    scores = [value / deviation for value in envelope]
+    previous = [-1] * count
+    shortest, longest = max(1, int(round(period / 2))), int(round(2 * period))
+    penalties = [tightness * math.log(gap / period) ** 2 for gap in range(shortest, longest + 1)]
+    for t in range(shortest, count):
+        best, best_score = -1, 0.0
+        for gap, penalty in zip(range(shortest, min(t, longest) + 1), penalties):
+            score = scores[t - gap] - penalty
+            if score > best_score:
+                best, best_score = t - gap, score
+        if best >= 0:
+            scores[t] += best_score
+            previous[t] = best
+
+    # The chain ends on the best scoring frame of the last period
+    last = max(range(max(0, count - int(period)), count), key=lambda t: scores[t])
+    beats = []
+    while last >= 0:
+        beats.append(last + _peak_offset(envelope, last))
+        last = previous[last]
+    return beats[::-1]
+
+
+def pick_onsets(envelope, hop, min_gap=0.05):
+    """
+    Returns the positions in hops of the onsets: local maxima of the envelope above mean + one standard deviation.
+    """
+    if not envelope:
+        return []
+    mean = sum(envelope) / len(envelope)
+    deviation = math.sqrt(sum((value - mean) ** 2 for value in envelope) / len(envelope))
+    threshold = mean + deviation
+    gap = max(1, int(min_gap / hop))
+    onsets = []
+    for i in range(1, len(envelope) - 1):
+        value = envelope[i]
+        if value > threshold and value >= envelope[i - 1] and value > envelope[i + 1]:
+            if onsets and i - onsets[-1] < gap:
+                if value > envelope[onsets[-1]]:
+                    onsets[-1] = i
+                continue
+            onsets.append(i)
+    return onsets
+
+
+def analyse(wav_path):
+    """
+    Analyses a 16 bit PCM WAV file and returns its BeatIndex.
+    """
+    with wave.open(wav_path, 'rb') as wav:
+        pcm = convert(wav.readframes(wav.getnframes()), wav.getframerate(), wav.getnchannels(), ANALYSIS_RATE, 1)
+    envelope, hop = onset_envelope(pcm, ANALYSIS_RATE)
+    # The spectral flux rises most when an onset passes the steepest part of the window, three quarters
+    # into the frame. The energy of a hop rises when the onset is in it
+    offset = (FRAME * 3 / 4.0 if numpy is not None else HOP / 2.0) / ANALYSIS_RATE
+    onsets = [(i + _peak_offset(envelope, i)) * hop + offset for i in pick_onsets(envelope, hop)]
+    period = estimate_period(envelope, hop)
+    if period is None:
+        return BeatIndex(0.0, [], onsets)
+    beats = [i * hop + offset for i in track_beats(envelope, period)]
+    return BeatIndex(60.0 / (period * hop), beats, onsets)
+
+
+def build(wav_paths):
+    """
+    Analyses WAV files and writes the index next to each of them.
+    :return: the indexes by WAV file
+    """
+    indexes = {}
+    for wav_path in wav_paths:
+        indexes[wav_path] = analyse(wav_path)
+        indexes[wav_path].save(index_path(wav_path), wav_path)
+    return indexes
+
+
+if __name__ == '__main__':
+    import time
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ('build', 'show', 'check') or (
+            sys.argv[1] != 'check' and len(sys.argv) < 3):
+        print(__doc__)
+        sys.exit(1)
+
+    if sys.argv[1] == 'build':
+        for wav_path in sys.argv[2:]:
+            start = time.perf_counter()
+            index = build([wav_path])[wav_path]
+            print("{}: {:.1f} bpm, {} beats, {} onsets, {} bytes, analysed in {:.2f}s{}".format(
+                index_path(wav_path), index.bpm, len(index.beats), len(index.onsets),
+                os.path.getsize(index_path(wav_path)), time.perf_counter() - start,
+                '' if numpy is not None else ' without NumPy'))
+
+    elif sys.argv[1] == 'show':
+        for wav_path in sys.argv[2:]:
+            start = time.perf_counter()
+            index = load_for(wav_path, verify=True)
+            elapsed = time.perf_counter() - start
+            if index is None:
+                print("{}: no up to date index, run: python3 beats.py build {}".format(wav_path, wav_path))
+                continue
+            print("{}: {:.1f} bpm, loaded in {:.3f} ms".format(wav_path, index.bpm, elapsed * 1000))
+            print("  beats:  " + ' '.join('{:.2f}'.format(t) for t in index.beats[:16]) + ' ...')
+            print("  onsets: " + ' '.join('{:.2f}'.format(t) for t in index.onsets[:16]) + ' ...')
+
+    else:
+        # Recover the tempo and beats of synthetic click tracks, started 0.37s in
+        import tempfile
+
+        rate = 22050
+        for bpm in (90, 100, 126, 150):
+            period = 60.0 / bpm
+            click = [int(12000 * math.sin(2 * math.pi * 1000 * i / rate) * math.exp(-i / 200.0)) for i in range(800)]
+            samples = array.array('h', bytes(2 * rate * 20))
+            first = 0.37
+            t = first
+            while t < 19.9:
+                start = int(t * rate)
+                for i, value in enumerate(click):
+                    samples[start + i] = value
+                t += period
+            path = os.path.join(tempfile.mkdtemp(), 'click.wav')
+            with wave.open(path, 'wb') as wav:
+                wav.setnchannels(1)
+                wav.setsampwidth(2)
+                wav.setframerate(rate)
+                wav.writeframes(samples.tobytes())
+            index = analyse(path)
+            errors = [min(abs(beat - (first + k * period)) for k in range(int(20 / period) + 1))
+                      for beat in index.beats]
+            print("{} bpm click track: {:.1f} bpm detected, {} beats, beat error {:.1f} ms avg {:.1f} ms max".format(
+                bpm, index.bpm, len(index.beats), sum(errors) / len(errors) * 1000, max(errors) * 1000))
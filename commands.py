@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Command execution for the Mindstorms puppy gadget.
+
+Directives are decoded on the AlexaGadget callback thread and handed to a
+bounded priority queue, so slow commands never block directive intake. The
+directions and preset commands the skill sends are defined here too, without
+any device imports.
+"""
+
+import difflib
+import heapq
+import logging
+import threading
+import time
+from enum import Enum
+
+from sensors import _thread_cpu_time
+
+logger = logging.getLogger(__name__)
+
+# Command priorities, lower runs first
+PRIORITY_STOP = 0
+PRIORITY_MOVE = 1
+PRIORITY_COMMAND = 2
+
+
+class Direction(Enum):
+    """
+    The list of directional commands and their variations.
+    These variations correspond to the skill slot values.
+    """
+    FORWARD = ['forward', 'forwards', 'go forward']
+    BACKWARD = ['back', 'backward', 'backwards', 'go backward']
+    LEFT = ['left', 'go left']
+    RIGHT = ['right', 'go right']
+    STOP = ['stop', 'brake']
+
+
+class Command(Enum):
+    """
+    The list of preset commands and their invocation variation.
+    These variations correspond to the skill slot values.
+    """
+    SENTRY = ['guard', 'protect', 'sentry', 'sentry mode','watch', 'watch mode']
+    SIT = ['sitz', 'sit']
+    STAY = ['bleib', 'stay', 'steh auf', 'stehen bleiben']
+    HEEL = ['fuss', 'heel']
+    COME = ['come to me', 'Komm', 'come']
+    SPEAK = ['speak', 'laut']
+    ANGRY = ['angry bark','angry' ,'bark','chey chey','chase','cheey' ,'cheey cheey']
+    CUTE = ['cute','cute bark','cutie cutie','cutie pie','hello cutie','beepash my cutie','good boy beepash']
+    COFFIN = ['coughing','coffee','coffin','coffin bark','die','beepash die','die beepash']
+    DANCE=['sing','dance','dance for me']
+
+
+def normalize(text):
+    """
+    Normalizes a slot value for lookup: lower case with single spaces.
+    """
+    return ' '.join(str(text).lower().split())
+
+
+class AliasIndex:
+    """
+    Maps every alias of one or more enums to its member with a single dict lookup.
+    Aliases are the list values of the enum members, e.g. ``Direction.STOP = ['stop', 'brake']``.
+    Near-miss slot values fall back to a fuzzy match whose result is cached.
+    """
+
+    def __init__(self, *enums, cutoff=0.8, cache_size=256):
+        """
+        :param enums: the enum classes to index, aliases of earlier enums win on collision
+        :param cutoff: the minimum similarity ratio for a fuzzy match
+        :param cache_size: the maximum number of cached fuzzy lookups
+        """
+        self.cutoff = cutoff
+        self.cache_size = cache_size
+        self._index = {}
+        for enum in enums:
+            for member in enum:
+                for alias in member.value:
+                    self._index.setdefault(normalize(alias), member)
+        self._aliases = list(self._index)
+        self._fuzzy = {}
+        self.misses = 0
+
+    def __contains__(self, text):
+        return self.lookup(text) is not None
+
+    def lookup(self, text):
+        """
+        Resolves a slot value to its enum member.
+        :param text: the slot value
+        :return: the enum member, or None if nothing matches closely enough
+        """
+        try:
+            return self._index[text]
+        except KeyError:
+            pass
+        except TypeError:
+            return None
+
+        key = normalize(text)
+        member = self._index.get(key)
+        if member is not None:
+            return member
+
+        try:
+            return self._fuzzy[key]
+        except KeyError:
+            pass
+        self.misses += 1
+        match = difflib.get_close_matches(key, self._aliases, n=1, cutoff=self.cutoff)
+        member = self._index[match[0]] if match else None
+        if len(self._fuzzy) >= self.cache_size:
+            self._fuzzy.clear()
+        self._fuzzy[key] = member
+        return member
+
+
+class _Timing:
+    """
+    Count, total and maximum of a duration in seconds.
+    Every duration is also observed by ``histogram`` if one is attached, see metrics.Registry.attach.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = None
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if self.histogram is not None:
+            self.histogram.observe(seconds)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+        }
+
+
+class CommandExecutor:
+    """
+    Runs submitted commands one at a time on its own thread, highest priority first.
+    """
+
+    def __init__(self, maxsize=8, name="commands"):
+        """
+        :param maxsize: the maximum number of pending commands, further submissions are dropped
+        :param name: the name of the executor thread
+        """
+        self.maxsize = maxsize
+        self.name = name
+        self._queue = []
+        self._sequence = 0
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        self._current = None
+        # Set by preempt() to tell the running command to return, cleared when the next command starts
+        self.cancel = threading.Event()
+
+        self.submitted = 0
+        self.dropped = 0
+        self.preempted = 0
+        self.cancelled = 0
+        self.max_depth = 0
+        self.wait_time = _Timing()
+        self.exec_time = _Timing()
+        self.exec_cpu = _Timing()
+
+    def start(self):
+        """
+        Starts the executor thread.
+        """
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the executor thread once the running command returns. Pending commands are discarded.
+        """
+        with self._cond:
+            self._running = False
+            del self._queue[:]
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, func, *args, priority=PRIORITY_COMMAND, label=None, **kwargs):
+        """
+        Queues a command for the executor thread.
+        :param func: the callable to run
+        :param priority: the command priority, lower runs first
+        :param label: a name for logging, defaults to the function name
+        :return: False if the queue was full and the command was dropped
+        """
+        label = label or getattr(func, '__name__', repr(func))
+        with self._cond:
+            if len(self._queue) >= self.maxsize:
+                self.dropped += 1
+                logger.warning("Command queue full, dropping {}".format(label))
+                return False
+            self._sequence += 1
+            heapq.heappush(self._queue, (priority, self._sequence, time.monotonic(), label, func, args, kwargs))
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._cond.notify()
+        return True
+
+    def preempt(self, func, *args, **kwargs):
+        """
+        Fast path for stop commands: discards every pending command, cancels the running one and runs ``func``
+        straight away on the calling thread, without waiting for the running command to return.
+        Long-running commands wait on ``cancel`` between their steps and return once it is set.
+        """
+        with self._cond:
+            self.preempted += len(self._queue)
+            del self._queue[:]
+            if self._current is not None:
+                self.cancelled += 1
+            self.cancel.set()
+        start = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.exec_time.add(time.monotonic() - start)
+            self.wait_time.add(0.0)
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def stats(self):
+        """
+        Returns queue depth, wait time and execution time metrics.
+        """
+        return {
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'submitted': self.submitted,
+            'dropped': self.dropped,
+            'preempted': self.preempted,
+            'cancelled': self.cancelled,
+            'running': self._current,
+            'wait_time': self.wait_time.as_dict(),
+            'exec_time': self.exec_time.as_dict(),
+            'exec_cpu': self.exec_cpu.as_dict(),
+        }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._queue:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                _, _, queued_at, label, func, args, kwargs = heapq.heappop(self._queue)
+                self._current = label
+                self.cancel.clear()
+
+            start = time.monotonic()
+            cpu_start = _thread_cpu_time()
+            self.wait_time.add(start - queued_at)
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception("Command {} failed".format(label))
+            finally:
+                self.exec_time.add(time.monotonic() - start)
+                self.exec_cpu.add(_thread_cpu_time() - cpu_start)
+                self._current = None
+
+
+def _chain_lookup(enums, text):
+    """
+    The original dispatch: test the value against every alias list of every member.
+    """
+    found = None
+    for enum in enums:
+        for member in enum:
+            if text in member.value:
+                found = member
+    return found
+
+
+if __name__ == '__main__':
+    # Microbenchmark of the alias index against the if-chain it replaces
+    import timeit
+
+    enums = (Direction, Command)
+    index = AliasIndex(*enums)
+    utterances = [alias for enum in enums for member in enum for alias in member.value]
+    rounds = 2000
+
+    chain = timeit.timeit(lambda: [_chain_lookup(enums, text) for text in utterances], number=rounds)
+    indexed = timeit.timeit(lambda: [index.lookup(text) for text in utterances], number=rounds)
+    lookups = rounds * len(utterances)
+    print("{} aliases, {} lookups".format(len(utterances), lookups))
+    print("if-chain:    {:.2f} us/lookup".format(chain / lookups * 1e6))
+    print("alias index: {:.2f} us/lookup ({:.1f}x faster)".format(indexed / lookups * 1e6, chain / indexed))
+
+    near_misses = ['Forwards ', 'sitt', 'go  left', 'Komm', 'dance for mee']
+    print("Fuzzy fallback: {}".format({text: index.lookup(text) for text in near_misses}))
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Closed-loop motor control for the Mindstorms puppy gadget.
+
+Heel mode is one controller task: it samples the IR proximity at a fixed rate
+and drives both large motors with a continuous proportional speed command,
+instead of starting a thread with a fixed-duration burst for every reading.
+The proximity is filtered over the recent samples and the drive direction has a
+hysteresis band and a minimum hold time, so one noisy reading cannot make the
+puppy lunge.
+"""
+
+import time
+
+try:
+    import numpy
+except ImportError:
+    # The ev3dev image does not ship NumPy, the filter falls back to plain Python
+    numpy = None
+
+from commands import _Timing
+
+
+class ProximityFilter:
+    """
+    Median then exponential moving average over a window of IR proximity samples.
+    The running median of ``median_size`` samples removes single-sample spikes and the EMA
+    smooths what is left. The EMA is a dot product with precomputed weights, so the whole
+    window is filtered in one vectorized pass rather than sample by sample.
+    """
+
+    def __init__(self, median_size=5, ema_size=5, alpha=0.5):
+        """
+        :param median_size: the number of samples in the running median
+        :param ema_size: the number of medians the EMA spans
+        :param alpha: the EMA smoothing factor, higher follows the signal faster
+        """
+        self.median_size = median_size
+        self.ema_size = ema_size
+        self.alpha = alpha
+        # Number of raw samples needed for a full pass
+        self.size = median_size + ema_size - 1
+        weights = [alpha * (1 - alpha) ** (ema_size - 1 - i) for i in range(ema_size)]
+        total = sum(weights)
+        self.weights = [weight / total for weight in weights]
+        if numpy is not None:
+            self.weights = numpy.array(self.weights)
+
+    def __call__(self, values):
+        """
+        Returns the filtered value of a window of samples, oldest first, or None if it is empty.
+        """
+        if not len(values):
+            return None
+        if numpy is not None:
+            samples = numpy.asarray(values, dtype=float)[-self.size:]
+            if len(samples) >= self.size:
+                medians = numpy.median(
+                    numpy.lib.stride_tricks.sliding_window_view(samples, self.median_size), axis=1)
+                return float(numpy.dot(medians, self.weights))
+            return float(numpy.median(samples))
+
+        samples = list(values)[-self.size:]
+        if len(samples) < self.size:
+            return _median(samples)
+        medians = [_median(samples[i:i + self.median_size]) for i in range(self.ema_size)]
+        return sum(median * weight for median, weight in zip(medians, self.weights))
+
+
+def _median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+
+class HeelController:
+    """
+    Keeps the puppy at a set IR proximity from the person it follows.
+    The wheel speed is proportional to the distance error outside a dead band.
+    Starting to move needs the error to clear the dead band by ``hysteresis``, and the drive
+    direction changes at most once per ``min_hold`` seconds. Stopping is never held back.
+    """
+
+    def __init__(self, sensor, wheels, target=42, deadband=7, gain=25, max_speed=750,
+                 rate=10, filter=None, hysteresis=4, min_hold=0.5, speed_step=50):
+        """
+        :param sensor: an object exposing a ``proximity`` property, an InfraredSensor or a SensorSampler.
+            With a filter it must be a SensorSampler.
+        :param wheels: the MotorPair of the two large motors
+        :param target: the proximity to hold, 0 (close) to 100 (far)
+        :param deadband: the distance error tolerated without moving
+        :param gain: the wheel speed in deg/s per unit of distance error
+        :param max_speed: the speed limit in deg/s
+        :param rate: the control loop rate in Hz
+        :param filter: a ProximityFilter applied to the sampler's proximity window, None uses raw readings
+        :param hysteresis: the extra distance error needed to start moving
+        :param min_hold: the minimum time in seconds between changes of drive direction, a stop is exempt
+        :param speed_step: the speed is rounded to multiples of this many deg/s
+        """
+        self.sensor = sensor
+        self.wheels = wheels
+        self.target = target
+        self.deadband = deadband
+        self.gain = gain
+        self.max_speed = max_speed
+        self.period = 1.0 / rate
+        self.filter = filter
+        self.hysteresis = hysteresis
+        self.min_hold = min_hold
+        self.speed_step = speed_step
+
+        self.distance = None
+        self.speed = 0
+        self._changed_at = None
+        self.ticks = 0
+        self.commands = 0
+        self.loop_period = _Timing()
+        self.jitter = _Timing()
+
+    def command(self, distance):
+        """
+        Returns the wheel speed for a proximity reading, positive drives forwards.
+        """
+        error = distance - self.target
+        # Standing still, the error must clear the hysteresis band as well
+        band = self.deadband if self.speed else self.deadband + self.hysteresis
+        if abs(error) <= band:
+            return 0
+        # Ramp up from the edge of the dead band so the speed does not jump
+        error -= self.deadband if error > 0 else -self.deadband
+        speed = max(-self.max_speed, min(self.max_speed, self.gain * error))
+        if self.speed_step:
+            # Round away from zero so a small error still moves
+            speed = (int(abs(speed) + self.speed_step - 1) // self.speed_step * self.speed_step
+                     * (1 if speed > 0 else -1))
+        return int(speed)
+
+    def step(self):
+        """
+        Reads the sensor once and updates the motors if the speed changed.
+        """
+        if self.filter is not None:
+            _, values = self.sensor.window('proximity', self.filter.size)
+            distance = self.filter(values)
+        else:
+            distance = self.sensor.proximity
+        self.update(distance, time.monotonic())
+
+    def update(self, distance, now):
+        """
+        Runs one control step on a proximity value.
+        :param distance: the (filtered) proximity, None before the first reading
+        :param now: the monotonic time of the step
+        """
+        self.ticks += 1
+        self.distance = distance
+        if distance is None:
+            return
+        speed = self.command(distance)
+        if speed == self.speed:
+            return
+        direction = (speed > 0) - (speed < 0)
+        if direction != (self.speed > 0) - (self.speed < 0):
+            # Hold the current direction for a while before switching, but stop at the target straight away
+            if speed and self._changed_at is not None and now - self._changed_at < self.min_hold:
+                return
+            self._changed_at = now
+        self._drive(speed)
+
+    def stop(self):
+        """
+        Stops both motors.
+        """
+        self._drive(0)
+
+    def stats(self):
+        """
+        Returns the control loop period and its jitter, the deviation from the nominal period.
+        """
+        return {
+            'ticks': self.ticks,
+            'commands': self.commands,
+            'distance': self.distance,
+            'speed': self.speed,
+            'period': self.loop_period.as_dict(),
+            'jitter': self.jitter.as_dict(),
+        }
+
+    def task(self):
+        """
+        Generator running the control loop, for use with the ModeScheduler.
+        The motors are stopped when the task is switched off.
+        """
+        deadline = time.monotonic()
+        last = None
+        try:
+            while True:
+                now = time.monotonic()
+                if last is not None:
+                    self.loop_period.add(now - last)
+                    self.jitter.add(abs(now - last - self.period))
+                last = now
+                self.step()
+
+                # Sleep until the next tick, skipping ticks we have already missed
+                deadline += self.period
+                delay = deadline - time.monotonic()
+                if delay < 0:
+                    deadline = time.monotonic()
+                    delay = 0
+                yield delay
+        finally:
+            self.stop()
+
+    def _drive(self, speed):
+        self.commands += 1
+        self.speed = speed
+        if speed:
+            self.wheels.run_forever(speed, speed)
+        else:
+            self.wheels.stop()
+
+
+def _synthetic_trace(seconds=300, rate=10, seed=1):
+    """
+    A proximity trace of someone walking about, with sensor noise and occasional glitches.
+    """
+    import random
+
+    rng = random.Random(seed)
+    trace = []
+    position = 42.0
+    for tick in range(int(seconds * rate)):
+        position = max(10.0, min(80.0, position + rng.gauss(0, 1.2)))
+        value = position + rng.gauss(0, 3)
+        if rng.random() < 0.03:
+            value = rng.choice((0, 100))
+        trace.append((tick / float(rate), int(max(0, min(100, value)))))
+    return trace
+
+
+def _load_trace(path):
+    """
+    Reads a recorded trace, one "timestamp,proximity" line per sample.
+    """
+    with open(path) as lines:
+        return [(float(t), float(value)) for t, value in (line.split(',') for line in lines if line.strip())]
+
+
+def _replay(trace, controller):
+    """
+    Feeds a trace through a controller and returns the number of motor commands it issued.
+    """
+    from sensors import RingBuffer
+
+    window = RingBuffer(64)
+    for timestamp, value in trace:
+        window.append(timestamp, value)
+        if controller.filter is not None:
+            controller.update(controller.filter(window.window(controller.filter.size)[1]), timestamp)
+        else:
+            controller.update(value, timestamp)
+    return controller.commands
+
+
+if __name__ == '__main__':
+    import math
+    import sys
+    import threading
+
+    from scheduler import ModeScheduler
+
+    class _Wheels:
+        def run_forever(self, left_speed, right_speed):
+            pass
+
+        def stop(self):
+            pass
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'trace':
+        # Count the motor commands with and without filtering on a recorded or synthetic trace
+        trace = _load_trace(sys.argv[2]) if len(sys.argv) > 2 else _synthetic_trace()
+        minutes = (trace[-1][0] - trace[0][0]) / 60.0
+        raw = _replay(trace, HeelController(None, _Wheels(), hysteresis=0, min_hold=0, speed_step=0))
+        filtered = _replay(trace, HeelController(None, _Wheels(), filter=ProximityFilter()))
+        print("{} samples over {:.1f} min".format(len(trace), minutes))
+        print("raw:      {:6.1f} motor commands/min".format(raw / minutes))
+        print("filtered: {:6.1f} motor commands/min ({:.1f}/min removed, {:.0%})".format(
+            filtered / minutes, (raw - filtered) / minutes, 1 - filtered / float(raw)))
+
+        sys.exit(0)
+
+    # Run the controller against a simulated walker and report the loop timing
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+
+    class _Walker:
+        # Someone walking away and back every 4 seconds
+        @property
+        def proximity(self):
+            return int(42 + 30 * math.sin(time.monotonic() * math.pi / 2))
+
+    controller = HeelController(_Walker(), _Wheels())
+    scheduler = ModeScheduler()
+    scheduler.add('heel', controller.task, enabled=True)
+    scheduler.start()
+
+    threads = threading.active_count()
+    time.sleep(seconds)
+    threads_after = threading.active_count()
+    scheduler.stop()
+    stats = controller.stats()
+    print("{} ticks in {:.1f}s, {} motor commands, threads {} -> {}".format(
+        stats['ticks'], seconds, stats['commands'], threads, threads_after))
+    print("period {:.1f}ms avg {:.1f}ms max, jitter {:.2f}ms avg {:.2f}ms max".format(
+        stats['period']['avg'] * 1000, stats['period']['max'] * 1000,
+        stats['jitter']['avg'] * 1000, stats['jitter']['max'] * 1000))
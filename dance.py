@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Beat-synchronized dance engine for the Mindstorms puppy gadget.
+
+Beat ``n`` of the song is due at ``origin + n * period`` on the monotonic
+clock. Every step sleeps until the absolute time of its beat instead of for a
+fixed delay after the previous step, so the time a step takes and the
+scheduler's wakeup latency never add up to drift. A tempo directive retunes
+the running engine in place: the beat grid is re-anchored at the new tempo's
+start and the sleeping task is woken to pick it up. No thread is started and
+the directive callback does not wait.
+
+When a clip with a beat index (see beats.py) starts playing, the grid is the
+clip's own beat times instead, extended at its tempo past the last beat.
+"""
+
+import bisect
+import math
+import threading
+import time
+
+from commands import _Timing
+
+DEFAULT_BPM = 100
+
+
+class DanceEngine:
+    """
+    Calls a step function on every beat of a tempo grid. Runs as a ModeScheduler task.
+    """
+
+    def __init__(self, step, bpm=DEFAULT_BPM, wake=None, clock=time.monotonic):
+        """
+        :param step: called with the beat number, counted from the start of the dance, the last tempo change
+            or the start of the clip
+        :param bpm: the tempo used until a tempo directive arrives
+        :param wake: called after a tempo change to resume the sleeping task, e.g. ``scheduler.wake``
+        :param clock: the monotonic clock beats are scheduled on
+        """
+        self.step = step
+        self.default_bpm = bpm
+        self.wake = wake
+        self.clock = clock
+        self._lock = threading.Lock()
+        # Beat grids (start, period, beat times or None) not yet reached, oldest first
+        self._pending = []
+        self._origin = None
+        self._period = 60.0 / bpm
+        self._times = None
+        self.bpm = bpm
+
+        self.beats = 0
+        self.skipped = 0
+        self.retunes = 0
+        self.phase_error = _Timing()
+        self.last_error = 0.0
+
+    def set_tempo(self, bpm, start=None):
+        """
+        Changes the tempo. Returns immediately.
+        :param bpm: the new tempo in beats per minute, above 0
+        :param start: the monotonic time of the first beat at this tempo, defaults to now
+        """
+        self._retune(start, 60.0 / bpm, None)
+
+    def set_beats(self, times, bpm, start=None):
+        """
+        Dances on the beats of a clip. Returns immediately.
+        :param times: the beat times in seconds from the start of the clip, ascending
+        :param bpm: the clip's tempo, the beats after the last one follow it
+        :param start: the monotonic time the clip started playing, defaults to now
+        """
+        if not times:
+            self.set_tempo(bpm, start)
+            return
+        self._retune(start, 60.0 / bpm, list(times))
+
+    def _retune(self, start, period, times):
+        start = self.clock() if start is None else start
+        with self._lock:
+            self._pending = [grid for grid in self._pending if grid[0] < start]
+            self._pending.append((start, period, times))
+            self.retunes += 1
+        if self.wake is not None:
+            self.wake()
+
+    def beat_time(self, beat):
+        """
+        Returns the monotonic time at which a beat of the current grid is due.
+        """
+        times = self._times
+        if times is None:
+            return self._origin + beat * self._period
+        if beat < len(times):
+            return self._origin + times[beat]
+        return self._origin + times[-1] + (beat - len(times) + 1) * self._period
+
+    def _beat_after(self, t):
+        # The first beat of the current grid due at or after t
+        times = self._times
+        if times is None:
+            return max(0, int(math.ceil((t - self._origin) / self._period)))
+        offset = t - self._origin
+        if offset <= times[-1]:
+            return bisect.bisect_left(times, offset)
+        return len(times) - 1 + int(math.ceil((offset - times[-1]) / self._period))
+
+    def stats(self):
+        """
+        Returns the beats danced and the beat phase error, how late each step started after its beat.
+        """
+        return {
+            'bpm': self.bpm,
+            'beats': self.beats,
+            'skipped': self.skipped,
+            'retunes': self.retunes,
+            'phase_error': self.phase_error.as_dict(),
+            'last_error': self.last_error,
+        }
+
+    def task(self):
+        """
+        Generator stepping on every beat, for use with the ModeScheduler.
+        Without a tempo directive the dance starts on the first beat right away at the default tempo.
+        """
+        with self._lock:
+            if not self._pending:
+                self._pending.append((self.clock(), 60.0 / self.default_bpm, None))
+        beat = 0
+        while True:
+            now = self.clock()
+            with self._lock:
+                # Switch to the newest grid that has started, or to the first one at all
+                while self._pending and (self._origin is None or self._pending[0][0] <= now
+                                         or self._pending[0][0] <= self.beat_time(beat)):
+                    self._origin, self._period, self._times = self._pending.pop(0)
+                    self.bpm = round(60.0 / self._period, 2)
+                    beat = self._beat_after(now)
+            due = self.beat_time(beat)
+            if due > now:
+                yield due - now
+                continue
+
+            late = now - due
+            if late > (self.beat_time(beat + 1) - due) / 2:
+                # Too late to be on this beat, wait for the next one
+                self.skipped += 1
+                beat = max(beat + 1, self._beat_after(now))
+                continue
+            self.phase_error.add(late)
+            self.last_error = late
+            self.step(beat)
+            self.beats += 1
+            beat += 1
+
+
+if __name__ == '__main__':
+    # Dance through a song with a tempo change, once with the original sleep-after-step loop and once on
+    # the engine, and compare how far the steps drift from the song's beats
+    import sys
+
+    from scheduler import ModeScheduler
+
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 180.0
+    step_cost = 0.003
+    tempos = [(0.0, 100), (seconds / 3, 128)]
+
+    def _work():
+        # The sysfs writes of one dance step on the brick
+        end = time.perf_counter() + step_cost
+        while time.perf_counter() < end:
+            pass
+
+    start = time.monotonic() + 0.5
+
+    def _grid_error(t):
+        # Signed distance to the nearest beat of the song's tempo map
+        origin, bpm = [(start + at, bpm) for at, bpm in tempos if start + at <= t + 1e-9][-1]
+        period = 60.0 / bpm
+        offset = (t - origin) % period
+        return offset if offset < period / 2 else offset - period
+
+    naive, naive_last = _Timing(), [0.0]
+    synced, synced_last = _Timing(), [0.0]
+
+    def _step(beat):
+        error = _grid_error(time.monotonic())
+        synced.add(abs(error))
+        synced_last[0] = error
+        _work()
+
+    def _naive():
+        # _dance_task before: a step, then a sleep of one beat
+        time.sleep(max(0.0, start - time.monotonic()))
+        while time.monotonic() < start + seconds:
+            now = time.monotonic()
+            error = _grid_error(now)
+            naive.add(abs(error))
+            naive_last[0] = error
+            _work()
+            bpm = [bpm for at, bpm in tempos if start + at <= now][-1]
+            time.sleep(60.0 / bpm)
+
+    scheduler = ModeScheduler()
+    engine = DanceEngine(_step, wake=lambda: scheduler.wake('dance'))
+    scheduler.add('dance', engine.task)
+    engine.set_tempo(tempos[0][1], start)
+    scheduler.start()
+    scheduler.enable('dance')
+    thread = threading.Thread(target=_naive)
+    thread.start()
+
+    time.sleep(start + tempos[1][0] - time.monotonic())
+    # The tempo directive arrives on the agt thread
+    engine.set_tempo(tempos[1][1], start + tempos[1][0])
+    thread.join()
+    scheduler.stop()
+
+    print("{:.0f}s song at {} bpm, {:.1f} ms per step".format(
+        seconds, ' then '.join(str(bpm) for _, bpm in tempos), step_cost * 1000))
+    print("sleep loop: {} steps, phase error {:.1f} ms avg {:.1f} ms max, {:+.1f} ms at the end".format(
+        naive.count, naive.total / naive.count * 1000, naive.max * 1000, naive_last[0] * 1000))
+    print("engine:     {} steps, phase error {:.1f} ms avg {:.1f} ms max, {:+.1f} ms at the end".format(
+        synced.count, synced.total / synced.count * 1000, synced.max * 1000, synced_last[0] * 1000))
+    print("Engine stats: {}".format(engine.stats()))
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""
+Precomputed eye animations for the Mindstorms puppy gadget's screen.
+
+Every eye pose is rasterized once into a frame in the screen's own
+framebuffer layout, ``line_length`` bytes per row. At 1 bit per pixel the
+pixels are packed least significant bit first and 1 is black. The EV3 on
+ev3dev-stretch has a 32 bits per pixel XRGB framebuffer instead, where black
+is 0 and white 0x00FFFFFF. The frames are cached on disk for the screen's
+geometry and pixel format, so the brick only pays for rasterizing after the
+poses change. Showing a frame copies the rectangle of bytes that differs from
+the frame on screen straight into the framebuffer's mmap. No drawing API is
+called and nothing else on the screen is touched.
+
+The eyes show the gadget's mood. An expression is a looping sequence of
+frames, one per mood: idle, angry, cute, dancing, sitting, heeling and
+disconnected. Switching the mood wakes the animator, which shows the new
+expression's first frame right away instead of finishing the current one.
+
+A frame file starts with a header::
+
+    magic 'PUPE', version, xres, yres, line_length, bits per pixel, CRC-32 of the pose definitions, frame count
+
+followed by each frame's name and its ``line_length * yres`` bytes.
+
+Usage::
+
+    python3 eyes.py [seconds] [bits per pixel]
+"""
+
+import collections
+import os
+import random
+import struct
+import time
+import zlib
+
+from commands import _Timing
+
+MAGIC = b'PUPE'
+VERSION = 2
+
+_HEADER = struct.Struct('<4sHHHHHII')
+
+# The white pixel of the framebuffer formats other than 1 bit per pixel, black is 0
+WHITE = {16: 0xFFFF, 24: 0xFFFFFF, 32: 0x00FFFFFF}
+
+# Bounding boxes of the left and right eye on the 178x128 screen
+EYES = ((5, 10, 75, 100), (103, 10, 173, 100))
+# A closed eye is a bar this many pixels high
+CLOSED_HEIGHT = 10
+
+# Poses by name:
+# - openness: the fraction of the eye's height the lids leave open
+# - slant: how far the upper lid drops towards the nose, as a fraction of the open height.
+#   Below 0 it drops towards the outer corner instead
+# - smile: how far below the eye the ellipse cutting away its lower part sits, as a fraction of the open height
+# - shift: how many pixels the eyes look to the right
+POSES = collections.OrderedDict([
+    ('open', {}),
+    ('lids_60', {'openness': 0.6}),
+    ('lids_25', {'openness': 0.25}),
+    ('closed', {'openness': 0.0}),
+    ('angry', {'openness': 0.8, 'slant': 0.6}),
+    ('angry_squint', {'openness': 0.5, 'slant': 0.7}),
+    ('happy', {'smile': 0.55}),
+    ('happy_left', {'smile': 0.55, 'shift': -12}),
+    ('happy_right', {'smile': 0.55, 'shift': 12}),
+    ('look_left', {'openness': 0.85, 'shift': -16}),
+    ('look_right', {'openness': 0.85, 'shift': 16}),
+    ('sleepy', {'openness': 0.4, 'slant': -0.5}),
+])
+
+FRAME = 1 / 15.0
+
+# A blink at 15 frames per second, as (frame, seconds on screen)
+BLINK = [('lids_60', FRAME), ('lids_25', FRAME), ('closed', 2 * FRAME), ('lids_25', FRAME), ('lids_60', FRAME)]
+
+# The looping frame sequence of every mood. A frame is shown for a number of seconds,
+# or for a random time within a (shortest, longest) range
+EXPRESSIONS = {
+    'idle': [('open', (2.0, 6.0))] + BLINK,
+    'angry': [('angry', (0.4, 0.9)), ('angry_squint', 3 * FRAME)],
+    'cute': [('happy', (1.0, 2.5)), ('happy_left', 4 * FRAME), ('happy', 4 * FRAME), ('happy_right', 4 * FRAME)],
+    'dancing': [('happy_left', 0.25), ('happy', 0.25), ('happy_right', 0.25), ('happy', 0.25)],
+    'sitting': [('lids_60', (3.0, 8.0)), ('lids_25', 2 * FRAME), ('closed', 0.3), ('lids_25', 2 * FRAME)],
+    'heeling': [('open', (1.0, 2.0)), ('look_left', 0.4), ('open', (1.0, 2.0)), ('look_right', 0.4)] + BLINK,
+    'disconnected': [('sleepy', (2.0, 4.0)), ('closed', (1.0, 3.0))],
+}
+
+
+def render(pose, xres, yres, line_length, bits_per_pixel=1, eyes=EYES):
+    """
+    Rasterizes a pose.
+    :param pose: the pose parameters, see POSES
+    :param bits_per_pixel: 1, or a pixel size in WHITE
+    :return: the frame in the framebuffer's format
+    :raises ValueError: for a pixel format the frames cannot be rendered in
+    """
+    if bits_per_pixel != 1 and bits_per_pixel not in WHITE:
+        raise ValueError("Cannot render eyes at {} bits per pixel".format(bits_per_pixel))
+    openness = pose.get('openness', 1.0)
+    slant = abs(pose.get('slant', 0.0))
+    smile = pose.get('smile', 0.0)
+    shift = pose.get('shift', 0)
+    rows = [0] * yres
+    for index, (x0, y0, x1, y1) in enumerate(eyes):
+        x0, x1 = x0 + shift, x1 + shift
+        cx, cy, rx = (x0 + x1) / 2.0, (y0 + y1) / 2.0, (x1 - x0) / 2.0
+        ry = max(CLOSED_HEIGHT / 2.0, openness * (y1 - y0) / 2.0)
+        top, height = cy - ry, 2 * ry
+        # The upper lid runs from the outer corner down to the inner one, or the other way round
+        outer, inner = (x0, x1) if index % 2 == 0 else (x1, x0)
+        if pose.get('slant', 0.0) < 0:
+            outer, inner = inner, outer
+        for y in range(max(0, int(cy - ry)), min(yres, int(cy + ry) + 1)):
+            dy = (y - cy) / ry
+            if abs(dy) > 1:
+                continue
+            dx = rx * (1 - dy * dy) ** 0.5
+            left, right = cx - dx, cx + dx
+            if slant:
+                # Pixels below the lid: a fraction of the way from the outer to the inner corner
+                reach = (y - top) / (slant * height)
+                if reach < 1:
+                    edge = outer + reach * (inner - outer)
+                    left, right = (left, min(right, edge)) if outer < inner else (max(left, edge), right)
+            mask = _span(left, right, xres)
+            if smile:
+                # The lower lid is the same ellipse, lowered by the smile
+                lowered = (y - cy - smile * height) / ry
+                if abs(lowered) <= 1:
+                    lowered_dx = rx * (1 - lowered * lowered) ** 0.5
+                    mask &= ~_span(cx - lowered_dx, cx + lowered_dx, xres)
+            rows[y] |= mask
+    if bits_per_pixel == 1:
+        return b''.join(row.to_bytes(line_length, 'little') for row in rows)
+    # Every bit of a row becomes a black or a white pixel, the first pixel is the least significant bit
+    size = bits_per_pixel // 8
+    pixels = {'0': WHITE[bits_per_pixel].to_bytes(size, 'little'), '1': bytes(size)}
+    return b''.join(b''.join(pixels[bit] for bit in reversed('{:0{}b}'.format(row, xres))).ljust(line_length, b'\0')
+                    for row in rows)
+
+
+def _span(left, right, xres):
+    left, right = max(0, int(round(left))), min(xres - 1, int(round(right)))
+    if right < left:
+        return 0
+    return ((1 << (right - left + 1)) - 1) << left
+
+
+def screen_geometry(screen):
+    """
+    Returns the xres, yres, line_length and bits per pixel of an ev3dev2 Display's framebuffer.
+    """
+    line_length = getattr(screen, 'line_length', None) or screen.fix_info.line_length
+    bits_per_pixel = getattr(screen, 'bits_per_pixel', None) or screen.var_info.bits_per_pixel
+    return screen.xres, screen.yres, line_length, bits_per_pixel
+
+
+def dirty_rect(before, after, line_length):
+    """
+    Returns the rectangle of bytes in which two frames differ, as (top row, bottom row, first byte, last byte)
+    inclusive, or None if they are the same.
+    """
+    top = bottom = first = last = None
+    for y in range(len(after) // line_length):
+        start = y * line_length
+        row_before, row_after = before[start:start + line_length], after[start:start + line_length]
+        if row_before == row_after:
+            continue
+        if top is None:
+            top = y
+        bottom = y
+        columns = [x for x in range(line_length) if row_before[x] != row_after[x]]
+        first = columns[0] if first is None else min(first, columns[0])
+        last = columns[-1] if last is None else max(last, columns[-1])
+    if top is None:
+        return None
+    return top, bottom, first, last
+
+
+class EyeFrames:
+    """
+    The frames of every pose, for one screen geometry and pixel format.
+    """
+
+    def __init__(self, frames, xres, yres, line_length, bits_per_pixel=1):
+        self.frames = frames
+        self.xres = xres
+        self.yres = yres
+        self.line_length = line_length
+        self.bits_per_pixel = bits_per_pixel
+
+    @staticmethod
+    def key(poses=POSES, eyes=EYES):
+        return zlib.crc32(repr((VERSION, CLOSED_HEIGHT, eyes, list(poses.items()))).encode('ascii'))
+
+    @classmethod
+    def build(cls, xres, yres, line_length, bits_per_pixel=1, poses=POSES):
+        return cls(collections.OrderedDict((name, render(pose, xres, yres, line_length, bits_per_pixel))
+                                           for name, pose in poses.items()), xres, yres, line_length, bits_per_pixel)
+
+    def save(self, path, poses=POSES):
+        with open(path + '.tmp', 'wb') as cache:
+            cache.write(_HEADER.pack(MAGIC, VERSION, self.xres, self.yres, self.line_length, self.bits_per_pixel,
+                                     self.key(poses), len(self.frames)))
+            for name, frame in self.frames.items():
+                encoded = name.encode('utf-8')
+                cache.write(struct.pack('<H', len(encoded)) + encoded + frame)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path, xres, yres, line_length, bits_per_pixel=1, poses=POSES):
+        """
+        Reads a frame file.
+        :return: the EyeFrames, or None if the file is missing or made for other poses, another screen or another
+            pixel format
+        """
+        try:
+            with open(path, 'rb') as cache:
+                data = cache.read()
+        except OSError:
+            return None
+        if len(data) < _HEADER.size or _HEADER.unpack_from(data)[:7] != (
+                MAGIC, VERSION, xres, yres, line_length, bits_per_pixel, cls.key(poses)):
+            return None
+        count = _HEADER.unpack_from(data)[7]
+        size = line_length * yres
+        frames = collections.OrderedDict()
+        position = _HEADER.size
+        for _ in range(count):
+            length, = struct.unpack_from('<H', data, position)
+            position += 2
+            name = data[position:position + length].decode('utf-8')
+            position += length
+            frames[name] = data[position:position + size]
+            position += size
+        return cls(frames, xres, yres, line_length, bits_per_pixel)
+
+    @classmethod
+    def open_or_build(cls, path, xres, yres, line_length, bits_per_pixel=1, poses=POSES):
+        """
+        Loads the frames from a frame file, rasterizing and saving them first if it is missing or stale.
+        """
+        frames = cls.load(path, xres, yres, line_length, bits_per_pixel, poses)
+        if frames is None:
+            frames = cls.build(xres, yres, line_length, bits_per_pixel, poses)
+            try:
+                frames.save(path, poses)
+            except OSError:
+                # A read-only directory only costs the rasterizing at the next start
+                pass
+        return frames
+
+
+class EyeAnimator:
+    """
+    Shows precomputed frames on the screen by copying their dirty rectangle into the framebuffer's mmap,
+    and plays the expression of the current mood.
+    """
+
+    def __init__(self, screen, frames, expressions=EXPRESSIONS, mood='idle', wake=None, clock=time.monotonic,
+                 rng=None):
+        """
+        :param screen: the ev3dev2 Display, or anything with a framebuffer ``mmap``
+        :param frames: the EyeFrames made for the screen's geometry
+        :param expressions: the frame sequences by mood, every frame must be in ``frames``
+        :param mood: the mood shown first
+        :param wake: called after a mood change to resume the sleeping task, e.g. ``scheduler.wake``
+        :param clock: the monotonic clock frame deadlines are kept on
+        :param rng: the random.Random the frame times within a range are drawn from, a new one if not given
+        """
+        missing = {name for sequence in expressions.values() for name, _ in sequence} - set(frames.frames)
+        if missing:
+            raise ValueError("Expressions use frames that were not rendered: {}".format(', '.join(sorted(missing))))
+        self.mmap = screen.mmap
+        self.frames = frames
+        self.expressions = expressions
+        self.mood = mood
+        self.wake = wake
+        self.line_length = frames.line_length
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self._size = frames.line_length * frames.yres
+        self._shown = bytes(self.mmap[:self._size])
+        # Dirty rectangles between two frames, keyed by their ids. The frames live as long as the animator
+        self._rects = {}
+        self.current = None
+        self.blit_time = _Timing()
+        self.blits = 0
+        self.bytes_written = 0
+        self.late = 0
+        # The perf_counter time of the last mood change not shown yet
+        self._changed_at = None
+        self.switches = 0
+        self.switch_latency = _Timing()
+
+    def express(self, mood):
+        """
+        Switches to the expression of a mood. Returns immediately, the first frame is shown by the task.
+        """
+        if mood == self.mood:
+            return
+        self._changed_at = time.perf_counter()
+        self.mood = mood
+        self.switches += 1
+        if self.wake is not None:
+            self.wake()
+
+    def show(self, name):
+        """
+        Puts a frame on the screen.
+        """
+        start = time.perf_counter()
+        frame = self.frames.frames[name]
+        key = (id(self._shown), id(frame))
+        rect = self._rects.get(key, False)
+        if rect is False:
+            rect = dirty_rect(self._shown, frame, self.line_length)
+            if len(self._rects) < 256:
+                self._rects[key] = rect
+        if rect is not None:
+            top, bottom, first, last = rect
+            for y in range(top, bottom + 1):
+                start_byte, end_byte = y * self.line_length + first, y * self.line_length + last + 1
+                self.mmap[start_byte:end_byte] = frame[start_byte:end_byte]
+            self.bytes_written += (bottom - top + 1) * (last - first + 1)
+        self._shown = frame
+        self.current = name
+        self.blits += 1
+        self.blit_time.add(time.perf_counter() - start)
+
+    def task(self):
+        """
+        Generator for the ModeScheduler looping the current mood's expression until the task is closed.
+        Every frame is due at an absolute time, so a late wakeup does not delay the rest of the sequence.
+        """
+        while True:
+            mood = self.mood
+            due = self.clock()
+            for name, seconds in self.expressions[mood]:
+                if self.mood != mood:
+                    break
+                now = self.clock()
+                if now > due + FRAME:
+                    self.late += 1
+                    due = now
+                self.show(name)
+                changed_at, self._changed_at = self._changed_at, None
+                if changed_at is not None:
+                    self.switch_latency.add(time.perf_counter() - changed_at)
+                due += self.rng.uniform(*seconds) if isinstance(seconds, tuple) else seconds
+                if due > now:
+                    yield due - now
+
+    def stats(self):
+        """
+        Returns the mood changes and how long they took to show, the frames shown, the bytes copied to
+        the framebuffer and the time spent per frame.
+        """
+        return {
+            'mood': self.mood,
+            'switches': self.switches,
+            'switch_latency': self.switch_latency.as_dict(),
+            'blits': self.blits,
+            'bytes_written': self.bytes_written,
+            'late': self.late,
+            'blit_time': self.blit_time.as_dict(),
+        }
+
+
+if __name__ == '__main__':
+    # Blink for a while at 15 frames per second, redrawing every frame from the shapes and pushing the whole
+    # screen like _draweyes and Display.update, then blitting the precomputed frames' dirty rectangles
+    import mmap
+    import sys
+    import tempfile
+
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+    # The 1 bit per pixel screen of ev3dev-jessie, or the 32 bit one of ev3dev-stretch
+    bits_per_pixel = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    xres, yres = 178, 128
+    line_length = 24 if bits_per_pixel == 1 else xres * bits_per_pixel // 8
+
+    class _Screen:
+        """
+        A framebuffer file standing in for the EV3 screen.
+        """
+
+        def __init__(self):
+            fd, self.path = tempfile.mkstemp(prefix='ev3fb')
+            os.write(fd, bytes(line_length * yres))
+            self.mmap = mmap.mmap(fd, line_length * yres)
+            os.close(fd)
+
+    cache = os.path.join(tempfile.mkdtemp(), 'eyes.frames')
+    start = time.perf_counter()
+    frames = EyeFrames.open_or_build(cache, xres, yres, line_length, bits_per_pixel)
+    built = time.perf_counter() - start
+    start = time.perf_counter()
+    frames = EyeFrames.open_or_build(cache, xres, yres, line_length, bits_per_pixel)
+    loaded = time.perf_counter() - start
+    print("{} poses rasterized and saved in {:.1f} ms, loaded from {} ({} bytes) in {:.2f} ms".format(
+        len(frames.frames), built * 1000, os.path.basename(cache), os.path.getsize(cache), loaded * 1000))
+
+    sequence = [('open', FRAME)] * 15 + BLINK
+    count = int(seconds * 15)
+    names = [sequence[i % len(sequence)][0] for i in range(count)]
+
+    screen = _Screen()
+    cpu = time.process_time()
+    for name in names:
+        # Rasterize the pose, then write the whole screen
+        screen.mmap[:] = render(POSES[name], xres, yres, line_length, bits_per_pixel)
+    redraw = time.process_time() - cpu
+
+    screen = _Screen()
+    animator = EyeAnimator(screen, frames)
+    cpu = time.process_time()
+    for name in names:
+        animator.show(name)
+    blit = time.process_time() - cpu
+    assert bytes(screen.mmap[:]) == frames.frames[names[-1]]
+
+    print("{} frames ({:.0f}s at 15 fps):".format(count, seconds))
+    print("  redraw + full push: {:.2f} ms CPU per frame, {:.1%} of a CPU at 15 fps".format(
+        redraw / count * 1000, redraw / seconds))
+    print("  precomputed blit:   {:.3f} ms CPU per frame, {:.2%} of a CPU at 15 fps, {:.0f} bytes per frame".format(
+        blit / count * 1000, blit / seconds, animator.bytes_written / float(count)))
+    print("Animator stats: {}".format(animator.stats()))
+
+    # Switch moods every 0.3 to 1 s from another thread, like directives arriving, while the expressions
+    # play on a scheduler thread
+    from scheduler import ModeScheduler
+
+    scheduler = ModeScheduler()
+    animator = EyeAnimator(_Screen(), frames, wake=lambda: scheduler.wake('eyes'))
+    scheduler.add('eyes', animator.task, enabled=True)
+    scheduler.start()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        time.sleep(random.uniform(0.3, 1.0))
+        animator.express(random.choice([mood for mood in sorted(EXPRESSIONS) if mood != animator.mood]))
+    time.sleep(0.1)
+    scheduler.stop()
+    switches, blits = animator.switch_latency, animator.blit_time
+    print("{} mood switches: first frame on screen {:.2f} ms avg {:.2f} ms max after the switch, a frame is {:.0f} ms"
+          .format(switches.count, switches.total / switches.count * 1000, switches.max * 1000, FRAME * 1000))
+    print("{} frames: {:.3f} ms avg {:.3f} ms max per frame".format(
+        blits.count, blits.total / blits.count * 1000, blits.max * 1000))
@@ -9,7 +9,6 @@
 # THE IMPLIED WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, AND NON-INFRINGEMENT.
 
 import os
-import sys
 import time
 import logging
 import json
@@ -21,13 +20,22 @@ from agt import AlexaGadget
 
 from ev3dev2.led import Leds
 from ev3dev2.sound import Sound
-from ev3dev2.motor import OUTPUT_A, OUTPUT_B, OUTPUT_C, MoveTank, SpeedPercent, MediumMotor
+from ev3dev2.motor import OUTPUT_A, OUTPUT_B, OUTPUT_C, MoveTank, SpeedPercent, SpeedNativeUnits, MediumMotor
+
+from commands import CommandExecutor, PRIORITY_MOVE, PRIORITY_COMMAND
+from motion import MotionPlayer, load_timelines
+from ringlog import RingHandler, log
 
 # Set the logging level to INFO to see messages from AlexaGadget
-logging.basicConfig(level=logging.INFO, stream=sys.stdout, format='%(message)s')
-logging.getLogger().addHandler(logging.StreamHandler(sys.stderr))
+# Records go through the ring buffer log and are written to stderr in batches by its flusher thread
+logging.basicConfig(level=logging.INFO, handlers=[RingHandler(log)])
 logger = logging.getLogger(__name__)
 
+# Log sites hit on every loop iteration are rate limited, in records per second
+LOG_RATES = {'dance': 0.5, 'patrol': 1}
+for site, rate in LOG_RATES.items():
+    log.configure(site, rate=rate)
+
 
 class Direction(Enum):
     """
@@ -74,9 +82,18 @@ class MindstormsGadget(AlexaGadget):
         self.drive = MoveTank(OUTPUT_B, OUTPUT_C)
         self.weapon = MediumMotor(OUTPUT_A)
 
+        # The circle and the square are motion routines, played on the command thread
+        self.motions = load_timelines('motions.json')
+        self.motion = MotionPlayer({'wheels': lambda left, right, time_sp: self.drive.on_for_seconds(
+            SpeedNativeUnits(left), SpeedNativeUnits(right), time_sp / 1000.0, block=False)})
+
         # Start threads
         threading.Thread(target=self._patrol_thread, daemon=True).start()
 
+        # Directives are executed off the AlexaGadget callback thread
+        self.commands = CommandExecutor()
+        self.commands.start()
+
     def on_connected(self, device_addr):
         """
         Gadget connected to the paired Echo device.
@@ -102,19 +119,25 @@ class MindstormsGadget(AlexaGadget):
         """
         try:
             payload = json.loads(directive.payload.decode("utf-8"))
-            print("Control payload: {}".format(payload), file=sys.stderr)
+            log.log('directive', "Control payload: {}", payload)
             control_type = payload["type"]
             if control_type == "move":
 
                 # Expected params: [direction, duration, speed]
-                self._move(payload["direction"], int(payload["duration"]), int(payload["speed"]))
+                if payload["direction"] in Direction.STOP.value:
+                    # Stop skips the queue and drops everything still pending
+                    self.commands.preempt(self._move, payload["direction"], 0, 0)
+                else:
+                    self.commands.submit(self._move, payload["direction"], int(payload["duration"]),
+                                         int(payload["speed"]), priority=PRIORITY_MOVE, label="move")
 
             if control_type == "command":
                 # Expected params: [command]
-                self._activate(payload["command"])
+                self.commands.submit(self._activate, payload["command"], priority=PRIORITY_COMMAND,
+                                     label="command")
 
         except KeyError:
-            print("Missing expected parameters: {}".format(directive), file=sys.stderr)
+            log.log('directive', "Missing expected parameters: {}", directive, level=logging.WARNING)
 
     def _move(self, direction, duration: int, speed: int, is_blocking=False):
         """
@@ -125,16 +148,21 @@ class MindstormsGadget(AlexaGadget):
         :param speed: the speed percentage as an integer
         :param is_blocking: if set, motor run until duration expired before accepting another command
         """
-        print("Move command: ({}, {}, {}, {})".format(direction, speed, duration, is_blocking), file=sys.stderr)
+        log.log('move', "Move command: ({}, {}, {}, {})", direction, speed, duration, is_blocking)
         if direction in Direction.FORWARD.value:
-            self.drive.on_for_seconds(SpeedPercent(speed), SpeedPercent(speed), duration, block=is_blocking)
+            self.drive.on_for_seconds(SpeedPercent(speed), SpeedPercent(speed), duration, block=False)
 
         if direction in Direction.BACKWARD.value:
-            self.drive.on_for_seconds(SpeedPercent(-speed), SpeedPercent(-speed), duration, block=is_blocking)
+            self.drive.on_for_seconds(SpeedPercent(-speed), SpeedPercent(-speed), duration, block=False)
 
         if direction in (Direction.RIGHT.value + Direction.LEFT.value):
-            self._turn(direction, speed)
-            self.drive.on_for_seconds(SpeedPercent(speed), SpeedPercent(speed), duration, block=is_blocking)
+            if not self._turn(direction, speed):
+                return
+            self.drive.on_for_seconds(SpeedPercent(speed), SpeedPercent(speed), duration, block=False)
+
+        if is_blocking and direction not in Direction.STOP.value:
+            # A stop directive cancels the wait
+            self.commands.cancel.wait(duration)
 
         if direction in Direction.STOP.value:
             self.drive.off()
@@ -146,13 +174,12 @@ class MindstormsGadget(AlexaGadget):
         :param command: the preset command
         :param speed: the speed if applicable
         """
-        print("Activate command: ({}, {})".format(command, speed), file=sys.stderr)
+        log.log('command', "Activate command: ({}, {})", command, speed)
         if command in Command.MOVE_CIRCLE.value:
-            self.drive.on_for_seconds(SpeedPercent(int(speed)), SpeedPercent(5), 12)
+            self.motion.run(self.motions['circle'], self.commands.cancel)
 
         if command in Command.MOVE_SQUARE.value:
-            for i in range(4):
-                self._move("right", 2, speed, is_blocking=True)
+            self.motion.run(self.motions['square'], self.commands.cancel)
 
         if command in Command.PATROL.value:
             # Set patrol mode to resume patrol thread processing
@@ -170,12 +197,16 @@ class MindstormsGadget(AlexaGadget):
         Calibrated for hard smooth surface.
         :param direction: the turn direction
         :param speed: the turn speed
+        :return: False if a stop directive cancelled the turn
         """
         if direction in Direction.LEFT.value:
-            self.drive.on_for_seconds(SpeedPercent(0), SpeedPercent(speed), 2)
+            self.drive.on_for_seconds(SpeedPercent(0), SpeedPercent(speed), 2, block=False)
 
         if direction in Direction.RIGHT.value:
-            self.drive.on_for_seconds(SpeedPercent(speed), SpeedPercent(0), 2)
+            self.drive.on_for_seconds(SpeedPercent(speed), SpeedPercent(0), 2, block=False)
+
+        # The turn holds the command thread until it is done or a stop directive cancels it
+        return not self.commands.cancel.wait(2)
 
     def _patrol_thread(self):
         """
@@ -183,7 +214,7 @@ class MindstormsGadget(AlexaGadget):
         """
         while True:
             while self.patrol_mode:
-                print("Patrol mode activated randomly picks a path", file=sys.stderr)
+                log.log('patrol', "Patrol mode activated randomly picks a path")
                 direction = random.choice(list(Direction))
                 duration = random.randint(1, 5)
                 speed = random.randint(1, 4) * 25
@@ -199,6 +230,8 @@ class MindstormsGadget(AlexaGadget):
 
 if __name__ == '__main__':
 
+    log.start()
+    log.install_crash_dump()
     gadget = MindstormsGadget()
 
     # Set LCD font and turn off blinking LEDs
@@ -215,6 +248,10 @@ if __name__ == '__main__':
     gadget.main()
 
     # Shutdown sequence
+    logger.info("Command stats: {}".format(gadget.commands.stats()))
+    logger.info("Motion stats: {}".format(gadget.motion.stats()))
+    logger.info("Log stats: {}".format(log.stats()))
     gadget.sound.play_song((('E5', 'e'), ('C4', 'e')))
     gadget.leds.set_color("LEFT", "BLACK")
     gadget.leds.set_color("RIGHT", "BLACK")
+    log.stop()
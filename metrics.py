@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""
+Counters, gauges and latency histograms for the Mindstorms puppy gadget.
+
+Hot paths update metrics handed out by a Registry. A disabled registry hands
+out one shared no-op metric, so instrumented code costs a method call that
+does nothing. Values the services already keep, like motor write counters,
+are read by collector functions only when the metrics are scraped.
+
+The registry is served in the Prometheus text format over HTTP, on a Unix
+socket or a TCP port, and can be written as a compact JSON snapshot to disk
+at a fixed interval::
+
+    curl --unix-socket /run/puppy/metrics.sock http://localhost/metrics
+"""
+
+import bisect
+import ctypes
+import json
+import os
+import platform
+import socket
+import socketserver
+import threading
+import time
+
+# Upper bounds in seconds, from a sysfs write to a slow directive
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counter:
+    """
+    A value that only goes up.
+    """
+
+    type = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge:
+    """
+    A value that goes up and down.
+    """
+
+    type = 'gauge'
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Histogram:
+    """
+    Counts of observed durations in fixed buckets, with their count and sum.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # One count per bucket plus the +Inf bucket, not cumulative
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            yield name + '_bucket', labels + (('le', _format_value(bound)),), cumulative
+        yield name + '_count', labels, self.count
+        yield name + '_sum', labels, self.sum
+
+
+class _NullMetric:
+    """
+    Stands in for every metric of a disabled registry.
+    """
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, seconds):
+        pass
+
+
+NULL = _NullMetric()
+
+
+class _Collector:
+    def __init__(self, read, type):
+        self.read = read
+        self.type = type
+
+    def samples(self, name, labels):
+        value = self.read()
+        if isinstance(value, dict):
+            # Label values of the first label name, e.g. one value per thread
+            label, values = labels[0][0], value
+            for label_value, sample in sorted(values.items()):
+                yield name, labels[1:] + ((label, str(label_value)),), sample
+        else:
+            yield name, labels, value
+
+
+class Registry:
+    """
+    The metrics of a process, by name and labels.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        # name -> (type, help, {labels: metric})
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, help, **labels):
+        return self._get(name, help, labels, Counter)
+
+    def gauge(self, name, help, **labels):
+        return self._get(name, help, labels, Gauge)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self._get(name, help, labels, lambda: Histogram(buckets))
+
+    def attach(self, timing, name, help, **labels):
+        """
+        Feeds every duration added to a ``_Timing`` into a histogram as well.
+        """
+        if self.enabled:
+            timing.histogram = self.histogram(name, help, **labels)
+
+    def collect(self, name, help, read, type='gauge', label=None, **labels):
+        """
+        Registers a value read when the metrics are rendered, nothing is done on the hot path.
+        :param read: a callable returning the value, or a dict of values keyed by the value of ``label``
+        :param type: 'gauge' or 'counter'
+        :param label: the label name of the keys of a dict returned by ``read``
+        """
+        if not self.enabled:
+            return
+        key = ((label, ''),) if label is not None else ()
+        self._get(name, help, labels, lambda: _Collector(read, type), prefix=key)
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, (type, help, metrics) in sorted(self._families.items()):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, type))
+            for labels, metric in list(metrics.items()):
+                for sample, sample_labels, value in metric.samples(name, labels):
+                    lines.append('{}{} {}'.format(sample, _format_labels(sample_labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        Returns the current values as a compact dict, histograms as [count, sum, bucket counts...].
+        """
+        values = {}
+        for name, (_, _, metrics) in self._families.items():
+            for labels, metric in list(metrics.items()):
+                if isinstance(metric, Histogram):
+                    values[name + _format_labels(labels)] = [metric.count, round(metric.sum, 6)] + metric.counts
+                    continue
+                for sample, sample_labels, value in metric.samples(name, labels):
+                    values[sample + _format_labels(sample_labels)] = value
+        return {'t': round(time.time(), 3), 'metrics': values}
+
+    def snapshot_task(self, path, interval=60):
+        """
+        Generator writing a snapshot to ``path`` every ``interval`` seconds, for use with the ModeScheduler.
+        The file is replaced atomically, so a reader never sees a partial snapshot.
+        """
+        while True:
+            yield interval
+            self.write_snapshot(path)
+
+    def write_snapshot(self, path):
+        with open(path + '.tmp', 'w') as snapshot:
+            json.dump(self.snapshot(), snapshot, separators=(',', ':'))
+        os.replace(path + '.tmp', path)
+
+    def _get(self, name, help, labels, factory, prefix=()):
+        if not self.enabled:
+            return NULL
+        key = prefix + tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._families.get(name)
+            metric = family[2].get(key) if family is not None else None
+            if metric is None:
+                metric = factory()
+                if family is None:
+                    family = self._families[name] = (metric.type, help, {})
+                family[2][key] = metric
+        return metric
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                          for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+# The gadget's metrics, disabled until new.py enables them
+registry = Registry(enabled=False)
+
+# gettid syscall numbers: i386 and 32 bit ARM, the EV3's architecture, share 224
+_GETTID = {'x86_64': 186, 'aarch64': 178}
+# Kernel thread ids by Thread.ident, recorded by the threads themselves where Thread.native_id is missing
+_native_ids = {}
+
+
+def _gettid():
+    """
+    Returns the kernel thread id of the calling thread, None if it is not known on this architecture.
+    """
+    machine = platform.machine()
+    number = _GETTID.get(machine, 224 if machine.startswith(('arm', 'i386', 'i686')) else None)
+    if number is None:
+        return None
+    return ctypes.CDLL(None).syscall(number)
+
+
+def install():
+    """
+    Lets thread_cpu_seconds find the threads started from now on, on Pythons without Thread.native_id.
+    Thread.native_id is new in Python 3.8 and the brick runs 3.5: there Thread.run is wrapped so every thread
+    records its kernel id when it starts. Does nothing on newer Pythons or when called again.
+    """
+    if hasattr(threading.Thread, 'native_id') or threading.main_thread().ident in _native_ids:
+        return
+    run = threading.Thread.run
+
+    def record_native_id(thread):
+        _native_ids[thread.ident] = _gettid()
+        try:
+            run(thread)
+        finally:
+            _native_ids.pop(thread.ident, None)
+    threading.Thread.run = record_native_id
+    _native_ids[threading.main_thread().ident] = os.getpid()
+
+
+def thread_cpu_seconds():
+    """
+    Returns the CPU time used by every live Python thread in seconds, keyed by thread name.
+    Before Python 3.8 only the threads started after install() are known.
+    """
+    ticks = os.sysconf('SC_CLK_TCK')
+    times = {}
+    for thread in threading.enumerate():
+        native_id = getattr(thread, 'native_id', None) or _native_ids.get(thread.ident)
+        if native_id is None:
+            continue
+        try:
+            with open('/proc/self/task/{}/stat'.format(native_id)) as stat:
+                # Fields after the parenthesized command name, utime and stime are the 12th and 13th
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        times[thread.name] = (int(fields[11]) + int(fields[12])) / float(ticks)
+    return times
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = self.rfile.readline(1024).decode('latin-1').split()
+        # Skip the headers
+        while self.rfile.readline(1024).strip():
+            pass
+        if len(request) < 2 or request[0] != 'GET':
+            self._respond('405 Method Not Allowed', 'text/plain', b'')
+        elif request[1].split('?')[0] in ('/', '/metrics'):
+            self._respond('200 OK', CONTENT_TYPE, self.server.registry.render().encode('utf-8'))
+        else:
+            self._respond('404 Not Found', 'text/plain', b'')
+
+    def _respond(self, status, content_type, body):
+        self.wfile.write('HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(
+            status, content_type, len(body)).encode('latin-1') + body)
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsServer:
+    """
+    Serves a registry over HTTP on a background thread.
+    """
+
+    def __init__(self, registry, address):
+        """
+        :param registry: the Registry to serve
+        :param address: a Unix socket path, or a (host, port) tuple for TCP
+        """
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.unlink(address)
+            self.server = _UnixServer(address, _Handler)
+        else:
+            self.server = _TCPServer(address, _Handler)
+        self.server.registry = registry
+        self.address = address
+        self._thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+def parse_address(text):
+    """
+    Returns a MetricsServer address from its text form: a path, or host:port.
+    """
+    if '/' in text or ':' not in text:
+        return text
+    host, port = text.rsplit(':', 1)
+    return host or 'localhost', int(port)
+
+
+if __name__ == '__main__':
+    # Cost of a hot path update with the metrics disabled and enabled, and of a scrape
+    import tempfile
+    import timeit
+
+    rounds = 200000
+    print("{:24s} {:>10s} {:>10s}".format('ns/op', 'disabled', 'enabled'))
+    for label, operation in (('counter inc', lambda metric: metric.inc),
+                             ('histogram observe', lambda metric: lambda: metric.observe(0.003))):
+        costs = []
+        for enabled in (False, True):
+            registry = Registry(enabled)
+            make = registry.counter if label.startswith('counter') else registry.histogram
+            call = operation(make('bench', 'Benchmark metric'))
+            costs.append(timeit.timeit(call, number=rounds) / rounds * 1e9)
+        print("{:24s} {:10.0f} {:10.0f}".format(label, *costs))
+    baseline = timeit.timeit(lambda: None, number=rounds) / rounds * 1e9
+    print("{:24s} {:10.0f}".format('empty call', baseline))
+
+    install()
+    registry = Registry()
+    for thread in range(5):
+        registry.histogram('gadget_bench_seconds', 'Benchmark latency', thread=str(thread)).observe(0.01)
+    registry.collect('gadget_thread_cpu_seconds_total', 'CPU time per thread', thread_cpu_seconds,
+                     type='counter', label='thread')
+    path = os.path.join(tempfile.mkdtemp(), 'metrics.sock')
+    server = MetricsServer(registry, path).start()
+    start = time.perf_counter()
+    client = socket.socket(socket.AF_UNIX)
+    client.connect(path)
+    client.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+    response = b''.join(iter(lambda: client.recv(65536), b''))
+    print("scrape over {}: {} bytes in {:.2f} ms".format(path, len(response), (time.perf_counter() - start) * 1000))
+    server.stop()
+    print(response.decode().split('\r\n\r\n', 1)[1].splitlines()[-3:])
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Motion timelines for the Mindstorms puppy gadget.
+
+Motion routines are data instead of hand-written sequences of motor calls and
+sleeps. A routine lists timed steps, each driving one actuator to a setpoint::
+
+    "square": {"repeat": 4, "steps": [
+        {"at": 0, "wheels": [525, 0], "for": 2000},
+        {"at": 2000, "wheels": [525, 525], "for": 2000}
+    ]}
+
+``at`` is the time of the step in the routine's ``unit``: 'ms' (the default),
+'s' or 'beat'. ``for`` is the run time of the motors in milliseconds and is
+passed to the actuator after the setpoint. ``length`` is the length of one
+repetition, by default the end of its last step. What an actuator's setpoint
+means is up to the player's actuators, e.g. wheel speeds in deg/s. A step
+without ``for``, e.g. a move by rotations, lasts as long as its actuator says:
+an actuator may return the seconds its motors run, and a timeline is only over
+once they stopped.
+
+Routines are compiled when they are loaded into timelines of parallel arrays
+of event times, actuators and setpoints, in time order and with the
+repetitions unrolled. The player runs every event at its absolute time on the
+monotonic clock, so the time a motor command takes never delays the events
+after it, and it records how late each event ran. Timelines counted in beats
+are cued one beat at a time by the dance engine instead.
+
+Usage::
+
+    python3 motion.py show motions.json
+    python3 motion.py bench motions.json
+"""
+
+import array
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import yaml
+except ImportError:
+    # The ev3dev image does not ship PyYAML, the gadget's routines are JSON
+    yaml = None
+
+from commands import _Timing
+
+logger = logging.getLogger(__name__)
+
+# Seconds per time unit of a routine, beat timelines are kept in beats
+UNITS = {'ms': 0.001, 's': 1.0, 'beat': 1}
+# Setpoint values an event holds, its run time included
+VALUES = 3
+
+
+class Timeline:
+    """
+    A compiled motion routine: parallel arrays of event times, actuator numbers and setpoints, in time order.
+    """
+
+    def __init__(self, name, unit, length, names, times, actuators, arity, values):
+        """
+        :param unit: 'beat' if the times are beats, otherwise they are seconds
+        :param length: the length of the timeline in seconds or beats, past its last event if motors still run
+        :param names: the actuator names, indexed by the actuator numbers
+        :param times: array of event times
+        :param actuators: array of event actuator numbers
+        :param arity: array of the number of setpoint values of every event
+        :param values: array of VALUES setpoint values per event
+        """
+        self.name = name
+        self.unit = unit
+        self.length = length
+        self.names = names
+        self.times = times
+        self.actuators = actuators
+        self.arity = arity
+        self.values = values
+
+    def __len__(self):
+        return len(self.times)
+
+    def setpoint(self, index):
+        """
+        Returns the setpoint values of an event.
+        """
+        start = index * VALUES
+        return self.values[start:start + self.arity[index]]
+
+    def events(self):
+        """
+        Yields (time, actuator name, setpoint values) of every event.
+        """
+        for index in range(len(self.times)):
+            yield self.times[index], self.names[self.actuators[index]], tuple(self.setpoint(index))
+
+    @property
+    def nbytes(self):
+        return sum(column.itemsize * len(column) for column in (self.times, self.actuators, self.arity, self.values))
+
+
+def compile_timeline(name, routine):
+    """
+    Compiles a routine into a timeline.
+    :param routine: a list of steps, or a dict with the steps and optionally the unit, length and repeat count
+    :raises ValueError: if the routine is malformed
+    """
+    if isinstance(routine, list):
+        routine = {'steps': routine}
+    unit = routine.get('unit', 'ms')
+    if unit not in UNITS:
+        raise ValueError("{}: unknown unit {!r}, expected one of {}".format(name, unit, sorted(UNITS)))
+    scale = UNITS[unit]
+    repeat = int(routine.get('repeat', 1))
+
+    names = []
+    events = []
+    end = 0
+    for number, step in enumerate(routine['steps']):
+        step = dict(step)
+        at = step.pop('at', 0) * scale
+        run_for = step.pop('for', None)
+        if len(step) != 1:
+            raise ValueError("{} step {}: expected one actuator, got {}".format(name, number, sorted(step)))
+        (actuator, setpoint), = step.items()
+        setpoint = list(setpoint) if isinstance(setpoint, (list, tuple)) else [setpoint]
+        if run_for is not None:
+            setpoint.append(run_for)
+        if len(setpoint) > VALUES:
+            raise ValueError("{} step {}: {} takes at most {} values".format(name, number, actuator, VALUES))
+        if unit == 'beat':
+            if at != int(at):
+                raise ValueError("{} step {}: beat timelines step on whole beats".format(name, number))
+            end = max(end, at + 1)
+        else:
+            end = max(end, at + (run_for or 0) / 1000.0)
+        if actuator not in names:
+            names.append(actuator)
+        events.append((at, names.index(actuator), setpoint))
+    period = routine['length'] * scale if 'length' in routine else end
+
+    # The repetitions are unrolled and the events sorted by time, steps at the same time keep their order
+    events = sorted(((at + period * repetition, actuator, setpoint) for repetition in range(repeat)
+                     for at, actuator, setpoint in events), key=lambda event: event[0])
+    values = array.array('d', bytes(8 * VALUES * len(events)))
+    for index, (_, _, setpoint) in enumerate(events):
+        values[index * VALUES:index * VALUES + len(setpoint)] = array.array('d', setpoint)
+    return Timeline(name, unit, period * repeat, names, array.array('d', (event[0] for event in events)),
+                    array.array('B', (event[1] for event in events)),
+                    array.array('B', (len(event[2]) for event in events)), values)
+
+
+def load_timelines(path):
+    """
+    Loads and compiles the motion routines of a JSON file, or a YAML file if PyYAML is installed.
+    :return: the timelines by routine name
+    """
+    start = time.perf_counter()
+    with open(path) as routines:
+        if os.path.splitext(path)[1] in ('.yaml', '.yml'):
+            if yaml is None:
+                raise ImportError("PyYAML is needed to load {}".format(path))
+            routines = yaml.safe_load(routines)
+        else:
+            routines = json.load(routines)
+    timelines = {name: compile_timeline(name, routine) for name, routine in routines.items()}
+    logger.info("Compiled {} motion timelines from {} in {:.1f}ms".format(
+        len(timelines), path, (time.perf_counter() - start) * 1000))
+    return timelines
+
+
+class MotionPlayer:
+    """
+    Plays motion timelines against a monotonic clock. play() queues a timeline for the ModeScheduler task, one
+    at a time, run() plays one on the calling thread.
+    """
+
+    def __init__(self, actuators, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param actuators: the callables driving each actuator by name, called with an event's setpoint values.
+            They may return the seconds the actuator runs for
+        :param clock: the monotonic clock events are scheduled on
+        :param sleep: how run() waits for the next event
+        """
+        self.actuators = actuators
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._pending = None
+        # Timeline name -> the callables of its actuator numbers
+        self._bound = {}
+
+        self.plays = 0
+        self.preempted = 0
+        self.events = 0
+        self.lateness = _Timing()
+
+    def play(self, timeline):
+        """
+        Queues a timeline to start now. The task started next plays it, a running one is not interrupted.
+        A timeline queued before that no task started yet is dropped.
+        :return: an event that is set once the timeline is over, was interrupted or dropped
+        """
+        self._check(timeline)
+        done = threading.Event()
+        with self._lock:
+            dropped, self._pending = self._pending, (timeline, self.clock(), done)
+        if dropped is not None:
+            self.preempted += 1
+            dropped[2].set()
+        return done
+
+    def run(self, timeline, cancel=None):
+        """
+        Plays a timeline on the calling thread and returns once it is over.
+        :param cancel: an Event, e.g. CommandExecutor.cancel: once it is set the timeline is interrupted before
+            its next event and run() returns
+        :return: False if the timeline was interrupted
+        """
+        self._check(timeline)
+        # Played on its own, whatever the scheduler task plays meanwhile
+        steps = self._playback(timeline, self.clock(), threading.Event())
+        for delay in steps:
+            if cancel is None:
+                self.sleep(delay)
+            elif cancel.wait(delay):
+                steps.close()
+                return False
+        return True
+
+    def cue(self, timeline, beat):
+        """
+        Runs the events of one beat of a beat timeline straight away, looping the timeline.
+        Called on the beat, e.g. by a DanceEngine step.
+        """
+        calls = self._bind(timeline)
+        position = beat % timeline.length
+        for index in range(bisect.bisect_left(timeline.times, position),
+                           bisect.bisect_left(timeline.times, position + 1)):
+            calls[timeline.actuators[index]](*timeline.setpoint(index))
+            self.events += 1
+
+    def task(self):
+        """
+        Generator for the ModeScheduler playing the timeline queued last, done when the timeline is over.
+        Every event is due at an absolute time, so a late event does not delay the ones after it.
+        Closing the generator interrupts the timeline.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, None
+        if pending is None:
+            return
+        yield from self._playback(*pending)
+
+    def _playback(self, timeline, start, done):
+        calls = self._bind(timeline)
+        self.plays += 1
+        finished = False
+        end = start + timeline.length
+        try:
+            for index in range(len(timeline)):
+                due = start + timeline.times[index]
+                now = self.clock()
+                if due > now:
+                    yield due - now
+                    now = self.clock()
+                self.lateness.add(now - due)
+                runs = calls[timeline.actuators[index]](*timeline.setpoint(index))
+                if runs is not None:
+                    end = max(end, now + runs)
+                self.events += 1
+            # The timeline is over once its last motor run is
+            now = self.clock()
+            if end > now:
+                yield end - now
+            finished = True
+        finally:
+            if not finished:
+                self.preempted += 1
+            done.set()
+
+    def stats(self):
+        """
+        Returns the timelines played and interrupted, the events run and how late they ran after their deadline.
+        """
+        return {
+            'plays': self.plays,
+            'preempted': self.preempted,
+            'events': self.events,
+            'lateness': self.lateness.as_dict(),
+        }
+
+    def _check(self, timeline):
+        if timeline.unit == 'beat':
+            raise ValueError("{} is counted in beats, cue it on the beat".format(timeline.name))
+        self._bind(timeline)
+
+    def _bind(self, timeline):
+        calls = self._bound.get(timeline.name)
+        if calls is None:
+            missing = [name for name in timeline.names if name not in self.actuators]
+            if missing:
+                raise ValueError("{}: no actuator {}".format(timeline.name, ', '.join(missing)))
+            calls = self._bound[timeline.name] = [self.actuators[name] for name in timeline.names]
+        return calls
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) != 3 or sys.argv[1] not in ('show', 'bench'):
+        print(__doc__)
+        sys.exit(1)
+
+    if sys.argv[1] == 'show':
+        for timeline in load_timelines(sys.argv[2]).values():
+            print("{}: {} events over {:g} {}, {} bytes".format(
+                timeline.name, len(timeline), timeline.length, 'beats' if timeline.unit == 'beat' else 's',
+                timeline.nbytes))
+            for at, actuator, setpoint in timeline.events():
+                print("  {:8.3f}  {:8s} {}".format(at, actuator, ', '.join('{:g}'.format(value) for value in setpoint)))
+        sys.exit(0)
+
+    with open(sys.argv[2]) as routines:
+        routines = json.load(routines)
+    rounds = 1000
+    start = time.perf_counter()
+    for _ in range(rounds):
+        timelines = {name: compile_timeline(name, routine) for name, routine in routines.items()}
+    elapsed = time.perf_counter() - start
+    events = sum(len(timeline) for timeline in timelines.values())
+    print("compile: {} routines, {} events in {:.0f} us, {:.1f} us per event, {} bytes of arrays".format(
+        len(timelines), events, elapsed / rounds * 1e6, elapsed / rounds / events * 1e6,
+        sum(timeline.nbytes for timeline in timelines.values())))
+
+    # A routine of 200 motor commands 20 ms apart, each taking about as long as the sysfs writes of a
+    # run_timed on the brick. Hand-written, the sequence sleeps 20 ms after every command, like the
+    # routines did; the player sleeps until the absolute time of each event
+    def _command(*setpoint):
+        until = time.perf_counter() + 0.0015
+        while time.perf_counter() < until:
+            pass
+
+    steps = [{'at': 20 * index, 'wheels': [300, -300], 'for': 20} for index in range(200)]
+    timeline = compile_timeline('bench', steps)
+
+    sleeps = _Timing()
+    started = time.monotonic()
+    for index in range(len(steps)):
+        sleeps.add(time.monotonic() - started - index * 0.02)
+        _command(300, -300, 20)
+        time.sleep(0.02)
+    player = MotionPlayer({'wheels': _command})
+    player.run(timeline)
+    for name, timing in (('sleeps', sleeps), ('player', player.lateness)):
+        print("{:6s} lateness {:6.2f} ms avg {:6.2f} ms max".format(
+            name, timing.total / timing.count * 1000, timing.max * 1000))
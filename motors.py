@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+Motor command coalescing for the Mindstorms puppy gadget.
+
+Every ev3dev motor command is several sysfs attribute writes: ``run_timed``
+writes ``speed_sp``, ``time_sp`` and ``command``. MotorFacade remembers what the
+motor was last told to do and which attribute values it holds, so it skips
+commands the motor is already running, turns a repeated timed run into a
+single timer restart and only writes the attributes that changed.
+
+MotorPair drives both wheels together: it stages the setpoints of both motors
+first and then writes the two ``command`` attributes back to back, so the
+wheels start as close together as possible. All attributes are written through
+the persistent handles of the sysfs module.
+"""
+
+import os
+import threading
+import time
+
+from commands import _Timing
+from sysfs import attributes
+
+# Attributes written through open handles
+_ATTRIBUTES = ('command', 'speed_sp', 'time_sp', 'stop_action')
+
+RUN_FOREVER = 'run-forever'
+RUN_TIMED = 'run-timed'
+STOP = 'stop'
+
+# A timed run at the running speed ending within this many seconds of the running one is the same command
+END_TOLERANCE = 0.01
+
+
+class MotorFacade:
+    """
+    Wraps a LargeMotor or MediumMotor and drops redundant commands.
+    Other motor attributes and methods are passed through to the motor.
+    """
+
+    def __init__(self, motor, clock=time.monotonic, cache=attributes):
+        """
+        :param motor: the ev3dev motor, or anything with the same sysfs-backed attributes
+        :param clock: the monotonic clock timed runs are tracked with
+        :param cache: the AttributeCache the handles are taken from
+        """
+        self.motor = motor
+        self.clock = clock
+        # Open handles of the attributes we write, motors without a sysfs path use their properties
+        self._handles = {}
+        for name in _ATTRIBUTES:
+            handle = cache.get(motor, name, writable=True)
+            if handle is not None:
+                self._handles[name] = handle
+        self.max_speed = motor.max_speed
+
+        # Last value written to each setpoint attribute
+        self._written = {}
+        self._mode = STOP
+        self._speed = 0
+        self._ends_at = 0.0
+        self._lock = threading.Lock()
+
+        self.commands = 0
+        self.suppressed = 0
+        self.merged = 0
+        self.writes = 0
+        self.writes_suppressed = 0
+
+    def __getattr__(self, name):
+        return getattr(self.motor, name)
+
+    def run_timed(self, speed_sp, time_sp, stop_action=None):
+        """
+        Runs the motor at ``speed_sp`` deg/s for ``time_sp`` milliseconds.
+        If the motor is already running at that speed the command only moves the end of the run,
+        and is dropped when the run ends at the same time anyway.
+        :param stop_action: if given, what the motor does at the end of the run
+        """
+        self.release(self.stage_timed(speed_sp, time_sp, stop_action))
+
+    def run_forever(self, speed_sp):
+        """
+        Runs the motor at ``speed_sp`` deg/s until told otherwise.
+        """
+        self.release(self.stage_forever(speed_sp))
+
+    def stop(self, stop_action=None):
+        """
+        Stops the motor, dropped if it is already stopped or its timed run is over.
+        :param stop_action: 'coast', 'brake' or 'hold', defaults to the motor's current stop action
+        """
+        self.release(self.stage_stop(stop_action))
+
+    def stage_timed(self, speed_sp, time_sp, stop_action=None):
+        """
+        Writes the setpoints of a run_timed without starting it.
+        :return: the command to release, or None if the command is dropped
+        """
+        speed_sp = int(speed_sp)
+        time_sp = int(time_sp)
+        with self._lock:
+            self.commands += 1
+            now = self.clock()
+            ends_at = now + time_sp / 1000.0
+            if self._running(RUN_TIMED, speed_sp, now):
+                if abs(ends_at - self._ends_at) <= END_TOLERANCE:
+                    self._suppress(3)
+                    return None
+                # A later or an earlier end: the new time_sp restarts the motor's timer
+                self.merged += 1
+            if stop_action is not None:
+                self._write('stop_action', stop_action)
+            self._write('speed_sp', speed_sp)
+            self._write('time_sp', time_sp)
+            self._mode, self._speed, self._ends_at = RUN_TIMED, speed_sp, ends_at
+        return RUN_TIMED
+
+    def stage_forever(self, speed_sp):
+        """
+        Writes the setpoints of a run_forever without starting it.
+        :return: the command to release, or None if the command is dropped
+        """
+        speed_sp = int(speed_sp)
+        with self._lock:
+            self.commands += 1
+            if self._running(RUN_FOREVER, speed_sp, self.clock()):
+                self._suppress(2)
+                return None
+            self._write('speed_sp', speed_sp)
+            self._mode, self._speed, self._ends_at = RUN_FOREVER, speed_sp, float('inf')
+        return RUN_FOREVER
+
+    def stage_stop(self, stop_action=None):
+        """
+        Writes the stop action of a stop without stopping.
+        :return: the command to release, or None if the motor is not running
+        """
+        with self._lock:
+            self.commands += 1
+            if stop_action is not None:
+                self._write('stop_action', stop_action)
+            running = self._mode != STOP and self.clock() < self._ends_at
+            self._mode, self._speed, self._ends_at = STOP, 0, 0.0
+            if not running:
+                self._suppress(1)
+                return None
+        return STOP
+
+    def release(self, command):
+        """
+        Starts a staged command by writing the command attribute.
+        :param command: the command returned by one of the stage methods, None does nothing
+        """
+        if command is None:
+            return
+        handle = self._handles.get('command')
+        if handle is not None:
+            handle.write(command)
+        else:
+            self.motor.command = command
+        self.writes += 1
+
+    def on_for_rotations(self, *args, **kwargs):
+        """
+        Passed through to the motor, which writes its own setpoints.
+        """
+        with self._lock:
+            self.commands += 1
+            self._written.clear()
+            self._mode, self._ends_at = STOP, 0.0
+        return self.motor.on_for_rotations(*args, **kwargs)
+
+    def speed(self, percent):
+        """
+        Converts a speed in percent of the maximum speed to deg/s.
+        """
+        return int(round(percent * self.max_speed / 100.0))
+
+    def stats(self):
+        """
+        Returns the command counters and the sysfs attribute writes issued and suppressed.
+        """
+        return {
+            'commands': self.commands,
+            'suppressed': self.suppressed,
+            'merged': self.merged,
+            'writes': self.writes,
+            'writes_suppressed': self.writes_suppressed,
+        }
+
+    def _suppress(self, writes):
+        self.suppressed += 1
+        self.writes_suppressed += writes
+
+    def _running(self, mode, speed, now):
+        return self._mode == mode and self._speed == speed and now < self._ends_at
+
+    def _write(self, attribute, value):
+        if self._written.get(attribute) == value:
+            self.writes_suppressed += 1
+            return
+        handle = self._handles.get(attribute)
+        if handle is not None:
+            handle.write(value)
+        else:
+            setattr(self.motor, attribute, value)
+        self._written[attribute] = value
+        self.writes += 1
+
+
+class MotorPair:
+    """
+    The two wheel motors, commanded together with the smallest possible gap between their starts.
+    """
+
+    def __init__(self, left, right):
+        """
+        :param left: the left wheel MotorFacade
+        :param right: the right wheel MotorFacade
+        """
+        self.left = left
+        self.right = right
+        self.skew = _Timing()
+
+    def run_timed(self, left_speed, right_speed, time_sp, stop_action=None):
+        """
+        Runs the wheels at their speeds in deg/s for ``time_sp`` milliseconds.
+        """
+        self._release(self.left.stage_timed(left_speed, time_sp, stop_action),
+                      self.right.stage_timed(right_speed, time_sp, stop_action))
+
+    def run_forever(self, left_speed, right_speed):
+        """
+        Runs the wheels at their speeds in deg/s until told otherwise.
+        """
+        self._release(self.left.stage_forever(left_speed), self.right.stage_forever(right_speed))
+
+    def stop(self, stop_action=None):
+        """
+        Stops both wheels.
+        """
+        self._release(self.left.stage_stop(stop_action), self.right.stage_stop(stop_action))
+
+    def stats(self):
+        """
+        Returns the time between the start of the left and the right wheel, in seconds.
+        """
+        return {'skew': self.skew.as_dict()}
+
+    def _release(self, left_command, right_command):
+        start = time.perf_counter()
+        self.left.release(left_command)
+        if left_command is not None and right_command is not None:
+            self.skew.add(time.perf_counter() - start)
+        self.right.release(right_command)
+
+
+if __name__ == '__main__':
+    # Replay the gadget's motor call patterns on a file-backed fake sysfs, with and without the facade,
+    # then compare the wheel start skew of sequential calls and of a MotorPair
+    import tempfile
+
+    class _FileMotor:
+        """
+        A motor whose attributes are files, written the way ev3dev writes sysfs attributes.
+        """
+
+        def __init__(self, path):
+            self._path = path
+            os.makedirs(path)
+            for name in _ATTRIBUTES:
+                open(os.path.join(path, name), 'w').close()
+            self.max_speed = 1050
+            self.writes = 0
+            self._started_at = None
+
+        def __setattr__(self, name, value):
+            if name.startswith('_') or name in ('max_speed', 'writes'):
+                return object.__setattr__(self, name, value)
+            if name == 'command':
+                self._started_at = time.perf_counter()
+            with open(os.path.join(self._path, name), 'w') as attribute:
+                attribute.write(str(value))
+            self.writes += 1
+
+        def run_timed(self, speed_sp, time_sp):
+            self.speed_sp, self.time_sp, self.command = speed_sp, time_sp, RUN_TIMED
+
+        def run_forever(self, speed_sp):
+            self.speed_sp, self.command = speed_sp, RUN_FOREVER
+
+        def stop(self):
+            self.command = STOP
+
+    class _Clock:
+        now = 0.0
+
+        def __call__(self):
+            return self.now
+
+    def _workload(left, right, clock):
+        # Dance: 100 bars of the _dance_task steps, 390 ms per beat
+        speed = 400
+        for _ in range(100):
+            speed = -speed
+            for step_speed, step_time in ((speed, 150), (speed, 150), (350, 300), (speed, 150)):
+                right.run_timed(speed_sp=step_speed, time_sp=step_time)
+                left.run_timed(speed_sp=-step_speed, time_sp=step_time)
+                clock.now += 0.39
+        # "come" said three times in a row, one second apart
+        for _ in range(3):
+            right.run_timed(speed_sp=750, time_sp=2500)
+            left.run_timed(speed_sp=750, time_sp=2500)
+            clock.now += 1.0
+        # Heel: the controller holding its speed, then "stop" twice
+        for tick in range(100):
+            speed = 300 if tick < 50 else -300
+            left.run_forever(speed_sp=speed)
+            right.run_forever(speed_sp=speed)
+            clock.now += 0.1
+        for _ in range(2):
+            left.stop()
+            right.stop()
+
+    root = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    results = {}
+    for name in ('plain', 'facade'):
+        clock = _Clock()
+        left = _FileMotor(os.path.join(root, name, 'motor0'))
+        right = _FileMotor(os.path.join(root, name, 'motor1'))
+        if name == 'facade':
+            left, right = MotorFacade(left, clock), MotorFacade(right, clock)
+        start = time.perf_counter()
+        _workload(left, right, clock)
+        elapsed = time.perf_counter() - start
+        results[name] = (left.writes + right.writes, elapsed)
+        if name == 'facade':
+            print("Facade stats: {}".format({'left': left.stats(), 'right': right.stats()}))
+
+    for name, (writes, elapsed) in sorted(results.items(), reverse=True):
+        print("{:6s} {:5d} sysfs writes in {:.1f} ms".format(name, writes, elapsed * 1000))
+    print("{:.0%} of the writes suppressed".format(1 - results['facade'][0] / float(results['plain'][0])))
+
+    rounds = 1000
+    right = _FileMotor(os.path.join(root, 'skew', 'motor1'))
+    left = _FileMotor(os.path.join(root, 'skew', 'motor0'))
+    sequential = _Timing()
+    for i in range(rounds):
+        # What the drive primitives do today: one full run_timed after the other
+        speed = 300 + i % 2
+        right.run_timed(speed_sp=speed, time_sp=1000)
+        left.run_timed(speed_sp=speed, time_sp=1000)
+        sequential.add(left._started_at - right._started_at)
+
+    clock = _Clock()
+    pair = MotorPair(MotorFacade(_FileMotor(os.path.join(root, 'pair', 'motor0')), clock),
+                     MotorFacade(_FileMotor(os.path.join(root, 'pair', 'motor1')), clock))
+    for i in range(rounds):
+        speed = 300 + i % 2
+        pair.run_timed(speed, speed, 1000)
+    paired = pair.skew
+    print("wheel start skew: sequential {:.1f} us avg {:.1f} us max, paired {:.1f} us avg {:.1f} us max".format(
+        sequential.total / rounds * 1e6, sequential.max * 1e6, paired.total / paired.count * 1e6, paired.max * 1e6))
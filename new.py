@@ -9,12 +9,10 @@
 # THE IMPLIED WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, AND NON-INFRINGEMENT.
 
 import os
-import sys
 import time
 import logging
 import json
 import random
-import threading
 
 from enum import Enum
 from agt import AlexaGadget
@@ -22,45 +20,96 @@ from agt import AlexaGadget
 
 from ev3dev2.led import Leds
 from ev3dev2.sound import Sound
-from ev3dev2.motor import OUTPUT_A, SpeedPercent, MediumMotor, OUTPUT_B, OUTPUT_C, MoveTank, LargeMotor
+from ev3dev2.motor import OUTPUT_A, SpeedPercent, MediumMotor, OUTPUT_B, OUTPUT_C, LargeMotor
 from ev3dev2.sensor.lego import InfraredSensor
 from ev3dev2.sensor.lego import TouchSensor
-from ev3dev2.display import Display
+
+from sensors import SensorSampler, TouchService
+from scheduler import ModeScheduler
+from audio import AudioEngine
+from assetpack import AssetPack
+from control import HeelController, ProximityFilter
+import beats
+from dance import DanceEngine
+from eyes import EyeAnimator, EyeFrames, screen_geometry
+from motion import MotionPlayer, load_timelines
+from speech import SpeechCache
+from startup import Startup
+from motors import MotorFacade, MotorPair
+from sysfs import LedWriter, SensorValue
+from commands import AliasIndex, Command, CommandExecutor, Direction, PRIORITY_MOVE, PRIORITY_COMMAND
+import metrics
+from ringlog import RingHandler, log
+from recording import Recorder
 
 # Set the logging level to INFO to see messages from AlexaGadget
-logging.basicConfig(level=logging.INFO, stream=sys.stdout, format='%(message)s')
-logging.getLogger().addHandler(logging.StreamHandler(sys.stderr))
+# Records go through the ring buffer log and are written to stderr in batches by its flusher thread
+logging.basicConfig(level=logging.INFO, handlers=[RingHandler(log)])
 logger = logging.getLogger(__name__)
 
-
-class Direction(Enum):
+# Log sites hit on every loop iteration are rate limited, in records per second
+LOG_RATES = {'dance': 0.5, 'patrol': 1}
+for site, rate in LOG_RATES.items():
+    log.configure(site, rate=rate)
+
+# LED colors of the dance, one per bar alternating with black
+DANCE_COLORS = ["GREEN", "RED", "AMBER", "YELLOW"]
+
+# Metrics are off unless an address to serve them on is set, e.g. /run/puppy/metrics.sock or :9100
+METRICS_ADDRESS = os.environ.get('PUPPY_METRICS')
+# If set, a JSON snapshot of the metrics is written there every METRICS_SNAPSHOT_INTERVAL seconds
+METRICS_SNAPSHOT = os.environ.get('PUPPY_METRICS_SNAPSHOT')
+METRICS_SNAPSHOT_INTERVAL = 60
+# If set, directives and sensor input are recorded there for sim/replay.py
+RECORDING = os.environ.get('PUPPY_RECORD')
+
+# Spoken phrases, rendered at install time with python3 speech.py warm phrases.txt
+GREETING = 'Hello, my name is Beipas!'
+SPEAK_RESPONSE = 'Woof! Woof!'
+
+
+# Every directional and preset alias, normalized, resolved with one dict lookup
+ALIASES = AliasIndex(Direction, Command)
+
+# Left and right wheel speed signs of each drive direction
+STEERING = {
+    Direction.FORWARD: (1, 1),
+    Direction.BACKWARD: (-1, -1),
+    Direction.RIGHT: (-1, 1),
+    Direction.LEFT: (1, -1),
+}
+
+# The eyes' expression for a preset command, shown as soon as its directive arrives
+MOODS = {
+    Command.ANGRY: 'angry',
+    Command.CUTE: 'cute',
+    Command.COFFIN: 'dancing',
+    Command.DANCE: 'dancing',
+    Command.SIT: 'sitting',
+    Command.HEEL: 'heeling',
+    Command.STAY: 'idle',
+    Command.SENTRY: 'idle',
+}
+
+
+def _mode(task):
     """
-    The list of directional commands and their variations.
-    These variations correspond to the skill slot values.
+    A gadget state flag backed by a scheduler task: setting it wakes or parks the task.
     """
-    FORWARD = ['forward', 'forwards', 'go forward']
-    BACKWARD = ['back', 'backward', 'backwards', 'go backward']
-    LEFT = ['left', 'go left']
-    RIGHT = ['right', 'go right']
-    STOP = ['stop', 'brake']
-
+    def setter(self, value):
+        if value:
+            self.scheduler.enable(task)
+        else:
+            self.scheduler.disable(task)
+    return property(lambda self: self.scheduler.is_enabled(task), setter)
 
 
-class Command(Enum):
+def _deferred(step, name):
     """
-    The list of preset commands and their invocation variation.
-    These variations correspond to the skill slot values.
+    A gadget attribute made by a startup step on its own thread: reading it waits for the step to finish.
     """
-    SENTRY = ['guard', 'protect', 'sentry', 'sentry mode','watch', 'watch mode']
-    SIT = ['sitz', 'sit']
-    STAY = ['bleib', 'stay', 'steh auf', 'stehen bleiben']
-    HEEL = ['fuss', 'heel']
-    COME = ['come to me', 'Komm', 'come']
-    SPEAK = ['speak', 'laut']
-    ANGRY = ['angry bark','angry' ,'bark','chey chey','chase','cheey' ,'cheey cheey']
-    CUTE = ['cute','cute bark','cutie cutie','cutie pie','hello cutie','beepash my cutie','good boy beepash']
-    COFFIN = ['coughing','coffee','coffin','coffin bark','die','beepash die','die beepash']
-    DANCE=['sing','dance','dance for me']
+    return property(lambda self: self.startup.result(step)[name])
+
 
 class EventName(Enum):
     """
@@ -75,51 +124,222 @@ class MindstormsGadget(AlexaGadget):
     Two types of commands are supported, directional movement and preset.
     """
 
-    def __init__(self):
+    # Behaviour modes, each one runs as a task on the mode scheduler
+    dance = _mode('dance')
+    patrol_mode = _mode('patrol')
+    heel_mode = _mode('heel')
+    eyes = _mode('eyes')
+
+    # Devices and assets made by the startup steps, reading one waits for its step to finish
+    screen = _deferred('display', 'screen')
+    eyes_animator = _deferred('display', 'eyes_animator')
+    ir = _deferred('sensors', 'ir')
+    ts = _deferred('sensors', 'ts')
+    touch = _deferred('sensors', 'touch')
+    medium_motor = _deferred('motors', 'medium_motor')
+    left_motor = _deferred('motors', 'left_motor')
+    right_motor = _deferred('motors', 'right_motor')
+    wheels = _deferred('motors', 'wheels')
+    heel = _deferred('heel', 'heel')
+    sounds = _deferred('sounds', 'sounds')
+    audio = _deferred('sounds', 'audio')
+
+    def __init__(self, startup=None, recorder=None):
         """
-        Performs Alexa Gadget initialization routines and ev3dev resource allocation.
+        Performs Alexa Gadget initialization routines and starts the ev3dev resource allocation in the background.
+        :param startup: the Startup timing the phases, a new one if not given
+        :param recorder: a Recorder attached before any device starts, so it sees all the gadget gets
         """
-        super().__init__()
-
-        # Gadget state
-        self.heel_mode = False
-        self.patrol_mode = False
-        self.sitting = False
-
-        # Ev3dev initialization
-        self.leds = Leds()
-        self.sound = Sound()
-
+        self.startup = startup or Startup()
+        with self.startup.phase('agt'):
+            super().__init__()
+
+        with self.startup.phase('core'):
+            # All behaviours share one scheduler thread and are parked while their mode is off
+            self.scheduler = ModeScheduler()
+            self.scheduler.add('dance', lambda: self.dancer.task())
+            self.scheduler.add('patrol', self._patrol_task)
+            self.scheduler.add('heel', lambda: self.heel.task())
+            self.scheduler.add('eyes', lambda: self.eyes_animator.task())
+            self.scheduler.add('motion', lambda: self.motion.task())
+
+            # Every consumer of random numbers has its own generator, seeded from the random module here, so a
+            # seeded run repeats each one's numbers whatever order the threads draw them in
+            self.rng = {name: random.Random(random.getrandbits(64)) for name in ('move', 'patrol', 'dance', 'eyes')}
+
+            # Gadget state
+            self.heel_mode = False
+            self.patrol_mode = False
+            self.sitting = False
+            self.echo_connected = False
+            self.dance = False
+            self.bpm = 0
+            self.trigger_bpm = "off"
+            # Number of songs started, the last one ends the dance
+            self._songs = 0
+
+            # Ev3dev initialization
+            self.leds = LedWriter(Leds())
+            self.sound = Sound()
+            # Phrases espeak rendered once play from their WAV files
+            self.speech = SpeechCache()
+            # Every behaviour reads the sensors through the sampler's ring buffers, filled once the sensors are found
+            self.samples = SensorSampler()
+
+            # Dance steps land on the beats of the song's tempo, retuned in place by tempo directives
+            self.dancer = DanceEngine(self._dance_step, wake=lambda: self.scheduler.wake('dance'))
+            self._dance_color = self.rng['dance'].choice(DANCE_COLORS)
+            # The motion routines are data, compiled into timelines played on the scheduler thread
+            self.motions = load_timelines('motions.json')
+            self.motion = MotionPlayer({
+                'wheels': lambda left, right, time_sp: self.wheels.run_timed(left, right, time_sp),
+                'medium': self._lift,
+            })
+            self.scheduler.start()
+
+            # Preset command handlers
+            self.presets = {
+                Command.COME: self._come,
+                Command.HEEL: self._heel,
+                Command.SIT: self._sit,
+                Command.SENTRY: self._sentry,
+                Command.STAY: self._stay,
+                Command.ANGRY: self._angrybark,
+                Command.CUTE: self._cutebark,
+                Command.COFFIN: self._coffin,
+                Command.DANCE: self._dance,
+                Command.SPEAK: self._speak,
+            }
+
+            # Directives are executed off the AlexaGadget callback thread
+            self.commands = CommandExecutor()
+            self.commands.start()
+
+            self._instrument(metrics.registry)
+            if recorder is not None:
+                recorder.attach(self)
+
+        # Pairing needs none of the devices. Finding them, loading the display and the sounds run concurrently
+        # while agt connects
+        self.startup.background('display', self._init_display).then(self._show_eyes)
+        self.startup.background('sensors', self._init_sensors)
+        self.startup.background('motors', self._init_motors)
+        self.startup.background('heel', self._init_heel)
+        self.startup.background('sounds', self._init_sounds)
+        self.startup.background('greeting', self._say, GREETING)
+        self.startup.background('instrument', self._instrument_devices, metrics.registry)
+
+    def _init_display(self):
+        # The ev3dev2 display module imports PIL, only load it here
+        from ev3dev2.display import Display
+        screen = Display()
+        # The eye poses are rasterized once for the screen's geometry and pixel format and blitted straight into
+        # the framebuffer
+        eye_frames = EyeFrames.open_or_build('eyes.frames', *screen_geometry(screen))
+        eyes_animator = EyeAnimator(screen, eye_frames, mood=self._mood(), wake=lambda: self.scheduler.wake('eyes'),
+                                    rng=self.rng['eyes'])
+        return {'screen': screen, 'eye_frames': eye_frames, 'eyes_animator': eyes_animator}
+
+    def _show_eyes(self, display):
+        # The mood may have changed while the animator was made
+        display['eyes_animator'].express(self._mood())
+        self.eyes = True
+
+    def _init_sensors(self):
         # Connect infrared and touch sensors.
-        self.ir = InfraredSensor()
-        self.ts = TouchSensor()
-        # Init display
-        self.screen = Display()
-        self.dance=False
-        self.sound = Sound()
-        self.drive = MoveTank(OUTPUT_B, OUTPUT_C)
-        self.sound.speak('Hello, my name is Beipas!')
-
-
-
+        ir = InfraredSensor()
+        ts = TouchSensor()
+        self.samples.add('proximity', SensorValue(ir, 'IR-PROX').read, rate=10)
+        touch = TouchService(self.samples, on_press=self._on_touch_pressed, on_release=self._on_touch_released)
+        self.samples.add('is_pressed', SensorValue(ts, 'TOUCH').read, rate=50, on_sample=touch.poll)
+        self.scheduler.add('sampler', self.samples.task, enabled=True)
+        return {'ir': ir, 'ts': ts, 'touch': touch}
+
+    def _init_motors(self):
         # Connect medium motor on output port A:
-        self.medium_motor = MediumMotor(OUTPUT_A)
+        medium_motor = MotorFacade(MediumMotor(OUTPUT_A))
         # Connect two large motors on output ports B and C:
-        self.left_motor = LargeMotor(OUTPUT_B)
-        self.right_motor = LargeMotor(OUTPUT_C)
-
-
-        # Gadget states
-        self.bpm = 0
-        self.trigger_bpm = "off"
-        self.eyes=True
-
-        # Start threads
-        threading.Thread(target=self._dance_thread, daemon=True).start()
-        threading.Thread(target=self._patrol_thread, daemon=True).start()
-        threading.Thread(target=self._heel_thread, daemon=True).start()
-        threading.Thread(target=self._touchsensor_thread, daemon=True).start()
-        threading.Thread(target=self._eyes_thread, daemon=True).start()
+        left_motor = MotorFacade(LargeMotor(OUTPUT_B))
+        right_motor = MotorFacade(LargeMotor(OUTPUT_C))
+        # Both wheels start together through the pair
+        wheels = MotorPair(left_motor, right_motor)
+        return {'medium_motor': medium_motor, 'left_motor': left_motor, 'right_motor': right_motor,
+                'wheels': wheels}
+
+    def _init_heel(self):
+        # Heel mode follows at a set IR proximity with a proportional wheel speed on filtered readings. It needs the
+        # wheels and the proximity channel the sensors step adds
+        self.startup.result('sensors')
+        return {'heel': HeelController(self.samples, self.wheels, filter=ProximityFilter())}
+
+    def _init_sounds(self):
+        # Stream the bark and music clips from the compressed asset pack through one output stream
+        sounds = AssetPack.open_or_build('sounds.pack', ['angry_bark.wav', 'cute_bark.wav', 'coffin_dance.wav'])
+        audio = AudioEngine(framerate=sounds.framerate, channels=1)
+        for clip in sounds.clips.values():
+            audio.add(clip)
+        return {'sounds': sounds, 'audio': audio}
+
+    def _say(self, text):
+        """
+        Speaks a phrase, from the speech cache through the audio engine. Without espeak, Sound.speak says it.
+        """
+        path = self.speech.get(text)
+        if path is None:
+            self.sound.speak(text)
+            return
+        name = os.path.basename(path)
+        if name not in self.audio.clips:
+            self.audio.load(path, name)
+        self.audio.play(name, duck=True)
+
+    def _instrument(self, registry):
+        """
+        Registers the gadget's metrics. Does nothing if the registry is disabled.
+        """
+        self._directives = {control_type: registry.counter(
+            'gadget_directives_total', 'Control directives received', type=control_type)
+            for control_type in ('move', 'command', 'invalid')}
+        self._directive_seconds = registry.histogram(
+            'gadget_directive_seconds', 'Time spent in the control directive callback')
+        registry.attach(self.commands.wait_time, 'gadget_command_wait_seconds', 'Time commands spent queued')
+        registry.attach(self.commands.exec_time, 'gadget_command_exec_seconds', 'Time commands spent running')
+        registry.attach(self.motion.lateness, 'gadget_motion_lateness_seconds',
+                        'Motion timeline event lateness after its deadline')
+        registry.attach(self.dancer.phase_error, 'gadget_dance_phase_error_seconds', 'Dance step lateness after the beat')
+        registry.collect('gadget_command_queue_depth', 'Commands waiting to run', lambda: self.commands.depth)
+        registry.collect('gadget_commands_dropped_total', 'Commands dropped from a full queue',
+                         lambda: self.commands.dropped, type='counter')
+        registry.collect('gadget_sensor_reads_total', 'Sensor reads by channel',
+                         lambda: {name: channel['reads'] for name, channel in self.samples.stats().items()},
+                         type='counter', label='channel')
+        registry.collect('gadget_sensor_reads_per_second', 'Sensor poll rate by channel',
+                         lambda: {name: channel['reads_per_second'] for name, channel in self.samples.stats().items()},
+                         label='channel')
+        registry.collect('gadget_speech_lookups_total', 'Speech cache lookups by result',
+                         lambda: {'hit': self.speech.hits, 'miss': self.speech.misses}, type='counter', label='result')
+        registry.collect('gadget_speech_seconds_saved_total', 'espeak render time saved by speech cache hits',
+                         lambda: self.speech.saved, type='counter')
+        registry.collect('gadget_led_writes_total', 'LED brightness writes', lambda: self.leds.writes, type='counter')
+        registry.collect('gadget_scheduler_cpu_load', 'Share of a core used by the scheduler thread',
+                         lambda: self.scheduler.stats()['cpu_load'])
+        registry.collect('gadget_thread_cpu_seconds_total', 'CPU time by thread', metrics.thread_cpu_seconds,
+                         type='counter', label='thread')
+
+    def _instrument_devices(self, registry):
+        """
+        Registers the metrics of the motors and the audio engine once their startup steps are done.
+        """
+        registry.attach(self.heel.loop_period, 'gadget_heel_loop_period_seconds', 'Heel control loop period')
+        registry.attach(self.wheels.skew, 'gadget_wheel_skew_seconds', 'Time between the starts of the two wheels')
+        motors = (('left', self.left_motor), ('right', self.right_motor), ('medium', self.medium_motor))
+        registry.collect('gadget_motor_writes_total', 'Motor sysfs attribute writes',
+                         lambda: {name: motor.writes for name, motor in motors}, type='counter', label='motor')
+        registry.collect('gadget_motor_writes_suppressed_total', 'Motor sysfs attribute writes skipped',
+                         lambda: {name: motor.writes_suppressed for name, motor in motors}, type='counter',
+                         label='motor')
+        registry.attach(self.audio.latency, 'gadget_audio_trigger_seconds', 'Audio trigger to first sample latency')
+        registry.collect('gadget_audio_plays_total', 'Clips played', lambda: self.audio.plays, type='counter')
 
     def on_connected(self, device_addr):
         """
@@ -128,7 +348,12 @@ class MindstormsGadget(AlexaGadget):
         """
         self.leds.set_color("LEFT", "GREEN")
         self.leds.set_color("RIGHT", "GREEN")
+        self.echo_connected = True
+        self._update_mood()
         logger.info("{} connected to Echo device".format(self.friendly_name))
+        if 'connected' not in self.startup.marks:
+            self.startup.mark('connected')
+            logger.info(self.startup.report())
 
     def on_disconnected(self, device_addr):
         """
@@ -137,6 +362,8 @@ class MindstormsGadget(AlexaGadget):
         """
         self.leds.set_color("LEFT", "BLACK")
         self.leds.set_color("RIGHT", "BLACK")
+        self.echo_connected = False
+        self._update_mood()
         logger.info("{} disconnected from Echo device".format(self.friendly_name))
 
     def on_custom_mindstorms_gadget_control(self, directive):
@@ -144,60 +371,74 @@ class MindstormsGadget(AlexaGadget):
         Handles the Custom.Mindstorms.Gadget control directive.
         :param directive: the custom directive with the matching namespace and name
         """
+        start = time.perf_counter()
         try:
             payload = json.loads(directive.payload.decode("utf-8"))
-            print("Control payload: {}".format(payload), file=sys.stderr)
+            log.log('directive', "Control payload: {}", payload)
             control_type = payload["type"]
+            self._directives.get(control_type, self._directives['invalid']).inc()
             if control_type == "move":
                 
-                speed = random.randint(3, 4) * 25
+                speed = self.rng['move'].randint(3, 4) * 25
                 # Expected params: [direction, duration, speed]
-                self._move(payload["direction"], int(payload["duration"]), speed)
+                if ALIASES.lookup(payload["direction"]) is Direction.STOP:
+                    # Stop skips the queue and drops everything still pending
+                    self.commands.preempt(self._move, payload["direction"], 0, speed)
+                else:
+                    self.commands.submit(self._move, payload["direction"], int(payload["duration"]), speed,
+                                         priority=PRIORITY_MOVE, label="move")
 
             if control_type == "command":
+                # The eyes change with the directive, before the command waits its turn in the queue
+                mood = MOODS.get(ALIASES.lookup(payload["command"]))
+                if mood is not None:
+                    self._express(mood)
                 # Expected params: [command]
-                self._activate(payload["command"])
+                self.commands.submit(self._activate, payload["command"], priority=PRIORITY_COMMAND,
+                                     label="command")
 
         except KeyError:
-            print("Missing expected parameters: {}".format(directive), file=sys.stderr)
+            self._directives['invalid'].inc()
+            log.log('directive', "Missing expected parameters: {}", directive, level=logging.WARNING)
+        self._directive_seconds.observe(time.perf_counter() - start)
 
-    def _dance_thread(self):
+    def on_alexa_gadget_musicdata_tempo(self, directive):
         """
-        Perform motor movement in sync with the beat per minute value from tempo data.
-        :param bpm: beat per minute from AGT
+        Provides the music tempo of the song currently playing on the Echo device.
+        Only retunes the dance engine, the dance itself runs on the mode scheduler.
+        :param directive: the music data directive containing the beat per minute value
         """
-        bpm = 100
-        color_list = ["GREEN", "RED", "AMBER", "YELLOW"]
-        led_color = random.choice(color_list)
-        motor_speed = 400
-        milli_per_beat = min(1000, (round(60000 / bpm)) * 0.65)
-        print("Adjusted milli_per_beat: {}".format(milli_per_beat))
-        while True:
-            while self.dance == True:
-                print("Dancing")
-                # Alternate led color and motor direction
-                led_color = "BLACK" if led_color != "BLACK" else random.choice(color_list)
-                motor_speed = -motor_speed
-
-                self.leds.set_color("LEFT", led_color)
-                self.leds.set_color("RIGHT", led_color)
-
-                self.right_motor.run_timed(speed_sp=motor_speed, time_sp=150)
-                self.left_motor.run_timed(speed_sp=-motor_speed, time_sp=150)
-                time.sleep(milli_per_beat / 1000)
-
-                self.left_motor.run_timed(speed_sp=-motor_speed, time_sp=150)
-                self.right_motor.run_timed(speed_sp=motor_speed, time_sp=150)
-                time.sleep(milli_per_beat / 1000)
-
-                self.right_motor.run_timed(speed_sp=350, time_sp=300)
-                self.left_motor.run_timed(speed_sp=-350, time_sp=300)
-                time.sleep(milli_per_beat / 1000)
-
-                self.right_motor.run_timed(speed_sp=motor_speed, time_sp=150)
-                self.left_motor.run_timed(speed_sp=-motor_speed, time_sp=150)
-                time.sleep(milli_per_beat / 1000)
+        received_at = time.monotonic()
+        for tempo in directive.payload.tempoData:
+            log.log('tempo', "tempo value: {}", tempo.value)
+            if tempo.value > 0:
+                start = received_at + getattr(tempo, 'startOffsetInMilliSeconds', 0) / 1000.0
+                self.dancer.set_tempo(tempo.value, start)
+                self.bpm = tempo.value
+                self.trigger_bpm = "on"
+                self.dance = True
+            elif tempo.value == 0:
+                # stops the dance
+                self.trigger_bpm = "off"
+                self.dance = False
+                self.leds.set_color("LEFT", "BLACK")
+                self.leds.set_color("RIGHT", "BLACK")
+            self._update_mood()
+
+    def _dance_step(self, beat):
+        """
+        Performs one beat of the dance, called by the dance engine on the beat.
+        The moves are the 'dance' timeline, which turns the other way every four beats.
+        :param beat: the beat number
+        """
+        if beat % 4 == 0:
+            log.log('dance', "Dancing at {} bpm", self.dancer.bpm)
+            # Alternate led color every bar
+            self._dance_color = "BLACK" if self._dance_color != "BLACK" else self.rng['dance'].choice(DANCE_COLORS)
+            self.leds.set_color("LEFT", self._dance_color)
+            self.leds.set_color("RIGHT", self._dance_color)
 
+        self.motion.cue(self.motions['dance'], beat)
 
     def _move(self, direction, duration: int, speed=70, is_blocking=False):
         """
@@ -208,81 +449,84 @@ class MindstormsGadget(AlexaGadget):
         :param speed: the speed percentage as an integer
         :param is_blocking: if set, motor run until duration expired before accepting another command
         """
-        print("Move command: ({}, {}, {}, {})".format(direction, speed, duration, is_blocking), file=sys.stderr)
-        if direction in Direction.FORWARD.value:
-            self.drive.on_for_seconds(SpeedPercent(speed), SpeedPercent(speed), duration, block=is_blocking)
-
-        if direction in Direction.BACKWARD.value:
-            self.drive.on_for_seconds(SpeedPercent(-speed), SpeedPercent(-speed), duration, block=is_blocking)
-
-        if direction in (Direction.RIGHT.value):
-            
-            self.drive.on_for_seconds(SpeedPercent(-speed), SpeedPercent(speed), duration, block=is_blocking)
-
-        if direction in (Direction.LEFT.value):
-            
-            self.drive.on_for_seconds(SpeedPercent(speed), SpeedPercent(-speed), duration, block=is_blocking)
-
-        if direction in Direction.STOP.value:
-            self.drive.off()
+        log.log('move', "Move command: ({}, {}, {}, {})", direction, speed, duration, is_blocking)
+        direction = ALIASES.lookup(direction)
+        if direction is Direction.STOP:
+            # Interrupt the motion timeline playing before it issues another step
+            self.scheduler.disable('motion')
+            # Stop preempts on the agt callback thread: devices still being found have nothing to stop, their
+            # steps are not waited for
+            if self.startup.steps['motors'].succeeded():
+                self.wheels.stop(stop_action='brake')
+            if self.startup.steps['sounds'].succeeded():
+                self.audio.stop()
             self.patrol_mode = False
             self.dance=False
+            self._update_mood()
+            return
+
+        steering = STEERING.get(direction)
+        if steering is not None:
+            left, right = steering
+            # Same setpoints as MoveTank.on_for_seconds, through the motor facades
+            self.wheels.run_timed(self.left_motor.speed(left * speed), self.right_motor.speed(right * speed),
+                                  duration * 1000, stop_action='brake')
+            if is_blocking:
+                # A stop directive cancels the wait
+                self.commands.cancel.wait(duration)
 
     def _activate(self, command):
         """
         Handles preset commands.
         :param command: the preset command
         """
-        print("Activate command: ({}".format(command))
-        if command in Command.COME.value:
-            #call _come method
-            self.right_motor.run_timed(speed_sp=750, time_sp=2500)
-            self.left_motor.run_timed(speed_sp=750, time_sp=2500)
+        log.log('command', "Activate command: ({}", command)
+        handler = self.presets.get(ALIASES.lookup(command))
+        if handler is not None:
+            handler()
 
-        if command in Command.HEEL.value:
-            #call _hell method
-            self.heel_mode = True
+    def _play(self, name):
+        """
+        Plays a motion timeline on the scheduler thread, interrupting the one playing.
+        :return: an event that is set once the timeline is over
+        """
+        done = self.motion.play(self.motions[name])
+        self.scheduler.disable('motion')
+        self.scheduler.enable('motion')
+        return done
 
-        if command in Command.SIT.value:
-            # call _sit method
-            self.heel_mode = False
-            
-            self.trigger_bpm == "on"
-            self._sitdown()
+    def _come(self):
+        self._play('come')
 
-        if command in Command.SENTRY.value:
-            # call _stay method
-            
-            self.trigger_bpm == "on"
-            self.heel_mode = False
-            self._standup()
+    def _heel(self):
+        self.heel_mode = True
 
-        if command in Command.STAY.value:
-            # call _stay method
-            self.heel_mode = False
-            self._standup()
-        
-        
-        if command in Command.ANGRY.value:
-            # call _stay method
-            self._angrybark()
-            
-        if command in Command.CUTE.value:
-            # call _stay method
-            self._cutebark()
-            
-        if command in Command.COFFIN.value:
-            # call _stay method
-            self.dance = True
-            self.trigger_bpm = "on"
-            self._coffinbark()
-            self.dance= False
-
-        if command in Command.DANCE.value:
-            # call _stay method
-            self.trigger_bpm = "on"
-            self.dance = True
-            print(self.dance)
+    def _sit(self):
+        self.heel_mode = False
+        self.sitting = True
+        self._sitdown()
+
+    def _sentry(self):
+        self.heel_mode = False
+        self.sitting = False
+        self._standup()
+
+    def _stay(self):
+        self.heel_mode = False
+        self.sitting = False
+        self._standup()
+
+    def _coffin(self):
+        self.dance = True
+        self.trigger_bpm = "on"
+        self._coffinbark()
+
+    def _dance(self):
+        self.trigger_bpm = "on"
+        self.dance = True
+
+    def _speak(self):
+        self._say(SPEAK_RESPONSE)
 
     def _turn(self, direction, speed):
         """
@@ -291,34 +535,32 @@ class MindstormsGadget(AlexaGadget):
         :param direction: the turn direction
         :param speed: the turn speed
         """
-        if direction in Direction.LEFT.value:
+        direction = ALIASES.lookup(direction)
+        if direction is Direction.LEFT:
             #self.drive.on_for_seconds(SpeedPercent(0), SpeedPercent(speed), 2)
-            self.right_motor.run_timed(speed_sp=0, time_sp=100)
-            self.left_motor.run_timed(speed_sp=750, time_sp=100)
+            self.wheels.run_timed(750, 0, 100)
 
-        if direction in Direction.RIGHT.value:
+        elif direction is Direction.RIGHT:
             #self.drive.on_for_seconds(SpeedPercent(speed), SpeedPercent(0), 2)
-            self.right_motor.run_timed(speed_sp=750, time_sp=100)
-            self.left_motor.run_timed(speed_sp=0, time_sp=100)
+            self.wheels.run_timed(0, 750, 100)
 
-    def _patrol_thread(self):
+    def _patrol_task(self):
         """
-        Performs random movement when patrol mode is activated.
+        Performs random movement while patrol mode is activated.
         """
         while True:
-            while self.patrol_mode:
-                print("Patrol mode activated randomly picks a path")
-                direction = random.choice(list(Direction))
-                duration = random.randint(1, 5)
-                speed = random.randint(1, 4) * 25
+            log.log('patrol', "Patrol mode activated randomly picks a path")
+            rng = self.rng['patrol']
+            direction = rng.choice(list(Direction))
+            duration = rng.randint(1, 5)
+            speed = rng.randint(1, 4) * 25
 
-                while direction == Direction.STOP:
-                    direction = random.choice(list(Direction))
+            while direction == Direction.STOP:
+                direction = rng.choice(list(Direction))
 
-                # direction: all except stop, duration: 1-5s, speed: 25, 50, 75, 100
-                self._move(direction.value[0], duration, speed)
-                time.sleep(duration)
-            time.sleep(1)
+            # direction: all except stop, duration: 1-5s, speed: 25, 50, 75, 100
+            self._move(direction.value[0], duration, speed)
+            yield duration
 
     
     def _send_event(self, name: EventName, payload):
@@ -329,147 +571,110 @@ class MindstormsGadget(AlexaGadget):
         """
         self.send_custom_event('Custom.Mindstorms.Gadget', name.value, payload)
 
-    def _heel_thread(self):
+    def _on_touch_pressed(self):
         """
-        Monitors the distance between the puppy and an obstacle when heel command called.
-        If the maximum distance is breached, decrease the distance by following an obstancle
+        Toggles between sitting and standing when the touch sensor is pressed.
         """
-        while True:
-            while self.heel_mode:
-                distance = self.ir.proximity
-                print("Proximity distance: {}".format(distance))
-                # keep distance and make step back from the object
-                if distance < 35:  
-                    threading.Thread(target=self.__movebackwards).start()
-                    # self._send_event(EventName.BARK, {'distance': distance})
-                    # follow the object
-                if distance > 50:
-                    threading.Thread(target=self.__moveforwards).start()
-                    # otherwise stay still
-                else: 
-                    threading.Thread(target=self.__stay).start()
-                time.sleep(0.2)
-            time.sleep(1)
-
-    def _touchsensor_thread(self):
-        print("Touch sensor activated")
-        while True:
-            if self.ts.is_pressed:
-                self.leds.set_color("LEFT", "RED")
-                self.leds.set_color("RIGHT", "RED")
-                if (self.sitting):
-                    threading.Thread(target=self._standup).start()
-                    self.sitting = False
-                else:
-                    threading.Thread(target=self._sitdown).start()
-                    self.sitting = True
-            else:
-                self.leds.set_color("LEFT", "GREEN")
-                self.leds.set_color("RIGHT", "GREEN")
+        self.leds.set_color("LEFT", "RED")
+        self.leds.set_color("RIGHT", "RED")
+        if (self.sitting):
+            self._standup()
+            self.sitting = False
+        else:
+            self._sitdown()
+            self.sitting = True
+        self._update_mood()
+
+    def _on_touch_released(self):
+        self.leds.set_color("LEFT", "GREEN")
+        self.leds.set_color("RIGHT", "GREEN")
     
-    def _eyes_thread(self):
-        print("Drawing Eyes")
-        while True:
-            while self.eyes:
-                self._draweyes()
+    def _lift(self, speed, rotations):
+        """
+        Turns the lift of the medium motor, without waiting for it.
+        :return: the seconds the lift turns for
+        """
+        self.medium_motor.on_for_rotations(SpeedPercent(speed), rotations, block=False)
+        degrees_per_second = abs(self.medium_motor.speed(speed))
+        return abs(rotations) * 360.0 / degrees_per_second if degrees_per_second else 0.0
 
     def _sitdown(self):
-        self.medium_motor.on_for_rotations(SpeedPercent(20), 0.5)
+        self._play('sitdown')
 
     def _standup(self):
-        # run the wheels backwards to help the puppy to stand up.
-        threading.Thread(target=self.__back).start()
-        self.medium_motor.on_for_rotations(SpeedPercent(50), -0.5)
-
-    def __back(self):
-        self.right_motor.run_timed(speed_sp=-350, time_sp=1000)
-        self.left_motor.run_timed(speed_sp=-350, time_sp=1000)
-
-    def __movebackwards(self):
-        self.right_motor.run_timed(speed_sp=-750, time_sp=2500)
-        self.left_motor.run_timed(speed_sp=-750, time_sp=2500)
-
-    def __moveforwards(self):
-        self.right_motor.run_timed(speed_sp=750, time_sp=2500)
-        self.left_motor.run_timed(speed_sp=750, time_sp=2500)
-
-    def __stay(self):
-        self.right_motor.run_timed(speed_sp=0, time_sp=1000)
-        self.left_motor.run_timed(speed_sp=0, time_sp=1000)
+        # The wheels run backwards to help the puppy to stand up
+        self._play('standup')
 
 
     
     def _angrybark(self):
-        self.sound.play_file('angry_bark.wav')
+        self.audio.play('angry_bark', duck=True, on_done=self._update_mood)
 
     def _cutebark(self):
-        self.sound.play_file('cute_bark.wav')
+        self.audio.play('cute_bark', duck=True, on_done=self._update_mood)
 
     def _coffinbark(self):
-        self.sound.play_file('coffin_dance.wav')
-
-
-    def _draweyes(self):
-        close = True
-
-        while True:
-            self.screen.clear()
-            # if close:
-            #     self.screen.draw.line(50,65,90, 100, width=5)
-            #     self.screen.draw.line(50,105,90, 105, width=5)
-
-            #     self.screen.draw.line(120,100,160,65, width=5)
-            #     self.screen.draw.line(120,105,160,105, width=5)
-
-            #     time.sleep(10)
-            # else:
-            #     self.screen.draw.rectangle(50,45,90, 125, radius=10, fill_color='white')
-            #     self.screen.draw.rectangle(120,45,160,125, radius=10, fill_color='white')
-
-            #     self.screen.draw.rectangle(65,65,80, 105, radius=7, fill_color='black')
-            #     self.screen.draw.rectangle(130,65,145,105, radius=7, fill_color='black')
-                
-
-            ## alt
-                # self.screen.draw.line(50,105,90, 105, width=5).rotate(135)
-                # self.screen.draw.line(50,105,90, 105, width=5)
-
-                # self.screen.draw.line(50,105,90, 105, width=5).rotate(45)
-                # self.screen.draw.line(50,105,90, 105, width=5)
-            if close:
-                # self.screen.draw.ellipse(( 5, 30,  75, 50),fill='white')
-                # self.screen.draw.ellipse((103, 30, 173, 50), fill='white')
-                self.screen.draw.rectangle(( 5, 60,  75, 50), fill='black')
-                self.screen.draw.rectangle((103, 60, 173, 50), fill='black')
-                
-                # self.screen.draw.rectangle(( 5, 30,  75, 50), fill='black')
-                # self.screen.draw.rectangle((103, 30, 173, 50), fill='black')
-                time.sleep(10)
-            else:
-                # self.screen.draw.ellipse(( 5, 30,  75, 100))
-                # self.screen.draw.ellipse((103, 30, 173, 100))
-                # self.screen.draw.ellipse(( 35, 30,  105, 30),fill='black')
-                # self.screen.draw.ellipse((133, 30, 203, 30), fill='black')
-                self.screen.draw.rectangle(( 5, 10,  75, 100), fill='black')
-                self.screen.draw.rectangle((103, 10, 173, 100), fill='black')
-
-            close = not close  # toggle between True and False
+        # Stop dancing once this song is over, not when a song played before it ends or is cut off
+        started = time.monotonic()
+        self._songs += 1
+        song = self._songs
+        self.audio.play('coffin_dance', on_done=lambda: self._stop_dancing(song))
+        # Dance on the song's own beats, from the index built next to the WAV with beats.py
+        index = beats.load_for('coffin_dance.wav')
+        if index is not None and index.beats:
+            self.dancer.set_beats(index.beats, index.bpm, started)
+
+    def _stop_dancing(self, song):
+        if song != self._songs:
+            return
+        self.dance = False
+        self._update_mood()
+
+    def _mood(self):
+        """
+        Returns the mood the eyes show for the gadget's state, when no bark is playing.
+        """
+        if not self.echo_connected:
+            return 'disconnected'
+        if self.dance:
+            return 'dancing'
+        if self.heel_mode:
+            return 'heeling'
+        if self.sitting:
+            return 'sitting'
+        return 'idle'
 
-            # Update screen display
-            # Applies pending changes to the screen.
-            # Nothing will be drawn on the screen screen
-            # until this function is called.
-            self.screen.update() 
-            time.sleep(1)
+    def _update_mood(self):
+        self._express(self._mood())
 
+    def _express(self, mood):
+        # Until the display is up there are no eyes, they start with the mood of the gadget's state
+        if self.startup.steps['display'].succeeded():
+            self.eyes_animator.express(mood)
 
 
 if __name__ == '__main__':
 
-    gadget = MindstormsGadget()
+    startup = Startup()
+    log.start()
+    log.install_crash_dump()
+    metrics.registry.enabled = bool(METRICS_ADDRESS or METRICS_SNAPSHOT)
+    if metrics.registry.enabled:
+        # The per thread CPU time needs the threads' kernel ids, recorded as they start on older Pythons
+        metrics.install()
+    # The recording starts with the gadget, the sensors are sampled from the startup steps on
+    recorder = Recorder(RECORDING) if RECORDING else None
+    gadget = MindstormsGadget(startup, recorder)
+    server = None
+    with startup.phase('metrics'):
+        if METRICS_ADDRESS:
+            server = metrics.MetricsServer(metrics.registry, metrics.parse_address(METRICS_ADDRESS)).start()
+        if METRICS_SNAPSHOT:
+            gadget.scheduler.add('metrics', lambda: metrics.registry.snapshot_task(
+                METRICS_SNAPSHOT, METRICS_SNAPSHOT_INTERVAL), enabled=True)
 
     # Set LCD font and turn off blinking LEDs
-    os.system('setfont Lat7-Terminus12x6')
+    startup.background('setfont', os.system, 'setfont Lat7-Terminus12x6')
     gadget.leds.set_color("LEFT", "BLACK")
     gadget.leds.set_color("RIGHT", "BLACK")
 
@@ -485,10 +690,36 @@ if __name__ == '__main__':
     gadget.leds.set_color("LEFT", "GREEN")
     gadget.leds.set_color("RIGHT", "GREEN")
 
+    startup.mark('connectable')
+    logger.info(startup.report())
     # Gadget main entry point
     gadget.main()
 
     # Shutdown sequence
+    logger.info("Touch sensor stats: {}".format(gadget.touch.stats()))
+    logger.info("Sensor sampler stats: {}".format(gadget.samples.stats()))
+    logger.info("Scheduler stats: {}".format(gadget.scheduler.stats()))
+    logger.info("Command stats: {}".format(gadget.commands.stats()))
+    logger.info("Motor stats: {}".format({name: motor.stats() for name, motor in (
+        ('left', gadget.left_motor), ('right', gadget.right_motor), ('medium', gadget.medium_motor))}))
+    logger.info("Wheel pair stats: {}".format(gadget.wheels.stats()))
+    logger.info("Heel controller stats: {}".format(gadget.heel.stats()))
+    logger.info("Dance stats: {}".format(gadget.dancer.stats()))
+    logger.info("Motion stats: {}".format(gadget.motion.stats()))
+    logger.info("Eyes stats: {}".format(gadget.eyes_animator.stats()))
+    logger.info("Audio stats: {}".format(gadget.audio.stats()))
+    logger.info("Sound cache stats: {}".format(gadget.sounds.cache.stats()))
+    logger.info("Speech cache stats: {}".format(gadget.speech.stats()))
+    logger.info("Log stats: {}".format(log.stats()))
+    logger.info("Startup stats: {}".format(startup.stats()))
+    if recorder is not None:
+        logger.info("Recorded {} records to {}".format(recorder.records, RECORDING))
+        recorder.close()
+    if server is not None:
+        server.stop()
+    if METRICS_SNAPSHOT:
+        metrics.registry.write_snapshot(METRICS_SNAPSHOT)
     gadget.sound.play_song((('E5', 'e'), ('C4', 'e')))
     gadget.leds.set_color("LEFT", "BLACK")
     gadget.leds.set_color("RIGHT", "BLACK")
+    log.stop()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+16 bit PCM sample math for the Mindstorms puppy gadget, for Pythons without audioop.
+
+audioop was removed from the standard library in Python 3.13. This module has
+the same signatures for the few audioop functions the gadget uses, so a module
+falls back to it with::
+
+    try:
+        import audioop
+    except ImportError:
+        import pcm as audioop
+
+The sample math is done with NumPy where it is installed, otherwise with the
+array module. Only 16 bit samples in the machine's byte order are supported.
+"""
+
+import array
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_MIN = -32768
+_MAX = 32767
+
+
+def _check(width):
+    if width != 2:
+        raise ValueError("only 16 bit samples are supported, not {} bytes".format(width))
+
+
+def _clip(value):
+    return _MIN if value < _MIN else _MAX if value > _MAX else value
+
+
+def _samples(fragment):
+    samples = array.array('h')
+    samples.frombytes(fragment)
+    return samples
+
+
+def mul(fragment, width, factor):
+    """
+    Returns the samples multiplied by ``factor``, clipped and rounded down like audioop.mul.
+    """
+    _check(width)
+    if numpy is not None:
+        samples = numpy.frombuffer(fragment, dtype=numpy.int16) * float(factor)
+        return numpy.floor(numpy.clip(samples, _MIN, _MAX)).astype(numpy.int16).tobytes()
+    return array.array('h', (int(math.floor(_clip(sample * factor))) for sample in _samples(fragment))).tobytes()
+
+
+def add(fragment1, fragment2, width):
+    """
+    Returns the sum of two fragments of the same length, clipped.
+    """
+    _check(width)
+    if len(fragment1) != len(fragment2):
+        raise ValueError("lengths not the same")
+    if numpy is not None:
+        total = (numpy.frombuffer(fragment1, dtype=numpy.int16).astype(numpy.int32)
+                 + numpy.frombuffer(fragment2, dtype=numpy.int16))
+        return numpy.clip(total, _MIN, _MAX).astype(numpy.int16).tobytes()
+    return array.array('h', (_clip(a + b) for a, b in zip(_samples(fragment1), _samples(fragment2)))).tobytes()
+
+
+def rms(fragment, width):
+    """
+    Returns the root mean square of the samples, rounded down like audioop.rms.
+    """
+    _check(width)
+    if not len(fragment):
+        return 0
+    if numpy is not None:
+        samples = numpy.frombuffer(fragment, dtype=numpy.int16).astype(numpy.float64)
+        return int(math.sqrt(numpy.dot(samples, samples) / len(samples)))
+    samples = _samples(fragment)
+    return int(math.sqrt(sum(float(sample) * sample for sample in samples) / len(samples)))
+
+
+def tomono(fragment, width, lfactor, rfactor):
+    """
+    Mixes interleaved stereo samples down to mono.
+    """
+    _check(width)
+    if numpy is not None:
+        samples = numpy.frombuffer(fragment, dtype=numpy.int16).reshape(-1, 2)
+        mono = samples[:, 0] * float(lfactor) + samples[:, 1] * float(rfactor)
+        return numpy.floor(numpy.clip(mono, _MIN, _MAX)).astype(numpy.int16).tobytes()
+    samples = _samples(fragment)
+    return array.array('h', (int(math.floor(_clip(left * lfactor + right * rfactor)))
+                             for left, right in zip(samples[0::2], samples[1::2]))).tobytes()
+
+
+def tostereo(fragment, width, lfactor, rfactor):
+    """
+    Turns mono samples into interleaved stereo samples.
+    """
+    _check(width)
+    if numpy is not None:
+        samples = numpy.frombuffer(fragment, dtype=numpy.int16)
+        stereo = numpy.stack((samples * float(lfactor), samples * float(rfactor)), axis=1)
+        return numpy.floor(numpy.clip(stereo, _MIN, _MAX)).astype(numpy.int16).tobytes()
+    stereo = array.array('h')
+    for sample in _samples(fragment):
+        stereo.append(int(math.floor(_clip(sample * lfactor))))
+        stereo.append(int(math.floor(_clip(sample * rfactor))))
+    return stereo.tobytes()
+
+
+def ratecv(fragment, width, nchannels, inrate, outrate, state, weightA=1, weightB=0):
+    """
+    Converts the sample rate by linear interpolation. Unlike audioop.ratecv no state is carried over,
+    the fragment must be the whole clip.
+    :return: (converted fragment, None)
+    """
+    _check(width)
+    if inrate == outrate:
+        return bytes(fragment), None
+    frames = len(fragment) // (2 * nchannels)
+    count = frames * outrate // inrate
+    if numpy is not None:
+        samples = numpy.frombuffer(fragment, dtype=numpy.int16)[:frames * nchannels].reshape(-1, nchannels)
+        positions = numpy.arange(count) * (inrate / float(outrate))
+        out = numpy.stack([numpy.interp(positions, numpy.arange(frames), samples[:, channel])
+                           for channel in range(nchannels)], axis=1)
+        return numpy.floor(out).astype(numpy.int16).tobytes(), None
+    samples = _samples(fragment[:frames * nchannels * 2])
+    out = array.array('h')
+    for index in range(count):
+        position = index * inrate / float(outrate)
+        before = int(position)
+        after = min(before + 1, frames - 1)
+        fraction = position - before
+        for channel in range(nchannels):
+            a = samples[before * nchannels + channel]
+            b = samples[after * nchannels + channel]
+            out.append(int(math.floor(a + (b - a) * fraction)))
+    return out.tobytes(), None
+
+
+# IMA ADPCM step index changes and step sizes, the tables of audioop
+_INDEX_TABLE = (-1, -1, -1, -1, 2, 4, 6, 8, -1, -1, -1, -1, 2, 4, 6, 8)
+_STEP_TABLE = (
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45, 50, 55, 60, 66, 73, 80, 88, 97,
+    107, 118, 130, 143, 157, 173, 190, 209, 230, 253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796,
+    876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327, 3660, 4026, 4428,
+    4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899, 15289, 16818, 18500, 20350,
+    22385, 24623, 27086, 29794, 32767)
+
+
+def lin2adpcm(fragment, width, state):
+    """
+    Encodes samples to IMA ADPCM, two samples per byte, bit for bit like audioop.lin2adpcm.
+    :param state: the (previous sample, step index) of the encoder, None to start afresh
+    :return: (encoded fragment, state)
+    """
+    _check(width)
+    valpred, index = state or (0, 0)
+    step = _STEP_TABLE[index]
+    out = bytearray()
+    high = None
+    for sample in _samples(fragment):
+        diff = sample - valpred
+        sign = 8 if diff < 0 else 0
+        if sign:
+            diff = -diff
+        delta = 0
+        vpdiff = step >> 3
+        if diff >= step:
+            delta = 4
+            diff -= step
+            vpdiff += step
+        step >>= 1
+        if diff >= step:
+            delta |= 2
+            diff -= step
+            vpdiff += step
+        step >>= 1
+        if diff >= step:
+            delta |= 1
+            vpdiff += step
+        valpred = _clip(valpred - vpdiff if sign else valpred + vpdiff)
+        delta |= sign
+        index = min(88, max(0, index + _INDEX_TABLE[delta]))
+        step = _STEP_TABLE[index]
+        if high is None:
+            high = delta << 4
+        else:
+            out.append(high | delta)
+            high = None
+    return bytes(out), (valpred, index)
+
+
+def adpcm2lin(fragment, width, state):
+    """
+    Decodes IMA ADPCM, bit for bit like audioop.adpcm2lin.
+    :param state: the (previous sample, step index) of the decoder, None to start afresh
+    :return: (decoded fragment, state)
+    """
+    _check(width)
+    valpred, index = state or (0, 0)
+    step = _STEP_TABLE[index]
+    out = array.array('h')
+    for byte in bytes(fragment):
+        for delta in (byte >> 4, byte & 0x0f):
+            index = min(88, max(0, index + _INDEX_TABLE[delta]))
+            vpdiff = step >> 3
+            if delta & 4:
+                vpdiff += step
+            if delta & 2:
+                vpdiff += step >> 1
+            if delta & 1:
+                vpdiff += step >> 2
+            valpred = _clip(valpred - vpdiff if delta & 8 else valpred + vpdiff)
+            step = _STEP_TABLE[index]
+            out.append(valpred)
+    return out.tobytes(), (valpred, index)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Compact binary recordings of what the Mindstorms puppy gadget saw.
+
+A Recorder attached to a MindstormsGadget appends every directive, tempo
+message, IR proximity sample and touch sensor press and release to a file, so a
+field session can be fed back into the gadget offline with sim/replay.py. Times
+count from the gadget's creation. The file is a header followed by append-only
+records::
+
+    header: magic 'PUPR', version, wall clock start time
+    record: milliseconds since start (uint32), kind (uint8), payload length (uint16), payload
+
+The payloads are:
+- a directive: namespace, name and the raw payload bytes, separated by NUL bytes
+- tempo: (value, start offset in ms) pairs
+- proximity: an int16
+- touch: one byte, 1 for pressed, recorded when the sampled state changes
+
+An IR sample at 10 Hz is 9 bytes, about 5 kB per minute.
+
+Usage::
+
+    python3 recording.py dump session.rec
+"""
+
+import json
+import struct
+import threading
+import time
+
+MAGIC = b'PUPR'
+VERSION = 2
+
+DIRECTIVE = 1
+TEMPO = 2
+PROXIMITY = 3
+TOUCH = 4
+
+KINDS = {DIRECTIVE: 'directive', TEMPO: 'tempo', PROXIMITY: 'proximity', TOUCH: 'touch'}
+
+_HEADER = struct.Struct('<4sHd')
+_RECORD = struct.Struct('<IBH')
+_PROXIMITY = struct.Struct('<h')
+_TEMPO = struct.Struct('<II')
+
+TEMPO_NAMESPACE = 'Alexa.Gadget.MusicData'
+
+
+class Recorder:
+    """
+    Appends timestamped records to a recording file. Safe to call from any thread.
+    """
+
+    def __init__(self, path, clock=time.monotonic):
+        """
+        :param path: the recording file, overwritten if it exists
+        :param clock: the monotonic clock record times are taken from
+        """
+        self.path = path
+        self.clock = clock
+        self.started_at = clock()
+        self.records = 0
+        self._pressed = False
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb')
+        self._file.write(_HEADER.pack(MAGIC, VERSION, time.time()))
+
+    def record(self, kind, payload, timestamp=None):
+        """
+        Appends one record.
+        :param timestamp: the monotonic time of the event, defaults to now
+        """
+        milliseconds = int(round(((timestamp if timestamp is not None else self.clock()) - self.started_at) * 1000))
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(_RECORD.pack(max(0, milliseconds), kind, len(payload)) + payload)
+            self.records += 1
+            # Directives are rare and the most valuable, do not lose them to a crash
+            if kind != PROXIMITY:
+                self._file.flush()
+
+    def directive(self, directive):
+        namespace, name = directive.header.namespace, directive.header.name
+        if namespace == TEMPO_NAMESPACE:
+            self.record(TEMPO, b''.join(
+                _TEMPO.pack(int(tempo.value), int(getattr(tempo, 'startOffsetInMilliSeconds', 0)))
+                for tempo in directive.payload.tempoData))
+            return
+        payload = directive.payload
+        if not isinstance(payload, bytes):
+            payload = str(payload).encode('utf-8')
+        self.record(DIRECTIVE, namespace.encode('utf-8') + b'\0' + name.encode('utf-8') + b'\0' + payload)
+
+    def proximity(self, timestamp, value):
+        self.record(PROXIMITY, _PROXIMITY.pack(int(value)), timestamp)
+
+    def touch(self, timestamp, value):
+        # Both edges of the raw state, the touch service debounces them again on replay
+        pressed = bool(value)
+        if pressed != self._pressed:
+            self._pressed = pressed
+            self.record(TOUCH, b'\1' if pressed else b'\0', timestamp)
+
+    def attach(self, gadget):
+        """
+        Records what a MindstormsGadget receives: the control and tempo directives and the sampler's
+        proximity and touch channels. Attach it before the sensors are sampled, or the presses before are lost.
+        """
+        for handler_name in ('on_custom_mindstorms_gadget_control', 'on_alexa_gadget_musicdata_tempo'):
+            handler = getattr(gadget, handler_name, None)
+            if handler is not None:
+                setattr(gadget, handler_name, self._recording(handler))
+        gadget.samples.tap('proximity', self.proximity)
+        gadget.samples.tap('is_pressed', self.touch)
+        return self
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _recording(self, handler):
+        def record_and_handle(directive):
+            self.directive(directive)
+            return handler(directive)
+        return record_and_handle
+
+
+def read(path):
+    """
+    Returns the records of a recording as (seconds since start, kind, value), where value is
+    (namespace, name, payload bytes) for a directive, a list of (value, start offset) pairs for tempo,
+    the proximity for an IR sample and True or False for a touch press or release.
+    :return: the wall clock start time and the list of records
+    """
+    with open(path, 'rb') as recording:
+        data = recording.read()
+    magic, version, started = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("{}: not a version {} recording".format(path, VERSION))
+    records = []
+    position = _HEADER.size
+    # A crash can leave a partial record at the end
+    while position + _RECORD.size <= len(data):
+        milliseconds, kind, length = _RECORD.unpack_from(data, position)
+        position += _RECORD.size
+        payload = data[position:position + length]
+        if len(payload) < length:
+            break
+        position += length
+        if kind == DIRECTIVE:
+            namespace, name, body = payload.split(b'\0', 2)
+            value = (namespace.decode('utf-8'), name.decode('utf-8'), body)
+        elif kind == TEMPO:
+            value = [_TEMPO.unpack_from(payload, offset) for offset in range(0, len(payload), _TEMPO.size)]
+        elif kind == PROXIMITY:
+            value, = _PROXIMITY.unpack(payload)
+        elif kind == TOUCH:
+            value = payload == b'\1'
+        else:
+            continue
+        records.append((milliseconds / 1000.0, kind, value))
+    return started, records
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) != 3 or sys.argv[1] != 'dump':
+        print(__doc__)
+        sys.exit(1)
+
+    started, records = read(sys.argv[2])
+    print("Recorded {} at {}".format(sys.argv[2], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started))))
+    counts = {}
+    for seconds, kind, value in records:
+        counts[kind] = counts.get(kind, 0) + 1
+        if kind == DIRECTIVE:
+            print("{:9.3f} {}.{} {}".format(seconds, value[0], value[1], value[2].decode('utf-8', 'replace')))
+        elif kind == TEMPO:
+            print("{:9.3f} tempo {}".format(seconds, json.dumps(value)))
+        elif kind == TOUCH:
+            print("{:9.3f} touch {}".format(seconds, 'pressed' if value else 'released'))
+    print(', '.join("{} {}".format(count, KINDS[kind]) for kind, count in sorted(counts.items())))
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Asynchronous ring buffer logger for the Mindstorms puppy gadget.
+
+On the EV3 stdout and stderr go to a slow console or an SD card backed
+journal, and a print in a control loop stalls the loop until it is written.
+RingLog.log only stores the message and its arguments in a preallocated ring
+of records. A background thread formats them and writes them out in one batch
+every ``interval`` seconds. Each log site can be sampled (keep one record in
+N) and rate limited. When the flusher falls behind, the oldest unwritten
+records are overwritten and counted as dropped.
+
+The last records stay in the ring after they are written. They can be dumped
+on demand, on SIGUSR1, or when a thread dies of an uncaught exception::
+
+    kill -USR1 $(pgrep -f new.py)
+"""
+
+import logging
+import signal
+import sys
+import threading
+import time
+
+
+class _SiteLimit:
+    """
+    Sampling and token bucket rate limit of one log site.
+    """
+
+    def __init__(self, every=1, rate=None, burst=None):
+        """
+        :param every: keep one record out of ``every``
+        :param rate: the maximum number of records per second, None for no limit
+        :param burst: the number of records allowed at once above the rate, defaults to one second's worth
+        """
+        self.every = every
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate or 0)
+        self._tokens = self.burst
+        self._last = None
+        self.seen = 0
+        self.sampled = 0
+        self.limited = 0
+
+    def allow(self, now):
+        self.seen += 1
+        if self.every > 1 and (self.seen - 1) % self.every:
+            self.sampled += 1
+            return False
+        if self.rate is not None:
+            if self._last is not None:
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens < 1:
+                self.limited += 1
+                return False
+            self._tokens -= 1
+        return True
+
+
+class RingLog:
+    """
+    A fixed-size ring of log records written out by a background thread.
+    """
+
+    def __init__(self, capacity=1024, stream=None, interval=0.5):
+        """
+        :param capacity: the number of records kept
+        :param stream: the file records are written to, defaults to sys.stderr at the time of writing
+        :param interval: the time in seconds between two batch writes
+        """
+        self.capacity = capacity
+        self.stream = stream
+        self.interval = interval
+        self._records = [None] * capacity
+        # Sequence numbers of the next record and of the next record to write out
+        self._next = 0
+        self._written = 0
+        self._sites = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._running = False
+        self.dropped = 0
+        self.batches = 0
+
+    def configure(self, site, every=1, rate=None, burst=None):
+        """
+        Samples and rate limits the records of a log site, see _SiteLimit.
+        """
+        self._sites[site] = _SiteLimit(every, rate, burst)
+
+    def log(self, site, message, *args, level=logging.INFO):
+        """
+        Stores a record. The message is formatted with ``message.format(*args)`` by the flusher.
+        :param site: the name of the log site, used for sampling and rate limits
+        """
+        now = time.time()
+        limit = self._sites.get(site)
+        if limit is not None and not limit.allow(now):
+            return
+        with self._lock:
+            sequence = self._next
+            self._records[sequence % self.capacity] = (now, level, site, message, args)
+            self._next = sequence + 1
+        # Do not wait for the interval once half of the ring is unwritten
+        if sequence - self._written == self.capacity // 2:
+            self._wake.set()
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="ringlog", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the flusher after writing out every pending record.
+        """
+        if self._thread is not None:
+            self._running = False
+            self._wake.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def flush(self):
+        """
+        Writes out the pending records in one write.
+        """
+        with self._lock:
+            start, end = self._written, self._next
+            if end - start > self.capacity:
+                self.dropped += end - start - self.capacity
+                start = end - self.capacity
+            records = [self._records[sequence % self.capacity] for sequence in range(start, end)]
+            self._written = end
+        if not records:
+            return
+        stream = self.stream or sys.stderr
+        stream.write(''.join(_format(record) + '\n' for record in records))
+        stream.flush()
+        self.batches += 1
+
+    def dump(self, count=None, stream=None):
+        """
+        Writes the last records, written out or not, with their timestamps and sites.
+        :param count: the number of records, defaults to the whole ring
+        :param stream: the file to write to, defaults to sys.stderr
+        """
+        with self._lock:
+            count = min(count or self.capacity, self.capacity, self._next)
+            records = [self._records[sequence % self.capacity] for sequence in range(self._next - count, self._next)]
+        stream = stream or sys.stderr
+        stream.write(''.join('{}.{:03d} {:8s} {}\n'.format(
+            time.strftime('%H:%M:%S', time.localtime(record[0])), int(record[0] % 1 * 1000), record[2],
+            _format(record)) for record in records))
+        stream.flush()
+
+    def install_crash_dump(self, count=100):
+        """
+        Dumps the last ``count`` records when a thread dies of an uncaught exception, and on SIGUSR1.
+        """
+        excepthook = sys.excepthook
+
+        def dump_exception(*args):
+            self.dump(count)
+            excepthook(*args)
+        sys.excepthook = dump_exception
+
+        if hasattr(threading, 'excepthook'):
+            thread_excepthook = threading.excepthook
+
+            def dump_thread_exception(args):
+                self.dump(count)
+                thread_excepthook(args)
+            threading.excepthook = dump_thread_exception
+        else:
+            # threading.excepthook is new in Python 3.8, the brick runs 3.5: catch the exception in Thread.run.
+            # Thread prints the traceback itself once run raised
+            run = threading.Thread.run
+
+            def dump_run(thread):
+                try:
+                    run(thread)
+                except SystemExit:
+                    raise
+                except BaseException:
+                    self.dump(count)
+                    raise
+            threading.Thread.run = dump_run
+        if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump(count))
+
+    def stats(self):
+        """
+        Returns the records logged, dropped by the ring, and sampled out or rate limited per site.
+        """
+        return {
+            'records': self._next,
+            'dropped': self.dropped,
+            'batches': self.batches,
+            'sites': {site: {'seen': limit.seen, 'sampled': limit.sampled, 'limited': limit.limited}
+                      for site, limit in self._sites.items()},
+        }
+
+    def _run(self):
+        while self._running:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                # A broken console must not take the gadget down
+                pass
+
+
+def _format(record):
+    _, _, _, message, args = record
+    if not args:
+        return message
+    try:
+        return message.format(*args)
+    except (IndexError, KeyError, ValueError):
+        return '{} {}'.format(message, args)
+
+
+class RingHandler(logging.Handler):
+    """
+    Routes the logging module's records into a RingLog, the logger name is the site.
+    """
+
+    def __init__(self, ring, level=logging.NOTSET):
+        super().__init__(level)
+        self.ring = ring
+
+    def emit(self, record):
+        message = record.getMessage()
+        if record.exc_info:
+            message += '\n' + logging.Formatter().formatException(record.exc_info)
+        self.ring.log(record.name, message, level=record.levelno)
+
+
+# The gadget's log
+log = RingLog()
+
+
+if __name__ == '__main__':
+    # Time a loop spends logging every iteration: printing to a slow console, logging to the ring,
+    # and logging to the ring with a rate limit of 2 records per second
+    import io
+
+    class _SlowConsole(io.StringIO):
+        """
+        A console that takes a fixed time per write, like a serial console or a busy journal.
+        """
+
+        def __init__(self, delay=0.002):
+            super().__init__()
+            self.delay = delay
+            self.writes = 0
+
+        def write(self, text):
+            self.writes += 1
+            time.sleep(self.delay)
+            return super().write(text)
+
+    iterations = 2000
+    results = {}
+    for mode in ('print', 'ring', 'limited'):
+        console = _SlowConsole()
+        ring = RingLog(stream=console, interval=0.1).start()
+        if mode == 'limited':
+            ring.configure('proximity', rate=2)
+        worst = 0.0
+        start = time.perf_counter()
+        for i in range(iterations):
+            tick = time.perf_counter()
+            if mode == 'print':
+                print("Proximity distance: {}".format(i % 100), file=console)
+            else:
+                ring.log('proximity', "Proximity distance: {}", i % 100)
+            worst = max(worst, time.perf_counter() - tick)
+        elapsed = time.perf_counter() - start
+        ring.stop()
+        results[mode] = (elapsed / iterations, worst, console.writes)
+        if mode != 'print':
+            print("{} ring stats: {}".format(mode, ring.stats()))
+    for mode, (average, worst, writes) in results.items():
+        print("{:7s} {:8.1f} us avg {:8.1f} us max per log call, {} console writes".format(
+            mode, average * 1e6, worst * 1e6, writes))
+    print("Last records:")
+    ring.dump(3, sys.stdout)
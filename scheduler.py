@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Cooperative mode scheduler for the Mindstorms puppy gadget.
+
+All behaviours run as generator tasks on one thread. A task yields the number of
+seconds it wants to sleep before it is resumed. Tasks that are switched off are
+parked and cost nothing: when no task is due the thread blocks without a timeout.
+"""
+
+import heapq
+import logging
+import threading
+import time
+
+from sensors import _thread_cpu_time
+
+logger = logging.getLogger(__name__)
+
+
+class _Task:
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self.enabled = False
+        self.generator = None
+        # Set while the scheduler thread runs the generator
+        self.running = False
+        # Bumped whenever the task is (re)scheduled so stale heap entries are skipped
+        self.generation = 0
+        self.resumes = 0
+
+
+class ModeScheduler:
+    """
+    Runs behaviour tasks on a single thread and wakes them only while their mode is on.
+    """
+
+    def __init__(self):
+        self._tasks = {}
+        self._heap = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._started_at = None
+        self._cpu_at_start = 0.0
+        self._cpu_used = 0.0
+        self.wakeups = 0
+
+    def add(self, name, factory, enabled=False):
+        """
+        Registers a behaviour.
+        :param name: the task name
+        :param factory: a callable returning a generator which yields sleep durations in seconds
+        :param enabled: if set, the task is scheduled straight away
+        """
+        with self._cond:
+            self._tasks[name] = _Task(name, factory)
+        if enabled:
+            self.enable(name)
+
+    def enable(self, name):
+        """
+        Switches a task on. A parked task is restarted from the beginning.
+        """
+        with self._cond:
+            task = self._tasks[name]
+            if task.enabled:
+                return
+            task.enabled = True
+            task.generator = task.factory()
+            self._push(task, time.monotonic())
+
+    def disable(self, name):
+        """
+        Switches a task off. A parked task is closed straight away, a running one at its next yield.
+        """
+        with self._cond:
+            task = self._tasks[name]
+            if not task.enabled:
+                return
+            task.enabled = False
+            task.generation += 1
+            # A generator that is executing right now is closed by the run loop
+            parked = task.generator if not task.running else None
+            task.generator = None
+        # Its finally blocks run here, not whenever the generator is collected, and without the lock held
+        if parked is not None:
+            self._close(parked)
+
+    def wake(self, name):
+        """
+        Resumes an enabled task now instead of at the end of its current sleep.
+        """
+        with self._cond:
+            task = self._tasks[name]
+            if task.enabled:
+                self._push(task, time.monotonic())
+
+    def is_enabled(self, name):
+        return self._tasks[name].enabled
+
+    def start(self):
+        """
+        Starts the scheduler thread.
+        """
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the scheduler thread and closes all running tasks.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for name in list(self._tasks):
+            self.disable(name)
+
+    def stats(self):
+        """
+        Returns wakeup and CPU time counters of the scheduler thread.
+        """
+        elapsed = time.monotonic() - self._started_at if self._started_at is not None else 0.0
+        return {
+            'wakeups': self.wakeups,
+            'active': sorted(name for name, task in self._tasks.items() if task.enabled),
+            'resumes': {name: task.resumes for name, task in self._tasks.items()},
+            'cpu_used': self._cpu_used,
+            'cpu_load': self._cpu_used / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def _push(self, task, due):
+        task.generation += 1
+        heapq.heappush(self._heap, (due, task.generation, task.name))
+        self._cond.notify()
+
+    def _close(self, generator):
+        try:
+            generator.close()
+        except Exception:
+            logger.exception("Error while closing task")
+
+    def _next_due(self):
+        """
+        Pops the next runnable task, blocking while nothing is due.
+        Must be called with the condition held.
+        """
+        while self._running:
+            while self._heap:
+                due, generation, name = self._heap[0]
+                task = self._tasks[name]
+                if generation != task.generation or not task.enabled:
+                    heapq.heappop(self._heap)
+                    continue
+                delay = due - time.monotonic()
+                if delay <= 0:
+                    heapq.heappop(self._heap)
+                    return task
+                break
+            else:
+                delay = None
+            # Parked with nothing due: wait without a timeout
+            self._cond.wait(delay)
+            self.wakeups += 1
+        return None
+
+    def _run(self):
+        self._started_at = time.monotonic()
+        self._cpu_at_start = _thread_cpu_time()
+        while True:
+            with self._cond:
+                task = self._next_due()
+                if task is None:
+                    return
+                generator, generation = task.generator, task.generation
+                task.running = True
+
+            task.resumes += 1
+            try:
+                delay = next(generator)
+            except StopIteration:
+                delay = None
+            except Exception:
+                logger.exception("Task {} failed".format(task.name))
+                delay = None
+
+            with self._cond:
+                task.running = False
+                if task.generation == generation and task.enabled:
+                    if delay is None:
+                        task.enabled = False
+                        task.generator = None
+                    else:
+                        self._push(task, time.monotonic() + max(0.0, delay))
+                        generator = None
+            if generator is not None and generator is not task.generator:
+                self._close(generator)
+            self._cpu_used = _thread_cpu_time() - self._cpu_at_start
+
+
+if __name__ == '__main__':
+    # Measure the idle cost of the scheduler with every behaviour parked
+    import sys
+
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+
+    def _behaviour():
+        while True:
+            yield 0.2
+
+    scheduler = ModeScheduler()
+    for name in ('dance', 'patrol', 'heel', 'eyes'):
+        scheduler.add(name, _behaviour)
+    scheduler.start()
+
+    cpu_start = time.process_time()
+    time.sleep(seconds)
+    cpu_idle = time.process_time() - cpu_start
+    print("Idle for {:.1f}s: {} wakeups, process CPU {:.4f}s ({:.3%})".format(
+        seconds, scheduler.stats()['wakeups'], cpu_idle, cpu_idle / seconds))
+
+    scheduler.enable('dance')
+    cpu_start = time.process_time()
+    time.sleep(seconds)
+    cpu_active = time.process_time() - cpu_start
+    print("One 5 Hz task for {:.1f}s: {} wakeups, process CPU {:.4f}s ({:.3%})".format(
+        seconds, scheduler.stats()['wakeups'], cpu_active, cpu_active / seconds))
+    scheduler.stop()
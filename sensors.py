@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Sensor services for the Mindstorms puppy gadget.
+
+The sensors are polled at a fixed rate on a single thread instead of being
+read in tight loops by every behaviour that needs them. The readings are kept
+in ring buffers that any number of consumers can read without a sysfs round trip.
+"""
+
+import array
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# A failing channel logs its first error and then every this many
+ERROR_LOG_EVERY = 100
+
+
+def _thread_cpu_time():
+    """
+    Returns the CPU time consumed by the calling thread in seconds.
+    """
+    try:
+        return time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID)
+    except (AttributeError, OSError):
+        return time.process_time()
+
+
+class TouchService:
+    """
+    Debounces the samples of a TouchSensor and reports press/release edges.
+    Callbacks are only fired when the debounced state changes. The service has no thread of its
+    own, ``poll`` is called at ``rate`` Hz by whoever samples the sensor, normally a SensorSampler.
+    """
+
+    def __init__(self, sensor, on_press=None, on_release=None, rate=50, debounce=0.03):
+        """
+        :param sensor: an object exposing an ``is_pressed`` property, a TouchSensor or the SensorSampler sampling one
+        :param on_press: called with no arguments when the sensor becomes pressed
+        :param on_release: called with no arguments when the sensor is released
+        :param rate: the rate in Hz ``poll`` is called at
+        :param debounce: time in seconds a new state must be stable before it is reported
+        """
+        self.sensor = sensor
+        self.on_press = on_press
+        self.on_release = on_release
+        # Number of consecutive samples that must agree before an edge is accepted
+        self.stable_samples = max(1, int(round(debounce * rate)))
+
+        self.pressed = False
+        self.polls = 0
+        self.edges = 0
+
+        self._candidate = False
+        self._candidate_count = 0
+        self._started_at = None
+        self._cpu_used = 0.0
+
+    def sample(self, value):
+        """
+        Feeds one raw sample through the debouncer.
+        :param value: the raw pressed state
+        :return: True on a press edge, False on a release edge, None otherwise
+        """
+        self.polls += 1
+        if value != self._candidate:
+            self._candidate = value
+            self._candidate_count = 1
+        else:
+            self._candidate_count += 1
+
+        if self._candidate == self.pressed or self._candidate_count < self.stable_samples:
+            return None
+
+        self.pressed = self._candidate
+        self.edges += 1
+        callback = self.on_press if self.pressed else self.on_release
+        if callback is not None:
+            callback()
+        return self.pressed
+
+    def stats(self):
+        """
+        Returns the poll counters of the service.
+        ``cpu_saved`` is the CPU time not spent compared to a thread busy-polling one full core.
+        """
+        elapsed = time.monotonic() - self._started_at if self._started_at is not None else 0.0
+        return {
+            'polls': self.polls,
+            'edges': self.edges,
+            'polls_per_second': self.polls / elapsed if elapsed > 0 else 0.0,
+            'cpu_used': self._cpu_used,
+            'cpu_saved': max(0.0, elapsed - self._cpu_used),
+        }
+
+    def poll(self):
+        """
+        Reads the sensor once and feeds the sample through the debouncer.
+        """
+        cpu_start = _thread_cpu_time()
+        if self._started_at is None:
+            self._started_at = time.monotonic()
+        edge = self.sample(bool(self.sensor.is_pressed))
+        self._cpu_used += _thread_cpu_time() - cpu_start
+        return edge
+
+
+class RingBuffer:
+    """
+    Fixed-size ring buffer of timestamped samples backed by two ``array('d')``.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.times = array.array('d', bytes(8 * size))
+        self.values = array.array('d', bytes(8 * size))
+        # Number of samples ever appended, the newest one has sequence number count
+        self.count = 0
+
+    def append(self, timestamp, value):
+        index = self.count % self.size
+        self.times[index] = timestamp
+        self.values[index] = value
+        self.count += 1
+
+    def latest(self):
+        """
+        Returns the newest (sequence number, timestamp, value), or None if the buffer is empty.
+        """
+        if not self.count:
+            return None
+        index = (self.count - 1) % self.size
+        return self.count, self.times[index], self.values[index]
+
+    def window(self, n=None):
+        """
+        Returns the timestamps and values of the last ``n`` samples, oldest first, as two arrays.
+        At most the samples held are returned, a negative ``n`` returns none.
+        """
+        n = max(0, min(self.size if n is None else n, self.size, self.count))
+        end = self.count % self.size
+        start = end - n
+        if start >= 0:
+            return self.times[start:end], self.values[start:end]
+        return self.times[start:] + self.times[:end], self.values[start:] + self.values[:end]
+
+
+class _Channel:
+    def __init__(self, name, read, period, size, on_sample, taps):
+        self.name = name
+        self.read = read
+        self.period = period
+        self.buffer = RingBuffer(size)
+        self.on_sample = on_sample
+        self.taps = taps
+        self.due = 0.0
+        self.reads = 0
+        self.errors = 0
+        self.served = 0
+
+
+class SensorSampler:
+    """
+    Reads sensors at fixed rates into ring buffers so consumers never touch sysfs themselves.
+    Every channel is also readable as an attribute returning its latest value, so the sampler
+    stands in for the sensor objects: ``sampler.proximity`` instead of ``ir.proximity``.
+    """
+
+    def __init__(self):
+        self._channels = {}
+        # Taps by channel name, also of channels not added yet
+        self._taps = {}
+        self._cond = threading.Condition()
+        self._started_at = None
+
+    def add(self, name, read, rate, size=64, on_sample=None):
+        """
+        Adds a channel.
+        :param name: the channel name, normally the sensor attribute it samples
+        :param read: a callable returning one raw reading
+        :param rate: the sample rate in Hz
+        :param size: the number of samples kept
+        :param on_sample: called with no arguments on the sampling thread after each new sample
+        """
+        self._channels[name] = _Channel(name, read, 1.0 / rate, size, on_sample, self._taps.setdefault(name, []))
+
+    def tap(self, name, callback):
+        """
+        Calls ``callback(timestamp, value)`` on the sampling thread with every new sample of a channel.
+        A channel can be tapped before it is added, the tap then sees its first sample.
+        """
+        self._taps.setdefault(name, []).append(callback)
+
+    def __getattr__(self, name):
+        try:
+            channel = self.__dict__['_channels'][name]
+        except KeyError:
+            raise AttributeError(name)
+        return self.latest(channel.name)
+
+    def latest(self, name):
+        """
+        Returns the newest value of a channel, or None before the first sample.
+        """
+        channel = self._channels[name]
+        channel.served += 1
+        with self._cond:
+            sample = channel.buffer.latest()
+        return sample[2] if sample is not None else None
+
+    def window(self, name, n=None):
+        """
+        Returns the timestamps and values of the last ``n`` samples of a channel, oldest first.
+        """
+        channel = self._channels[name]
+        channel.served += 1
+        with self._cond:
+            return channel.buffer.window(n)
+
+    def wait(self, name, after=0, timeout=None):
+        """
+        Blocks until a channel has a sample newer than sequence number ``after``.
+        Must not be called from the thread running the sampler.
+        :return: the newest (sequence number, timestamp, value), or None on timeout
+        """
+        channel = self._channels[name]
+        with self._cond:
+            if not self._cond.wait_for(lambda: channel.buffer.count > after, timeout):
+                return None
+            channel.served += 1
+            return channel.buffer.latest()
+
+    def sample(self, name):
+        """
+        Reads one channel now and stores the reading.
+        A failed read is counted and skipped, the channel keeps its previous sample.
+        """
+        channel = self._channels[name]
+        try:
+            value = channel.read()
+        except (OSError, ValueError) as error:
+            # One bad read, e.g. of a sensor being replugged, must not end the task sampling every channel
+            channel.errors += 1
+            if channel.errors % ERROR_LOG_EVERY == 1:
+                logger.warning("Reading {} failed ({} errors so far): {}".format(name, channel.errors, error))
+            return
+        timestamp = time.monotonic()
+        channel.reads += 1
+        with self._cond:
+            channel.buffer.append(timestamp, value)
+            self._cond.notify_all()
+        for tap in channel.taps:
+            tap(timestamp, value)
+        if channel.on_sample is not None:
+            channel.on_sample()
+
+    def stats(self):
+        """
+        Returns the sensor reads and the consumer reads served from the buffers, per channel.
+        ``saved_per_second`` is the number of sysfs reads per second the consumers avoided: every read served from
+        a buffer would have been one. ``reads_per_second`` is what the sampler itself reads to fill them.
+        """
+        elapsed = time.monotonic() - self._started_at if self._started_at is not None else 0.0
+        channels = {}
+        for name, channel in self._channels.items():
+            channels[name] = {
+                'reads': channel.reads,
+                'errors': channel.errors,
+                'served': channel.served,
+                'reads_per_second': channel.reads / elapsed if elapsed > 0 else 0.0,
+                'saved_per_second': channel.served / elapsed if elapsed > 0 else 0.0,
+            }
+        return channels
+
+    def task(self):
+        """
+        Generator sampling every channel on its own schedule, for use with the ModeScheduler.
+        """
+        self._started_at = time.monotonic()
+        for channel in self._channels.values():
+            channel.due = self._started_at
+        while True:
+            now = time.monotonic()
+            for channel in self._channels.values():
+                if channel.due <= now:
+                    self.sample(channel.name)
+                    # Skip ticks we have already missed
+                    channel.due = max(channel.due + channel.period, now)
+            yield max(0.0, min(channel.due for channel in self._channels.values()) - time.monotonic())
+
+
+if __name__ == '__main__':
+    # Count the sensor reads with three behaviours consuming the same IR data
+    import sys
+
+    from scheduler import ModeScheduler
+
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+
+    sampler = SensorSampler()
+    touch = TouchService(sampler)
+    sampler.add('proximity', lambda: 42, rate=10)
+    sampler.add('is_pressed', lambda: False, rate=50, on_sample=touch.poll)
+
+    def _consumer(rate, read):
+        def task():
+            while True:
+                read()
+                yield 1.0 / rate
+        return task
+
+    scheduler = ModeScheduler()
+    scheduler.add('sampler', sampler.task, enabled=True)
+    # Heel control at 10 Hz, patrol safety at 20 Hz and sentry over a one second window at 5 Hz
+    scheduler.add('heel', _consumer(10, lambda: sampler.proximity), enabled=True)
+    scheduler.add('patrol', _consumer(20, lambda: sampler.proximity), enabled=True)
+    scheduler.add('sentry', _consumer(5, lambda: sampler.window('proximity', 10)), enabled=True)
+    scheduler.start()
+    time.sleep(seconds)
+    scheduler.stop()
+
+    for name, stats in sampler.stats().items():
+        print("{}: {:.1f} sysfs reads/s, {} reads served from the buffer, {:.1f} sysfs reads/s saved".format(
+            name, stats['reads_per_second'], stats['served'], stats['saved_per_second']))
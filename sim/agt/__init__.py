@@ -0,0 +1,88 @@
+"""
+Simulated agt (Alexa Gadgets Toolkit): no Bluetooth, directives come from a script.
+
+``AlexaGadget.main()`` connects straight away, delivers every directive of
+``world.directive_source`` at its scheduled time, waits ``world.linger`` seconds
+and disconnects.
+"""
+
+import json
+import logging
+import sys
+import time
+from types import SimpleNamespace
+
+from simworld import world
+
+logger = logging.getLogger(__name__)
+
+
+def _namespace(value):
+    if isinstance(value, dict):
+        return SimpleNamespace(**{key: _namespace(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return [_namespace(item) for item in value]
+    return value
+
+
+class Directive:
+    """
+    A directive as the agt callbacks receive it. Custom directives carry their JSON payload
+    as bytes, the others a decoded payload object.
+    """
+
+    def __init__(self, namespace, name, payload):
+        self.header = SimpleNamespace(namespace=namespace, name=name)
+        if namespace.startswith('Custom.'):
+            self.payload = json.dumps(payload).encode('utf-8')
+        else:
+            self.payload = _namespace(payload)
+
+    def __repr__(self):
+        return "Directive({}.{}, {!r})".format(self.header.namespace, self.header.name, self.payload)
+
+
+class AlexaGadget:
+    def __init__(self, gadget_config_path=None):
+        self.friendly_name = 'SimGadget'
+        self.device_addr = '00:00:00:00:00:00'
+
+    def send_custom_event(self, namespace, name, payload):
+        world.events.append((world.elapsed(), namespace, name, payload))
+        world.record('agt', 'event', namespace=namespace, name=name, payload=payload)
+
+    def on_connected(self, device_addr):
+        pass
+
+    def on_disconnected(self, device_addr):
+        pass
+
+    def dispatch(self, namespace, name, payload):
+        """
+        Calls the ``on_<namespace>_<name>`` handler of a directive, like the agt event loop.
+        """
+        handler = getattr(self, 'on_{}_{}'.format(namespace.replace('.', '_'), name).lower(), None)
+        directive = Directive(namespace, name, payload)
+        world.directives.append((world.elapsed(), namespace, name, payload))
+        if handler is None:
+            logger.info("No handler for {}.{}".format(namespace, name))
+            return
+        try:
+            handler(directive)
+        except Exception:
+            logger.exception("Directive handler failed")
+
+    def main(self):
+        world.connected_at = world.elapsed()
+        self.on_connected(self.device_addr)
+        try:
+            for entry in world.directive_source:
+                delay = entry.get('at', 0) - world.elapsed()
+                if delay > 0:
+                    time.sleep(delay)
+                self.dispatch(entry.get('namespace', 'Custom.Mindstorms.Gadget'), entry.get('name', 'control'),
+                              entry.get('payload', {}))
+            time.sleep(world.linger)
+        except KeyboardInterrupt:
+            print("Interrupted", file=sys.stderr)
+        self.on_disconnected(self.device_addr)
@@ -0,0 +1,3 @@
+"""
+Simulated ev3dev2 for running the gadget on a plain Linux box. See sim/run.py.
+"""
@@ -0,0 +1,137 @@
+"""
+Simulated ev3dev2.display: a 178x128 screen drawn into a memory-mapped framebuffer file, at the
+``world.bits_per_pixel`` of the framebuffer.
+
+PIL is not needed: the drawing object implements the few ImageDraw calls the gadget makes
+on a plain bytearray raster.
+"""
+
+import mmap
+import os
+import tempfile
+
+from simworld import world
+
+XRES = 178
+YRES = 128
+# Row length of the 1 bit per pixel framebuffer
+LINE_LENGTH = 24
+# The white pixel of the formats other than 1 bit per pixel, black is 0
+WHITE = {16: 0xFFFF, 24: 0xFFFFFF, 32: 0x00FFFFFF}
+
+
+def _fill(color):
+    return 0 if color in (None, 'white', 255, 1, (255, 255, 255)) else 1
+
+
+class _Draw:
+    def __init__(self, raster, xres, yres):
+        self._raster = raster
+        self._xres = xres
+        self._yres = yres
+
+    def _span(self, x0, x1, y, value):
+        x0, x1 = max(0, int(x0)), min(self._xres - 1, int(x1))
+        if 0 <= y < self._yres and x0 <= x1:
+            start = int(y) * self._xres
+            self._raster[start + x0:start + x1 + 1] = bytes([value]) * (x1 - x0 + 1)
+
+    def rectangle(self, xy, fill=None, outline=None, width=1, **kwargs):
+        x0, y0, x1, y1 = xy
+        x0, x1 = sorted((x0, x1))
+        y0, y1 = sorted((y0, y1))
+        if fill is not None:
+            for y in range(int(y0), int(y1) + 1):
+                self._span(x0, x1, y, _fill(fill))
+        if outline is not None:
+            self._span(x0, x1, y0, _fill(outline))
+            self._span(x0, x1, y1, _fill(outline))
+            for y in range(int(y0), int(y1) + 1):
+                self._span(x0, x0, y, _fill(outline))
+                self._span(x1, x1, y, _fill(outline))
+
+    def ellipse(self, xy, fill=None, outline=None, width=1):
+        x0, y0, x1, y1 = xy
+        x0, x1 = sorted((x0, x1))
+        y0, y1 = sorted((y0, y1))
+        cx, cy = (x0 + x1) / 2.0, (y0 + y1) / 2.0
+        rx, ry = max(0.5, (x1 - x0) / 2.0), max(0.5, (y1 - y0) / 2.0)
+        for y in range(int(y0), int(y1) + 1):
+            dy = (y - cy) / ry
+            if abs(dy) <= 1:
+                dx = rx * (1 - dy * dy) ** 0.5
+                self._span(cx - dx, cx + dx, y, _fill(fill if fill is not None else outline))
+
+    def line(self, xy, fill=None, width=1):
+        x0, y0, x1, y1 = xy
+        steps = int(max(abs(x1 - x0), abs(y1 - y0), 1))
+        for i in range(steps + 1):
+            x = x0 + (x1 - x0) * i / float(steps)
+            y = y0 + (y1 - y0) * i / float(steps)
+            self._span(x - width // 2, x + width // 2, int(round(y)), _fill(fill or 'black'))
+
+    def point(self, xy, fill=None):
+        self._span(xy[0], xy[0], xy[1], _fill(fill or 'black'))
+
+    def text(self, xy, text, fill=None, font=None):
+        world.record('display', 'text', text=text)
+
+
+class Display:
+    """
+    The EV3 screen. ``path`` is the framebuffer file, ``line_length`` bytes per row. At 1 bit per pixel
+    the pixels are packed least significant bit first and 1 is black, otherwise black is 0.
+    """
+
+    def __init__(self, desc='Display'):
+        self.xres = XRES
+        self.yres = YRES
+        self.bits_per_pixel = world.bits_per_pixel
+        self.line_length = LINE_LENGTH if self.bits_per_pixel == 1 else XRES * self.bits_per_pixel // 8
+        size = self.line_length * YRES
+        if world.framebuffer is None:
+            directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+            fd, world.framebuffer = tempfile.mkstemp(prefix='ev3fb', dir=directory)
+            os.write(fd, bytes(size))
+            os.close(fd)
+        self.path = world.framebuffer
+        self._fb = open(self.path, 'r+b')
+        self.mmap = mmap.mmap(self._fb.fileno(), size)
+        self._raster = bytearray(XRES * YRES)
+        self.draw = _Draw(self._raster, XRES, YRES)
+        self.image = None
+
+    @property
+    def shape(self):
+        return self.xres, self.yres
+
+    def clear(self):
+        self._raster[:] = bytes(len(self._raster))
+
+    def update(self):
+        packed = bytearray(self.line_length * YRES)
+        if self.bits_per_pixel == 1:
+            for y in range(YRES):
+                row = self._raster[y * XRES:(y + 1) * XRES]
+                for x in range(XRES):
+                    if row[x]:
+                        packed[y * self.line_length + x // 8] |= 1 << (x % 8)
+        else:
+            size = self.bits_per_pixel // 8
+            white = WHITE[self.bits_per_pixel].to_bytes(size, 'little')
+            for y in range(YRES):
+                for x in range(XRES):
+                    if not self._raster[y * XRES + x]:
+                        start = y * self.line_length + x * size
+                        packed[start:start + size] = white
+        self.mmap[:] = packed
+        world.frames += 1
+        world.record('display', 'update')
+
+    def text_pixels(self, text, clear_screen=True, x=0, y=0, text_color='black', font=None):
+        if clear_screen:
+            self.clear()
+        self.draw.text((x, y), text)
+
+    def text_grid(self, text, clear_screen=True, x=0, y=0, text_color='black', font=None):
+        self.text_pixels(text, clear_screen)
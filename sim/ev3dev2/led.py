@@ -0,0 +1,61 @@
+"""
+Simulated ev3dev2.led with the EV3 LED groups and colors.
+"""
+
+from collections import OrderedDict
+
+from simworld import world
+
+
+class Led:
+    _path = None
+    max_brightness = 255
+
+    def __init__(self, name):
+        self.name = name
+        self._brightness = 0
+
+    @property
+    def brightness(self):
+        return self._brightness
+
+    @brightness.setter
+    def brightness(self, value):
+        self._brightness = int(value)
+        world.leds[self.name] = self._brightness
+
+    @property
+    def brightness_pct(self):
+        return self._brightness / float(self.max_brightness)
+
+    @brightness_pct.setter
+    def brightness_pct(self, value):
+        self.brightness = round(self.max_brightness * value)
+
+
+class Leds:
+    def __init__(self):
+        self.leds = OrderedDict((name, Led(name)) for name in (
+            'led0:red:brick-status', 'led0:green:brick-status', 'led1:red:brick-status', 'led1:green:brick-status'))
+        self.led_groups = OrderedDict([
+            ('LEFT', (self.leds['led0:red:brick-status'], self.leds['led0:green:brick-status'])),
+            ('RIGHT', (self.leds['led1:red:brick-status'], self.leds['led1:green:brick-status'])),
+        ])
+        self.led_colors = OrderedDict([
+            ('BLACK', (0, 0)),
+            ('RED', (1, 0)),
+            ('GREEN', (0, 1)),
+            ('AMBER', (1, 1)),
+            ('ORANGE', (1, 0.5)),
+            ('YELLOW', (0.1, 1)),
+        ])
+
+    def set_color(self, group, color, pct=1):
+        values = self.led_colors[color] if isinstance(color, str) else color
+        world.record('leds', 'set_color', group=group, color=color)
+        for led, value in zip(self.led_groups[group], values):
+            led.brightness_pct = value * pct
+
+    def all_off(self):
+        for group in self.led_groups:
+            self.set_color(group, 'BLACK')
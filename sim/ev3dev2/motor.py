@@ -0,0 +1,199 @@
+"""
+Simulated ev3dev2.motor: the motors act on the kinematics in simworld.
+"""
+
+import time
+
+from simworld import world
+
+OUTPUT_A = 'outA'
+OUTPUT_B = 'outB'
+OUTPUT_C = 'outC'
+OUTPUT_D = 'outD'
+
+
+class SpeedValue:
+    def to_native_units(self, motor):
+        raise NotImplementedError
+
+
+class SpeedPercent(SpeedValue):
+    def __init__(self, percent):
+        self.percent = percent
+
+    def to_native_units(self, motor):
+        return self.percent / 100.0 * motor.max_speed
+
+    def __repr__(self):
+        return "SpeedPercent({})".format(self.percent)
+
+
+class SpeedNativeUnits(SpeedValue):
+    def __init__(self, native_counts):
+        self.native_counts = native_counts
+
+    def to_native_units(self, motor):
+        return self.native_counts
+
+
+def _native(speed, motor):
+    return speed.to_native_units(motor) if isinstance(speed, SpeedValue) else speed
+
+
+class Motor:
+    """
+    A tacho motor with the sysfs attributes and commands the gadget uses.
+    It has no sysfs path, so the gadget's handle cache falls back to these properties.
+    """
+
+    max_speed = 1050
+    _path = None
+
+    def __init__(self, address=None):
+        self.address = address
+        self._state = world.motor(address, self.max_speed)
+        self.speed_sp = 0
+        self.time_sp = 0
+        self.position_sp = 0
+
+    @property
+    def stop_action(self):
+        return self._state.stop_action
+
+    @stop_action.setter
+    def stop_action(self, value):
+        self._state.stop_action = value
+
+    @property
+    def command(self):
+        raise AttributeError("command is write-only")
+
+    @command.setter
+    def command(self, command):
+        world.record(self.address, command, speed_sp=self.speed_sp, time_sp=self.time_sp)
+        if command == 'run-forever':
+            self._state.run(self.speed_sp)
+        elif command == 'run-timed':
+            self._state.run(self.speed_sp, self.time_sp / 1000.0)
+        elif command == 'run-to-rel-pos':
+            degrees = abs(self.position_sp)
+            speed = abs(self.speed_sp) * (1 if self.position_sp >= 0 else -1)
+            self._state.run(speed, degrees / abs(self.speed_sp) if self.speed_sp else 0)
+        elif command in ('stop', 'reset'):
+            self._state.stop()
+
+    @property
+    def position(self):
+        return int(self._state.read()[0])
+
+    @property
+    def speed(self):
+        return int(self._state.read()[1])
+
+    @property
+    def is_running(self):
+        return self._state.running
+
+    @property
+    def state(self):
+        return ['running'] if self._state.running else []
+
+    def run_forever(self, **kwargs):
+        self._set(kwargs)
+        self.command = 'run-forever'
+
+    def run_timed(self, **kwargs):
+        self._set(kwargs)
+        self.command = 'run-timed'
+
+    def run_to_rel_pos(self, **kwargs):
+        self._set(kwargs)
+        self.command = 'run-to-rel-pos'
+
+    def stop(self, **kwargs):
+        self._set(kwargs)
+        self.command = 'stop'
+
+    def reset(self):
+        self.command = 'reset'
+
+    def wait_while(self, state, timeout=None):
+        start = time.monotonic()
+        while self._state.running:
+            if timeout is not None and time.monotonic() - start >= timeout / 1000.0:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def on_for_rotations(self, speed, rotations, brake=True, block=True):
+        return self.on_for_degrees(speed, rotations * 360, brake, block)
+
+    def on_for_degrees(self, speed, degrees, brake=True, block=True):
+        speed = _native(speed, self)
+        self.stop_action = 'hold' if brake else 'coast'
+        self.run_to_rel_pos(speed_sp=abs(speed), position_sp=degrees * (1 if speed >= 0 else -1))
+        if block:
+            self.wait_while('running')
+
+    def on_for_seconds(self, speed, seconds, brake=True, block=True):
+        self.stop_action = 'hold' if brake else 'coast'
+        self.run_timed(speed_sp=_native(speed, self), time_sp=int(seconds * 1000))
+        if block:
+            self.wait_while('running')
+
+    def on(self, speed, brake=True, block=False):
+        self.stop_action = 'hold' if brake else 'coast'
+        self.run_forever(speed_sp=_native(speed, self))
+
+    def off(self, brake=True):
+        self.stop(stop_action='hold' if brake else 'coast')
+
+    def _set(self, attributes):
+        for name, value in attributes.items():
+            setattr(self, name, value)
+
+
+class LargeMotor(Motor):
+    max_speed = 1050
+
+    def __init__(self, address=OUTPUT_B):
+        super().__init__(address)
+
+
+class MediumMotor(Motor):
+    max_speed = 1560
+
+    def __init__(self, address=OUTPUT_A):
+        super().__init__(address)
+
+
+class MoveTank:
+    """
+    Two large motors driven as a pair, like ev3dev2.motor.MoveTank.
+    """
+
+    def __init__(self, left_motor_port, right_motor_port, motor_class=LargeMotor):
+        self.left_motor = motor_class(left_motor_port)
+        self.right_motor = motor_class(right_motor_port)
+
+    def on_for_seconds(self, left_speed, right_speed, seconds, brake=True, block=True):
+        for motor, speed in ((self.left_motor, left_speed), (self.right_motor, right_speed)):
+            motor.on_for_seconds(speed, seconds, brake, block=False)
+        if block:
+            self.left_motor.wait_while('running')
+            self.right_motor.wait_while('running')
+
+    def on_for_rotations(self, left_speed, right_speed, rotations, brake=True, block=True):
+        for motor, speed in ((self.left_motor, left_speed), (self.right_motor, right_speed)):
+            motor.on_for_rotations(speed, rotations, brake, block=False)
+        if block:
+            self.left_motor.wait_while('running')
+            self.right_motor.wait_while('running')
+
+    def on(self, left_speed, right_speed):
+        self.left_motor.on(left_speed)
+        self.right_motor.on(right_speed)
+
+    def off(self, brake=True):
+        self.left_motor.off(brake)
+        self.right_motor.off(brake)
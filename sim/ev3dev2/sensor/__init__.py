@@ -0,0 +1,23 @@
+"""
+Simulated ev3dev2.sensor.
+"""
+
+INPUT_1 = 'in1'
+INPUT_2 = 'in2'
+INPUT_3 = 'in3'
+INPUT_4 = 'in4'
+
+
+class Sensor:
+    """
+    A sensor without a sysfs path: the value is computed from the world on every read.
+    """
+
+    _path = None
+
+    def __init__(self, address=None):
+        self.address = address
+        self.mode = None
+
+    def value(self, n=0):
+        raise NotImplementedError
@@ -0,0 +1,49 @@
+"""
+Simulated ev3dev2.sensor.lego: the readings follow the scripted profiles in simworld.
+"""
+
+from ev3dev2.sensor import Sensor, INPUT_1, INPUT_4
+from simworld import world
+
+
+class InfraredSensor(Sensor):
+    MODE_IR_PROX = 'IR-PROX'
+
+    def __init__(self, address=INPUT_4):
+        super().__init__(address)
+        self.mode = self.MODE_IR_PROX
+        self.reads = 0
+
+    def value(self, n=0):
+        self.reads += 1
+        return world.proximity()
+
+    @property
+    def proximity(self):
+        return self.value(0)
+
+
+class TouchSensor(Sensor):
+    MODE_TOUCH = 'TOUCH'
+
+    def __init__(self, address=INPUT_1):
+        super().__init__(address)
+        self.mode = self.MODE_TOUCH
+        self.reads = 0
+
+    def value(self, n=0):
+        self.reads += 1
+        return int(world.pressed())
+
+    @property
+    def is_pressed(self):
+        return bool(self.value(0))
+
+    def wait_for_pressed(self, timeout_ms=None, sleep_ms=10):
+        import time
+        start = time.monotonic()
+        while not self.is_pressed:
+            if timeout_ms is not None and time.monotonic() - start >= timeout_ms / 1000.0:
+                return False
+            time.sleep(sleep_ms / 1000.0)
+        return True
@@ -0,0 +1,53 @@
+"""
+Simulated ev3dev2.sound: speech and songs take their playing time on the clock and are logged.
+"""
+
+import time
+
+from simworld import world
+
+# Seconds per character of speech, roughly espeak's default rate
+_SPEECH_RATE = 0.07
+_NOTE_VALUES = {'w': 4.0, 'h': 2.0, 'q': 1.0, 'e': 0.5, 's': 0.25}
+
+
+class Sound:
+    PLAY_WAIT_FOR_COMPLETE = 0
+    PLAY_NO_WAIT_FOR_COMPLETE = 1
+    PLAY_LOOP = 2
+
+    def speak(self, text, espeak_opts='-a 200 -s 130', volume=100, play_type=PLAY_WAIT_FOR_COMPLETE):
+        world.spoken.append(text)
+        world.record('sound', 'speak', text=text)
+        self._play(len(text) * _SPEECH_RATE, play_type)
+
+    def play_song(self, song, tempo=120, delay=0.05):
+        world.record('sound', 'play_song', notes=len(song))
+        beat = 60.0 / tempo
+        duration = 0.0
+        for _, value in song:
+            length = _NOTE_VALUES.get(value.rstrip('.3'), 1.0) * beat
+            if value.endswith('.'):
+                length *= 1.5
+            elif value.endswith('3'):
+                length *= 2 / 3.0
+            duration += length + delay
+        self._play(duration, self.PLAY_WAIT_FOR_COMPLETE)
+
+    def play_file(self, wav_file, volume=100, play_type=PLAY_WAIT_FOR_COMPLETE):
+        import wave
+        world.record('sound', 'play_file', path=wav_file)
+        with wave.open(wav_file) as wav:
+            self._play(wav.getnframes() / float(wav.getframerate()), play_type)
+
+    def beep(self, args='', play_type=PLAY_WAIT_FOR_COMPLETE):
+        world.record('sound', 'beep')
+        self._play(0.1, play_type)
+
+    def play_tone(self, frequency, duration, delay=0.0, volume=100, play_type=PLAY_WAIT_FOR_COMPLETE):
+        world.record('sound', 'tone', frequency=frequency)
+        self._play(duration, play_type)
+
+    def _play(self, duration, play_type):
+        if play_type == self.PLAY_WAIT_FOR_COMPLETE:
+            time.sleep(duration)
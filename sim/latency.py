@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+End-to-end latency benchmark of new.py's directive handling, on the simulated hardware.
+
+Synthetic directives are fed into ``on_custom_mindstorms_gadget_control`` at a
+fixed rate while the gadget is idle, dancing or in heel mode. Every directive is
+timestamped at each stage:
+
+    decode    JSON decoding of the payload
+    dispatch  arrival until the callback returns
+    queue     arrival until the command starts on the executor (0 for the stop fast path)
+    actuator  arrival until the first motor, LED or audio sample write it caused
+
+and the p50/p95/p99 of each stage and the throughput are reported per command class::
+
+    python3 sim/latency.py --count 20 --rate 5
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+SIM_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SIM_DIR)
+
+import run  # noqa: E402
+
+# Command class -> directive payload
+CLASSES = {
+    'stop': {'type': 'move', 'direction': 'stop', 'duration': 0, 'speed': 0},
+    'forward': {'type': 'move', 'direction': 'forward', 'duration': 1, 'speed': 50},
+    'sit': {'type': 'command', 'command': 'sit'},
+    'bark': {'type': 'command', 'command': 'angry'},
+}
+LOADS = ('idle', 'dancing', 'heel')
+STAGES = ('decode', 'dispatch', 'queue', 'actuator')
+
+
+class _Sample:
+    def __init__(self, command_class):
+        self.command_class = command_class
+        self.arrived = None
+        self.decode = None
+        self.returned = None
+        self.started = None
+        self.actuated = None
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of a list of numbers, None if it is empty.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(p / 100.0 * len(ordered))) - 1))]
+
+
+class LatencyProbe:
+    """
+    Hooks the stages of a MindstormsGadget and attributes actuator writes to the directive
+    that caused them: writes on the command executor thread belong to the running command,
+    writes on the feeding thread to the stop fast path, and the first audio write after a
+    play() to the bark that started it.
+    """
+
+    def __init__(self, gadget, module, world):
+        self.gadget = gadget
+        self.samples = []
+        self._current = None
+        self._running = None
+        self._audio_pending = []
+        self._feeder = threading.current_thread()
+        self._lock = threading.Lock()
+
+        probe = self
+
+        class _TimedJson:
+            @staticmethod
+            def loads(data, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return json.loads(data, **kwargs)
+                finally:
+                    if probe._current is not None:
+                        probe._current.decode = time.perf_counter() - start
+        module.json = _TimedJson
+
+        submit, preempt = gadget.commands.submit, gadget.commands.preempt
+
+        def timed_submit(func, *args, **kwargs):
+            sample = self._current
+
+            def run_command(*run_args, **run_kwargs):
+                sample.started = time.perf_counter()
+                self._running = sample
+                try:
+                    return func(*run_args, **run_kwargs)
+                finally:
+                    self._running = None
+            return submit(run_command, *args, **kwargs)
+
+        def timed_preempt(func, *args, **kwargs):
+            self._current.started = time.perf_counter()
+            return preempt(func, *args, **kwargs)
+        gadget.commands.submit = timed_submit
+        gadget.commands.preempt = timed_preempt
+
+        play = gadget.audio.play
+
+        def timed_play(*args, **kwargs):
+            if self._running is not None:
+                with self._lock:
+                    self._audio_pending.append(self._running)
+            return play(*args, **kwargs)
+        gadget.audio.play = timed_play
+
+        write = gadget.audio.sink.write
+
+        def timed_write(data):
+            if self._audio_pending:
+                now = time.perf_counter()
+                with self._lock:
+                    pending, self._audio_pending = self._audio_pending, []
+                for sample in pending:
+                    self._actuated(sample, now)
+            return write(data)
+        gadget.audio.sink.write = timed_write
+
+        world.listeners.append(self._on_actuator)
+
+    def _on_actuator(self, entry):
+        _, device, _, _ = entry
+        if device in ('sound', 'display'):
+            return
+        now = time.perf_counter()
+        thread = threading.current_thread()
+        if thread.name == self.gadget.commands.name:
+            sample = self._running
+        elif thread is self._feeder:
+            sample = self._current
+        else:
+            return
+        if sample is not None:
+            self._actuated(sample, now)
+
+    def _actuated(self, sample, now):
+        if sample.actuated is None:
+            sample.actuated = now
+
+    def drain(self, timeout=30.0):
+        """
+        Waits until the command executor has run everything it was given.
+        """
+        deadline = time.perf_counter() + timeout
+        while (self.gadget.commands.depth or self._running is not None) and time.perf_counter() < deadline:
+            time.sleep(0.01)
+
+    def deliver(self, command_class, directive):
+        """
+        Calls the gadget's directive handler like the agt event loop does.
+        """
+        sample = _Sample(command_class)
+        self.samples.append(sample)
+        self._current = sample
+        sample.arrived = time.perf_counter()
+        self.gadget.on_custom_mindstorms_gadget_control(directive)
+        sample.returned = time.perf_counter()
+        self._current = None
+        return sample
+
+
+def _stages(sample):
+    return {
+        'decode': sample.decode,
+        'dispatch': sample.returned - sample.arrived,
+        'queue': sample.started - sample.arrived if sample.started is not None else None,
+        'actuator': sample.actuated - sample.arrived if sample.actuated is not None else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=20, help="directives per command class and load")
+    parser.add_argument('--rate', type=float, default=5.0, help="directives per second")
+    parser.add_argument('--settle', type=float, default=1.0, help="seconds to wait for the last actuator write")
+    parser.add_argument('--loads', default=','.join(LOADS), help="comma separated loads to run")
+    parser.add_argument('--classes', default=','.join(CLASSES), help="comma separated command classes")
+    parser.add_argument('--script', default=os.path.join(SIM_DIR, os.pardir, 'new.py'), help="the gadget script")
+    options = parser.parse_args()
+
+    world = run.install(speed=1.0)
+    # Someone walking to and fro in front of the puppy keeps heel mode busy
+    world.ir_profile = run.ir_profile('42 + 30 * sin(t * 2)')
+    script = os.path.abspath(options.script)
+    sys.path.insert(1, os.path.dirname(script))
+    os.chdir(os.path.dirname(script))
+
+    import audio
+    import importlib
+    from agt import Directive
+
+    audio.sink_factory = lambda framerate, channels: audio.NullSink(framerate, channels)
+    stdout, stderr = sys.stdout, sys.stderr
+    # The gadget prints on every directive, that cost is part of the measurement but not of the report
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    try:
+        module = importlib.import_module(os.path.splitext(os.path.basename(script))[0])
+        gadget = module.MindstormsGadget()
+        probe = LatencyProbe(gadget, module, world)
+        results = []
+        for load in options.loads.split(','):
+            for command_class in options.classes.split(','):
+                directive = Directive('Custom.Mindstorms.Gadget', 'control', CLASSES[command_class])
+                start = time.perf_counter()
+                samples = []
+                for i in range(options.count):
+                    # Stop and sit end dancing and heel mode, put the load back before every directive
+                    gadget.dance = load == 'dancing'
+                    gadget.heel_mode = load == 'heel'
+                    if command_class == 'stop' and load == 'idle':
+                        # Give stop something to stop
+                        gadget.wheels.run_forever(300, 300)
+                    samples.append(probe.deliver(command_class, directive))
+                    time.sleep(max(0.0, start + (i + 1) / options.rate - time.perf_counter()))
+                probe.drain()
+                time.sleep(options.settle)
+                elapsed = time.perf_counter() - start
+                completed = sum(1 for sample in samples if sample.actuated is not None)
+                results.append((load, command_class, samples, completed / elapsed))
+        gadget.dance = gadget.heel_mode = False
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+    print("{:8s} {:8s} {:9s} {:>9s} {:>9s} {:>9s} {:>8s}".format(
+        'load', 'command', 'stage', 'p50 ms', 'p95 ms', 'p99 ms', 'per s'))
+    for load, command_class, samples, throughput in results:
+        stages = [_stages(sample) for sample in samples]
+        for stage in STAGES:
+            values = [sample[stage] for sample in stages if sample[stage] is not None]
+            cells = ["{:9.2f}".format(percentile(values, p) * 1000) if values else "{:>9s}".format('-')
+                     for p in (50, 95, 99)]
+            rate = "{:8.1f}".format(throughput) if stage == 'actuator' else ''
+            print("{:8s} {:8s} {:9s} {} {}".format(load, command_class, stage, ' '.join(cells), rate).rstrip())
+        missing = len(samples) - sum(1 for sample in stages if sample['actuator'] is not None)
+        if missing:
+            # e.g. a stop while the wheels are between two dance steps, the MotorFacade drops it
+            print("{:8s} {:8s} {} of {} directives wrote to no actuator".format(
+                load, command_class, missing, len(samples)))
+
+
+if __name__ == '__main__':
+    main()
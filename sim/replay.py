@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Replays a recording made with PUPPY_RECORD into a gadget script on the simulated hardware,
+and diffs actuator command streams.
+
+The recorded directives are delivered at their recorded times, the IR sensor
+returns the recorded proximity samples and the touch sensor is pressed and
+released at the recorded times. The virtual clock runs the session at 1x or
+faster, and the random module is seeded so random speeds and colors repeat::
+
+    PUPPY_RECORD=session.rec python3 sim/run.py --seed 0 --actuators field.jsonl --directives sim/demo.jsonl new.py
+    python3 sim/replay.py run session.rec new.py --speed 20 --out replay.jsonl --against field.jsonl
+    python3 sim/replay.py diff before.jsonl after.jsonl
+
+The diff matches the commands of each device in order and reports commands
+that are missing, extra or changed, and matching commands more than
+``--tolerance`` seconds apart. It exits with status 1 if the streams differ.
+"""
+
+import argparse
+import bisect
+import collections
+import difflib
+import json
+import os
+import sys
+import time
+
+SIM_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SIM_DIR)
+sys.path.insert(1, os.path.join(SIM_DIR, os.pardir))
+
+import run  # noqa: E402
+import recording  # noqa: E402
+
+# Thread timing on the virtual clock can shift a heel control decision by a tick or two of 100 ms
+TOLERANCE = 0.25
+
+
+def load_actuators(path):
+    with open(path) as lines:
+        return [json.loads(line) for line in lines if line.strip()]
+
+
+def diff(expected, actual, tolerance=TOLERANCE):
+    """
+    Compares two actuator command streams device by device.
+    :return: a list of difference descriptions and the largest time offset between matching commands
+    """
+    def by_device(stream):
+        devices = collections.OrderedDict()
+        for t, device, action, details in stream:
+            devices.setdefault(str(device), []).append((t, action, json.dumps(details, sort_keys=True)))
+        return devices
+
+    expected_devices, actual_devices = by_device(expected), by_device(actual)
+    differences = []
+    worst = 0.0
+    for device in sorted(set(expected_devices) | set(actual_devices)):
+        left, right = expected_devices.get(device, []), actual_devices.get(device, [])
+        matcher = difflib.SequenceMatcher(None, [command[1:] for command in left],
+                                          [command[1:] for command in right], autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                for (t1, action, _), (t2, _, _) in zip(left[i1:i2], right[j1:j2]):
+                    worst = max(worst, abs(t2 - t1))
+                    if abs(t2 - t1) > tolerance:
+                        differences.append("{} {} at {:.3f}s moved by {:+.3f}s".format(device, action, t1, t2 - t1))
+                continue
+            for t, action, details in left[i1:i2]:
+                differences.append("{} {:.3f}s - {} {}".format(device, t, action, details))
+            for t, action, details in right[j1:j2]:
+                differences.append("{} {:.3f}s + {} {}".format(device, t, action, details))
+    return differences, worst
+
+
+def report(expected, actual, tolerance):
+    differences, worst = diff(expected, actual, tolerance)
+    print("{} vs {} actuator commands, largest time offset of matching commands {:.3f}s".format(
+        len(expected), len(actual), worst))
+    for line in differences[:50]:
+        print("  " + line)
+    if len(differences) > 50:
+        print("  ... {} more".format(len(differences) - 50))
+    print("{} differences".format(len(differences)))
+    return not differences
+
+
+def replay(path, script, speed, seed, linger):
+    """
+    Runs a script against a recording on the simulated hardware.
+    :return: the simulated world after the run
+    """
+    _, records = recording.read(path)
+    directives = []
+    samples = ([], [])
+    presses = []
+    for t, kind, value in records:
+        if kind == recording.DIRECTIVE:
+            namespace, name, payload = value
+            directives.append({'at': t, 'namespace': namespace, 'name': name, 'payload': json.loads(payload)})
+        elif kind == recording.TEMPO:
+            directives.append({'at': t, 'namespace': recording.TEMPO_NAMESPACE, 'name': 'Tempo', 'payload': {
+                'tempoData': [{'value': tempo, 'startOffsetInMilliSeconds': offset} for tempo, offset in value]}})
+        elif kind == recording.PROXIMITY:
+            samples[0].append(t)
+            samples[1].append(value)
+        elif kind == recording.TOUCH:
+            if value:
+                presses.append([t, float('inf')])
+            elif presses:
+                presses[-1][1] = t
+
+    world = run.install(speed)
+    world.linger = linger
+    # Recorded times start when the gadget is made
+    import agt
+    init = agt.AlexaGadget.__init__
+
+    def replay_init(gadget, *args, **kwargs):
+        offset = world.elapsed()
+        world.directive_source = [dict(directive, at=directive['at'] + offset) for directive in directives]
+        world.touch_profile = [(press + offset, release + offset) for press, release in presses]
+
+        def proximity(t):
+            # The sample nearest in time, the sampler's ticks do not line up exactly with the recorded ones
+            t -= offset
+            index = bisect.bisect_left(samples[0], t)
+            if index == len(samples[0]) or (index > 0 and t - samples[0][index - 1] < samples[0][index] - t):
+                index -= 1
+            return samples[1][index]
+        if samples[0]:
+            world.ir_profile = proximity
+        return init(gadget, *args, **kwargs)
+    agt.AlexaGadget.__init__ = replay_init
+
+    # Do not record the replay itself
+    os.environ.pop('PUPPY_RECORD', None)
+    start = time.perf_counter()
+    try:
+        run.execute(world, script, seed=seed)
+    finally:
+        print(run.summary(world, time.perf_counter() - start), file=sys.stderr)
+    return world
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+    replay_parser = commands.add_parser('run', help="replay a recording into a gadget script")
+    replay_parser.add_argument('recording')
+    replay_parser.add_argument('script')
+    replay_parser.add_argument('--speed', type=float, default=1.0, help="virtual clock speed-up, default 1")
+    replay_parser.add_argument('--seed', type=int, default=0, help="seed of the random module")
+    replay_parser.add_argument('--linger', type=float, default=5.0, help="seconds to run after the last directive")
+    replay_parser.add_argument('--out', help="write the actuator commands to this JSON lines file")
+    replay_parser.add_argument('--against', help="diff the actuator commands with this JSON lines file")
+    replay_parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                               help="seconds two matching commands may differ")
+    diff_parser = commands.add_parser('diff', help="diff two actuator command files")
+    diff_parser.add_argument('expected')
+    diff_parser.add_argument('actual')
+    diff_parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                             help="seconds two matching commands may differ")
+    options = parser.parse_args()
+
+    if options.command == 'diff':
+        sys.exit(0 if report(load_actuators(options.expected), load_actuators(options.actual),
+                             options.tolerance) else 1)
+    if options.command != 'run':
+        parser.print_help()
+        sys.exit(2)
+
+    out = os.path.abspath(options.out) if options.out else None
+    against = os.path.abspath(options.against) if options.against else None
+    world = replay(os.path.abspath(options.recording), options.script, options.speed, options.seed, options.linger)
+    if out:
+        run.write_actuators(world, out)
+    if against:
+        actual = [[round(t - world.connected_at, 4), device, action, details]
+                  for t, device, action, details in world.log]
+        # Round trip through JSON so details compare like the loaded file
+        actual = json.loads(json.dumps(actual, default=str))
+        sys.exit(0 if report(load_actuators(against), actual, options.tolerance) else 1)
+
+
+if __name__ == '__main__':
+    main()
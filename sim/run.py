@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Runs a gadget script against the simulated EV3 hardware on a plain Linux box.
+
+The simulated ``ev3dev2`` and ``agt`` modules in this directory shadow the real
+ones, and a virtual clock runs ``time.sleep``-driven behaviours faster than real
+time. The script itself runs unchanged::
+
+    python3 sim/run.py --speed 10 --directives sim/demo.jsonl new.py
+    python3 sim/run.py --ir "42 + 30 * sin(t / 2)" --touch 3:3.5,8:8.2 main.py
+    python3 sim/run.py --seed 0 --actuators field.jsonl --directives sim/demo.jsonl new.py
+    python3 sim/run.py --bpp 32 --directives sim/demo.jsonl new.py
+
+Directive files hold one JSON object per line::
+
+    {"at": 2.0, "payload": {"type": "command", "command": "heel"}}
+    {"at": 9.5, "namespace": "Alexa.Gadget.MusicData", "name": "Tempo", "payload": {"tempoData": [...]}}
+
+``at`` is in seconds since start, the namespace defaults to Custom.Mindstorms.Gadget
+and the name to control.
+"""
+
+import argparse
+import collections
+import json
+import math
+import os
+import random
+import runpy
+import sys
+import time
+
+SIM_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_directives(path):
+    with open(path) as lines:
+        return [json.loads(line) for line in lines if line.strip() and not line.lstrip().startswith('#')]
+
+
+def ir_profile(expression):
+    """
+    Compiles a proximity profile: a number, or an expression of ``t`` in seconds using the math functions.
+    """
+    code = compile(expression, '<ir profile>', 'eval')
+    names = {name: getattr(math, name) for name in dir(math) if not name.startswith('_')}
+    return lambda t: eval(code, {'__builtins__': {}}, dict(names, t=t))
+
+
+def touch_profile(spec):
+    """
+    Parses "press:release,..." times in seconds.
+    """
+    return [tuple(float(value) for value in pair.split(':')) for pair in spec.split(',') if pair]
+
+
+def install(speed=1.0):
+    """
+    Puts the simulated modules first on the import path and installs the virtual clock.
+    :return: the simulated world
+    """
+    if SIM_DIR not in sys.path:
+        sys.path.insert(0, SIM_DIR)
+    from simworld import VirtualClock, world
+    VirtualClock(speed).install()
+    world.reset_clock()
+    return world
+
+
+def summary(world, real_elapsed):
+    counts = collections.Counter((device, action) for _, device, action, _ in world.log)
+    lines = ["Simulated {:.1f}s in {:.1f}s real time".format(world.elapsed(), real_elapsed),
+             "Directives: {}, events sent: {}".format(len(world.directives), len(world.events)),
+             "Display frames: {}, speech: {}, audio: {:.1f}s".format(
+                 world.frames, world.spoken, world.audio_bytes / float(world.audio_rate or 1))]
+    for (device, action), count in sorted(counts.items(), key=lambda item: str(item[0])):
+        lines.append("  {:8s} {:12s} {}".format(str(device), action, count))
+    for port, motor in sorted(world.motors.items()):
+        position, speed = motor.read()
+        lines.append("  motor {} at {:.0f} deg".format(port, position))
+    return '\n'.join(lines)
+
+
+def write_actuators(world, path):
+    """
+    Writes the actuator commands as JSON lines of [seconds since agt connected, device, action, details].
+    """
+    with open(path, 'w') as lines:
+        for t, device, action, details in world.log:
+            lines.write(json.dumps([round(t - world.connected_at, 4), device, action, details], default=str) + '\n')
+
+
+def execute(world, script, args=(), seed=None):
+    """
+    Runs a gadget script on the simulated hardware.
+    :param seed: if given, the seed of the random module, so random speeds and colors repeat
+    :return: the real time it took in seconds
+    """
+    script = os.path.abspath(script)
+    sys.path.insert(1, os.path.dirname(script))
+    os.chdir(os.path.dirname(script))
+
+    # Audio goes to a sink that plays in (virtual) real time and counts what it got
+    import audio
+
+    class _Sink(audio.NullSink):
+        def __init__(self, framerate, channels):
+            super().__init__(framerate, channels)
+            world.audio_rate = framerate * channels * 2
+
+        def write(self, data):
+            world.audio_bytes += len(data)
+            super().write(data)
+    audio.sink_factory = _Sink
+
+    if seed is not None:
+        random.seed(seed)
+    sys.argv = [script] + list(args)
+    start = time.perf_counter()
+    try:
+        runpy.run_path(script, run_name='__main__')
+    finally:
+        elapsed = time.perf_counter() - start
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--speed', type=float, default=1.0, help="virtual clock speed-up, default 1")
+    parser.add_argument('--directives', help="JSON lines file of directives to deliver")
+    parser.add_argument('--ir', default='60', help="IR proximity profile, a number or an expression of t")
+    parser.add_argument('--touch', default='', help="touch sensor presses as press:release,... in seconds")
+    parser.add_argument('--bpp', type=int, default=1, choices=(1, 16, 32),
+                        help="bits per pixel of the screen's framebuffer, 32 like ev3dev-stretch, default 1")
+    parser.add_argument('--linger', type=float, default=5.0, help="seconds to run after the last directive")
+    parser.add_argument('--seed', type=int, help="seed of the random module")
+    parser.add_argument('--actuators', help="write the actuator commands to this JSON lines file")
+    parser.add_argument('script', help="the gadget script, e.g. new.py")
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+    options = parser.parse_args()
+
+    world = install(options.speed)
+    world.ir_profile = ir_profile(options.ir)
+    world.touch_profile = touch_profile(options.touch)
+    world.bits_per_pixel = options.bpp
+    world.linger = options.linger
+    if options.directives:
+        world.directive_source = load_directives(options.directives)
+
+    actuators = os.path.abspath(options.actuators) if options.actuators else None
+    start = time.perf_counter()
+    try:
+        execute(world, options.script, options.args, options.seed)
+    finally:
+        print(summary(world, time.perf_counter() - start), file=sys.stderr)
+        if actuators:
+            write_actuators(world, actuators)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""
+Shared state of the simulated EV3 brick: the virtual clock, the motors, sensors,
+LEDs, display and speaker, and the log of every actuator command.
+
+The simulated ev3dev2 and agt modules all act on the single ``world`` object.
+"""
+
+import collections
+import math
+import threading
+import time
+
+_real_monotonic = time.monotonic
+_real_time = time.time
+_real_sleep = time.sleep
+
+
+class VirtualClock:
+    """
+    A clock running ``speed`` times faster than real time.
+    Installing it patches time.sleep, time.monotonic, time.time and the timeouts of
+    threading waits, so sleep- and timeout-driven code runs faster without changes.
+    time.perf_counter and the CPU clocks are left alone.
+    """
+
+    def __init__(self, speed=1.0):
+        self.speed = float(speed)
+        self._real_start = _real_monotonic()
+        self._start = self._real_start
+        self._wall_start = _real_time()
+
+    def monotonic(self):
+        return self._start + (_real_monotonic() - self._real_start) * self.speed
+
+    def time(self):
+        return self._wall_start + (_real_monotonic() - self._real_start) * self.speed
+
+    def sleep(self, seconds):
+        _real_sleep(max(0.0, seconds) / self.speed)
+
+    def install(self):
+        time.monotonic = self.monotonic
+        time.time = self.time
+        time.sleep = self.sleep
+        # Condition.wait_for and friends take the time from here
+        threading._time = self.monotonic
+        wait = threading.Condition.wait
+        speed = self.speed
+
+        def scaled_wait(condition, timeout=None):
+            return wait(condition, None if timeout is None else max(0.0, timeout) / speed)
+        threading.Condition.wait = scaled_wait
+
+
+class MotorState:
+    """
+    Kinematics of one motor: the speed ramps to the commanded speed with limited
+    acceleration and the position is integrated lazily whenever it is read.
+    """
+
+    def __init__(self, port, max_speed, acceleration=6000.0):
+        self.port = port
+        self.max_speed = max_speed
+        self.acceleration = acceleration
+        self.speed = 0.0
+        self.target = 0.0
+        self.position = 0.0
+        self.stop_action = 'coast'
+        self.ends_at = None
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def run(self, speed, duration=None):
+        with self.lock:
+            self._update(time.monotonic())
+            self.target = max(-self.max_speed, min(self.max_speed, float(speed)))
+            self.ends_at = None if duration is None else self.updated_at + duration
+
+    def stop(self, stop_action=None):
+        with self.lock:
+            self._update(time.monotonic())
+            self._stop(stop_action or self.stop_action)
+
+    def read(self):
+        """
+        Returns the current (position in degrees, speed in deg/s).
+        """
+        with self.lock:
+            self._update(time.monotonic())
+            return self.position, self.speed
+
+    @property
+    def running(self):
+        with self.lock:
+            self._update(time.monotonic())
+            return self.target != 0 or self.speed != 0
+
+    def _stop(self, stop_action):
+        self.target = 0.0
+        self.ends_at = None
+        if stop_action in ('brake', 'hold'):
+            self.speed = 0.0
+
+    def _update(self, now):
+        if self.ends_at is not None and self.ends_at <= now:
+            self._integrate(self.ends_at)
+            self._stop(self.stop_action)
+        self._integrate(now)
+
+    def _integrate(self, now):
+        dt = now - self.updated_at
+        if dt <= 0:
+            return
+        # Accelerate towards the target, then hold it
+        gap = self.target - self.speed
+        ramp = min(dt, abs(gap) / self.acceleration)
+        end_speed = self.speed + math.copysign(self.acceleration * ramp, gap)
+        self.position += (self.speed + end_speed) / 2.0 * ramp + self.target * (dt - ramp)
+        self.speed = self.target if ramp < dt else end_speed
+        self.updated_at = now
+
+
+class World:
+    """
+    Everything the simulated hardware knows about.
+    """
+
+    def __init__(self):
+        self.motors = {}
+        self.leds = {}
+        self.frames = 0
+        self.framebuffer = None
+        # The screen's framebuffer format: 1 bit per pixel like ev3dev-jessie, or 32 like ev3dev-stretch
+        self.bits_per_pixel = 1
+        self.spoken = []
+        self.audio_bytes = 0
+        self.audio_rate = None
+        # Actuator commands as (time, device, action, details)
+        self.log = collections.deque(maxlen=100000)
+        # Directives delivered to the gadget and events it sent, as (time, namespace, name, payload)
+        self.directives = []
+        self.events = []
+        # The directives agt delivers: dicts with 'at' (seconds since start), 'namespace', 'name', 'payload'
+        self.directive_source = []
+        # Seconds to keep running after the last directive
+        self.linger = 5.0
+        self.started_at = time.monotonic()
+        # Seconds since start when agt connected, the origin of actuator logs
+        self.connected_at = 0.0
+        # Proximity 0 (close) to 100 (far) as a function of seconds since start
+        self.ir_profile = lambda t: 60
+        # (press, release) times in seconds since start
+        self.touch_profile = []
+        self.listeners = []
+
+    def reset_clock(self):
+        self.started_at = time.monotonic()
+
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    def motor(self, port, max_speed):
+        state = self.motors.get(port)
+        if state is None:
+            state = self.motors[port] = MotorState(port, max_speed)
+        return state
+
+    def record(self, device, action, **details):
+        entry = (self.elapsed(), device, action, details)
+        self.log.append(entry)
+        for listener in self.listeners:
+            listener(entry)
+
+    def proximity(self):
+        return int(max(0, min(100, self.ir_profile(self.elapsed()))))
+
+    def pressed(self):
+        t = self.elapsed()
+        return any(press <= t < release for press, release in self.touch_profile)
+
+
+world = World()
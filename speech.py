@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Speech render cache for the Mindstorms puppy gadget.
+
+Sound.speak runs espeak and pipes it into aplay every time, which takes
+seconds on the brick. A phrase is rendered with espeak once into a WAV file
+and played from it afterwards through the AudioEngine. The files are content
+addressed: the file name is a hash of the text, voice, speed and volume, so a
+changed phrase or voice is a new entry and never a stale one. The cache
+directory is bounded by a size budget, the least recently spoken phrases are
+removed first. Recency is the modification time of the files, so it survives
+restarts, and ``index.json`` keeps what each phrase cost to render, which is
+the latency a hit saves.
+
+The phrases the gadget says are rendered at install time::
+
+    python3 speech.py warm phrases.txt
+    python3 speech.py show
+    python3 speech.py bench
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+from commands import _Timing
+
+logger = logging.getLogger(__name__)
+
+ESPEAK = 'espeak'
+# The espeak defaults of ev3dev2's Sound.speak: '-a 200 -s 130' and the default voice
+VOICE = 'en'
+SPEED = 130
+VOLUME = 200
+# Directory the rendered phrases are kept in
+DIRECTORY = 'speech'
+# Size cap of the rendered phrases in bytes, a second of espeak output is about 44 kB
+BUDGET = 4 * 1024 * 1024
+INDEX = 'index.json'
+
+
+def render(text, path, voice=VOICE, speed=SPEED, volume=VOLUME):
+    """
+    Speaks a text into a WAV file with espeak.
+    """
+    tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+    subprocess.run([ESPEAK, '-v', voice, '-s', str(speed), '-a', str(volume), '-w', tmp, text], check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    os.replace(tmp, path)
+
+
+def key(text, voice=VOICE, speed=SPEED, volume=VOLUME):
+    """
+    Returns the file name of a phrase spoken with the given espeak voice, speed and volume.
+    """
+    return hashlib.sha1('\0'.join((voice, str(speed), str(volume), text)).encode('utf-8')).hexdigest()[:16] + '.wav'
+
+
+class SpeechCache:
+    """
+    On-disk LRU cache of phrases rendered by espeak, bounded by a size budget in bytes.
+    """
+
+    def __init__(self, directory=DIRECTORY, budget=BUDGET, voice=VOICE, speed=SPEED, volume=VOLUME, renderer=render):
+        """
+        :param directory: the directory the WAV files are kept in
+        :param budget: the size cap of the WAV files in bytes, the phrase spoken last is always kept
+        :param voice: the default espeak voice
+        :param speed: the default espeak speed in words per minute
+        :param volume: the default espeak amplitude
+        :param renderer: called with (text, path, voice, speed, volume) to render a phrase, espeak by default
+        """
+        self.directory = directory
+        self.budget = budget
+        self.voice = voice
+        self.speed = speed
+        self.volume = volume
+        self.renderer = renderer
+        self.resident = 0
+        self.hits = 0
+        self.misses = 0
+        self.unavailable = 0
+        self.evictions = 0
+        # The render time the hits did not spend, less the time the lookups took
+        self.saved = 0.0
+        self.render_time = _Timing()
+        self.lookup_time = _Timing()
+        # File name -> size, least recently used first
+        self._entries = collections.OrderedDict()
+        # File name -> {'text', 'render'}, persisted in the index file
+        self._index = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def get(self, text, voice=None, speed=None, volume=None):
+        """
+        Returns a WAV file of the text spoken, rendered the first time.
+        :return: the path of the WAV file, or None if it has not been rendered and the renderer is not available
+        """
+        voice, speed, volume = voice or self.voice, speed or self.speed, volume or self.volume
+        name = key(text, voice, speed, volume)
+        path = os.path.join(self.directory, name)
+        start = time.monotonic()
+        with self._lock:
+            hit = name in self._entries and os.path.exists(path)
+            if hit:
+                self._entries.move_to_end(name)
+                self.hits += 1
+                elapsed = time.monotonic() - start
+                self.lookup_time.add(elapsed)
+                self.saved += self._index.get(name, {}).get('render', self._average_render()) - elapsed
+            else:
+                self.misses += 1
+        if hit:
+            # The modification time keeps the recency for the next start
+            os.utime(path)
+            return path
+
+        if self.renderer is render and shutil.which(ESPEAK) is None:
+            with self._lock:
+                self.unavailable += 1
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        start = time.monotonic()
+        self.renderer(text, path, voice, speed, volume)
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self.render_time.add(elapsed)
+            self.resident += os.path.getsize(path) - self._entries.get(name, 0)
+            self._entries[name] = os.path.getsize(path)
+            self._entries.move_to_end(name)
+            self._index[name] = {'text': text, 'render': elapsed}
+            self._evict()
+            self._save()
+        return path
+
+    def warm(self, phrases, voice=None, speed=None, volume=None):
+        """
+        Renders the phrases not rendered yet.
+        :return: the paths of the WAV files, None for those that could not be rendered
+        """
+        return [self.get(text, voice, speed, volume) for text in phrases]
+
+    def entries(self):
+        """
+        Returns (file name, size, render seconds, text) of every phrase, least recently used first.
+        """
+        with self._lock:
+            return [(name, size, self._index.get(name, {}).get('render'), self._index.get(name, {}).get('text'))
+                    for name, size in self._entries.items()]
+
+    def stats(self):
+        """
+        Returns the hit rate and the render time the hits saved, besides the size and the counters.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'resident': self.resident,
+            'budget': self.budget,
+            'hits': self.hits,
+            'misses': self.misses,
+            'unavailable': self.unavailable,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'latency_saved': self.saved,
+            'render_time': self.render_time.as_dict(),
+            'lookup_time': self.lookup_time.as_dict(),
+        }
+
+    def _average_render(self):
+        renders = [entry['render'] for entry in self._index.values()]
+        return sum(renders) / len(renders) if renders else 0.0
+
+    def _load(self):
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith('.wav')]
+        except FileNotFoundError:
+            return
+        files = [(os.stat(os.path.join(self.directory, name)), name) for name in names]
+        for stat, name in sorted(files, key=lambda file: file[0].st_mtime):
+            self._entries[name] = stat.st_size
+            self.resident += stat.st_size
+        try:
+            with open(os.path.join(self.directory, INDEX)) as index:
+                self._index = {name: entry for name, entry in json.load(index).items() if name in self._entries}
+        except (OSError, ValueError):
+            logger.info("No speech cache index in {}, the render times of its phrases are not known".format(
+                self.directory))
+        with self._lock:
+            if self._evict():
+                self._save()
+
+    def _evict(self):
+        evicted = False
+        while self.resident > self.budget and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._index.pop(name, None)
+            self.resident -= size
+            self.evictions += 1
+            evicted = True
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+        return evicted
+
+    def _save(self):
+        path = os.path.join(self.directory, INDEX)
+        with open(path + '.tmp', 'w') as index:
+            json.dump(self._index, index)
+        os.replace(path + '.tmp', path)
+
+
+def read_phrases(path):
+    """
+    Returns the phrases of a phrase list, one per line. Blank lines and lines starting with # are skipped.
+    """
+    with open(path) as phrases:
+        return [line.strip() for line in phrases if line.strip() and not line.lstrip().startswith('#')]
+
+
+# Seconds the stand-in renderer takes per character, about what espeak takes on the brick
+STAND_IN_RENDER = 0.02
+
+
+def _stand_in(text, path, voice, speed, volume):
+    """
+    Renders silence as long as espeak would speak the text, taking as long as espeak does on the brick.
+    """
+    import wave
+
+    seconds = len(text) * 0.065
+    time.sleep(len(text) * STAND_IN_RENDER)
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(22050)
+        wav.writeframes(bytes(int(seconds * 22050) * 2))
+
+
+if __name__ == '__main__':
+    import bisect
+    import itertools
+    import random
+    import sys
+    import tempfile
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ('warm', 'show', 'bench'):
+        print(__doc__)
+        sys.exit(1)
+
+    if sys.argv[1] == 'warm':
+        cache = SpeechCache()
+        for text in read_phrases(sys.argv[2] if len(sys.argv) > 2 else 'phrases.txt'):
+            start = time.monotonic()
+            path = cache.get(text)
+            print("{:7.1f} ms  {}  {}".format((time.monotonic() - start) * 1000,
+                                               path or 'espeak is not installed', text))
+        print(cache.stats())
+
+    elif sys.argv[1] == 'show':
+        cache = SpeechCache()
+        for name, size, seconds, text in cache.entries():
+            print("{}  {:7d} B  {:>9s}  {}".format(name, size, '?' if seconds is None else
+                                                   '{:.0f} ms'.format(seconds * 1000), text or ''))
+        print("{} of {} bytes".format(cache.resident, cache.budget))
+
+    else:
+        # A day of spoken responses: a few phrases are said most of the time, following Zipf's law, and the
+        # budget holds about half of them
+        renderer = render
+        if shutil.which(ESPEAK) is None:
+            print("espeak is not installed, phrases are rendered by a stand-in taking {:.0f} ms per character".format(
+                STAND_IN_RENDER * 1000))
+            renderer = _stand_in
+        phrases = ["Phrase number {}, said by the puppy.".format(i) for i in range(24)]
+        weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(phrases))))
+        rng = random.Random(0)
+        # random.choices is not there on the brick's Python 3.5
+        said = [phrases[bisect.bisect(weights, rng.random() * weights[-1])] for _ in range(120)]
+        with tempfile.TemporaryDirectory() as directory:
+            cache = SpeechCache(directory, budget=12 * 2 * 22050 * 2, renderer=renderer)
+            cache.warm(phrases[:6])
+            warmed = cache.stats()
+            start = time.monotonic()
+            for text in said:
+                cache.get(text)
+            elapsed = time.monotonic() - start
+        stats = cache.stats()
+        hits, misses = stats['hits'] - warmed['hits'], stats['misses'] - warmed['misses']
+        print("{} phrases said, {} hits and {} misses, hit rate {:.0%}, {} evictions".format(
+            len(said), hits, misses, hits / len(said), stats['evictions']))
+        print("{:.1f} s spent, rendering every time would have taken {:.1f} s: {:.1f} s saved".format(
+            elapsed, elapsed + stats['latency_saved'], stats['latency_saved']))
+        print("render {:.0f} ms avg, lookup {:.3f} ms avg".format(
+            stats['render_time']['avg'] * 1000, stats['lookup_time']['avg'] * 1000))
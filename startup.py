@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Startup pipeline of the Mindstorms puppy gadget.
+
+Only what pairing needs runs before the gadget becomes connectable. Device
+discovery, the display and its PIL import, the sound assets, the greeting and
+the console font are startup steps running on their own threads, concurrently.
+Code that needs a step's result asks for it and waits only if the step has not
+finished yet, so nothing is used half initialized. Every phase and step is
+timed from the start of the process, and the report breaks the time to
+connectable down by phase::
+
+    Startup: connectable at 1.84s
+      imports            0.000s   +0.912s  MainThread
+      agt                0.912s   +0.201s  MainThread
+      ...
+"""
+
+import contextlib
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def process_age():
+    """
+    Returns the seconds since this process started, from /proc, or 0 where /proc is not available.
+    """
+    try:
+        with open('/proc/self/stat') as stat:
+            # The command name can contain spaces, the fields after it cannot
+            fields = stat.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as uptime:
+            now = float(uptime.read().split()[0])
+        return max(0.0, now - int(fields[19]) / float(os.sysconf('SC_CLK_TCK')))
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+class Step:
+    """
+    A startup step running on its own thread.
+    """
+
+    def __init__(self, name, function, args):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.started = None
+        self.finished = None
+        self._value = None
+        self._error = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def succeeded(self):
+        return self._done.is_set() and self._error is None
+
+    def result(self):
+        """
+        Returns the step's result, waiting for the step to finish. Raises the step's exception if it failed.
+        """
+        if not self._done.is_set():
+            self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def then(self, callback):
+        """
+        Calls ``callback(result)`` once the step succeeded, right away if it already has.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        if self._error is None:
+            callback(self._value)
+
+    def _run(self, clock):
+        self.started = clock()
+        try:
+            self._value = self.function(*self.args)
+        except Exception as error:
+            self._error = error
+            logger.exception("Startup step {} failed".format(self.name))
+        self.finished = clock()
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        if self._error is None:
+            for callback in callbacks:
+                callback(self._value)
+
+
+class Startup:
+    """
+    Times the startup phases and runs the startup steps.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        """
+        :param clock: the monotonic clock phases are timed on
+        """
+        self.clock = clock
+        # Times are kept relative to the start of the process, so the interpreter and the imports count too
+        self.origin = clock() - process_age()
+        self.phases = [('imports', 0.0, self.clock() - self.origin, 'MainThread')]
+        self.steps = {}
+        self.marks = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Times a block of the startup sequence run on the calling thread.
+        """
+        start = self.clock() - self.origin
+        try:
+            yield
+        finally:
+            self.phases.append((name, start, self.clock() - self.origin, threading.current_thread().name))
+
+    def background(self, name, function, *args):
+        """
+        Starts a step on its own thread.
+        :return: the Step, also available as ``steps[name]``
+        """
+        step = Step(name, function, args)
+        self.steps[name] = step
+        threading.Thread(target=step._run, args=(lambda: self.clock() - self.origin,),
+                         name="startup-" + name, daemon=True).start()
+        return step
+
+    def result(self, name):
+        """
+        Returns the result of a step, waiting for it to finish.
+        """
+        return self.steps[name].result()
+
+    def mark(self, name):
+        """
+        Records the time a milestone was reached, e.g. 'connectable'.
+        """
+        self.marks[name] = self.clock() - self.origin
+
+    def wait(self):
+        """
+        Waits for every step to finish.
+        """
+        for step in list(self.steps.values()):
+            step._done.wait()
+
+    def stats(self):
+        """
+        Returns the milestones and the (start, end) of every phase and finished step in seconds since the process
+        started.
+        """
+        timings = {name: (start, end) for name, start, end, _ in self.phases}
+        timings.update((name, (step.started, step.finished)) for name, step in self.steps.items() if step.done())
+        return {'marks': dict(self.marks), 'timings': timings}
+
+    def report(self):
+        """
+        Returns the startup report: the milestones, then every phase and step with its start, duration and thread,
+        in order of start. Steps still running are listed as such.
+        """
+        rows = [(start, name, end - start, thread) for name, start, end, thread in self.phases]
+        for name, step in self.steps.items():
+            if step.done():
+                rows.append((step.started, name, step.finished - step.started, 'startup-' + name))
+            else:
+                rows.append((step.started or 0.0, name, None, 'startup-' + name))
+        lines = ["Startup: " + ', '.join("{} at {:.2f}s".format(name, at) for name, at in sorted(
+            self.marks.items(), key=lambda mark: mark[1]))]
+        for start, name, duration, thread in sorted(rows, key=lambda row: row[0]):
+            lines.append("  {:16s} {:7.3f}s  {:>8s}  {}".format(
+                name, start, 'running' if duration is None else '+{:.3f}s'.format(duration), thread))
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    # Start like the gadget did before, one step after the other, and through the pipeline with the slow steps
+    # in the background. The steps only sleep, for illustrative times
+    steps = [('display', 1.9), ('sensors', 0.35), ('motors', 0.45), ('sounds', 0.6), ('greeting', 2.4),
+             ('setfont', 0.3)]
+
+    startup = Startup()
+    with startup.phase('agt'):
+        time.sleep(0.2)
+    with startup.phase('serial'):
+        for name, seconds in steps:
+            with startup.phase(name):
+                time.sleep(seconds)
+    startup.mark('connectable')
+    # Both runs are timed from the start of the process, compare them from the end of the imports phase
+    serial = startup.marks['connectable'] - startup.phases[0][2]
+
+    startup = Startup()
+    with startup.phase('agt'):
+        time.sleep(0.2)
+    for name, seconds in steps:
+        startup.background(name, time.sleep, seconds)
+    startup.mark('connectable')
+    startup.wait()
+    startup.mark('ready')
+    print(startup.report())
+    began = startup.phases[0][2]
+    print("Connectable after {:.2f}s in series, {:.2f}s through the pipeline, every step done after {:.2f}s".format(
+        serial, startup.marks['connectable'] - began, startup.marks['ready'] - began))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Persistent sysfs attribute handles for the Mindstorms puppy gadget.
+
+ev3dev exposes every motor setpoint, LED brightness and sensor value as a sysfs
+file. Attribute keeps one file descriptor open per attribute and reads or
+writes it at offset 0 with ``os.pread``/``os.pwrite``, so an access is a single
+system call with no open, seek, flush or per-call string encoding.
+"""
+
+import os
+
+
+class Attribute:
+    """
+    One open sysfs attribute file.
+    """
+
+    def __init__(self, path, writable=False, max_encodings=64):
+        """
+        :param path: the attribute file
+        :param writable: open for writing instead of reading, sysfs attributes are one or the other
+        :param max_encodings: the maximum number of encoded values kept
+        """
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY if writable else os.O_RDONLY)
+        self.max_encodings = max_encodings
+        self._encoded = {}
+
+    def write(self, value):
+        data = self._encoded.get(value)
+        if data is None:
+            data = str(value).encode('ascii')
+            if len(self._encoded) < self.max_encodings:
+                self._encoded[value] = data
+        os.pwrite(self.fd, data, 0)
+
+    def read(self):
+        return os.pread(self.fd, 4096, 0).decode('ascii').strip()
+
+    def read_int(self):
+        return int(os.pread(self.fd, 32, 0))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class AttributeCache:
+    """
+    Open attribute handles keyed by path, shared by everything that drives the same device.
+    """
+
+    def __init__(self):
+        self._attributes = {}
+
+    def get(self, device, name, writable=False):
+        """
+        Returns the open handle of a device attribute.
+        :param device: an ev3dev device object, or the sysfs directory of the device
+        :param name: the attribute name, e.g. 'speed_sp'
+        :param writable: open the attribute for writing
+        :return: the Attribute, or None if the device has no sysfs directory or the file cannot be opened
+        """
+        directory = device if isinstance(device, str) else getattr(device, '_path', None)
+        if directory is None:
+            return None
+        key = (os.path.join(directory, name), writable)
+        attribute = self._attributes.get(key)
+        if attribute is None:
+            try:
+                attribute = Attribute(key[0], writable)
+            except OSError:
+                return None
+            self._attributes[key] = attribute
+        return attribute
+
+    def __len__(self):
+        return len(self._attributes)
+
+    def close(self):
+        for attribute in self._attributes.values():
+            attribute.close()
+        self._attributes.clear()
+
+
+# The handles of the gadget's devices
+attributes = AttributeCache()
+
+
+class LedWriter:
+    """
+    Sets LED colors through open brightness handles. Drop-in for ``Leds.set_color``.
+    """
+
+    def __init__(self, leds, cache=attributes):
+        """
+        :param leds: the ev3dev2 Leds
+        :param cache: the AttributeCache the brightness handles are taken from
+        """
+        self.leds = leds
+        # (attribute, max brightness) of every LED of every group
+        self._groups = {}
+        for group, members in leds.led_groups.items():
+            handles = [(cache.get(led, 'brightness', writable=True), led) for led in members]
+            if all(handle is not None for handle, _ in handles):
+                self._groups[group] = [(handle, led.max_brightness) for handle, led in handles]
+        self.writes = 0
+
+    def __getattr__(self, name):
+        return getattr(self.leds, name)
+
+    def set_color(self, group, color, pct=1):
+        """
+        Sets the color of an LED group, with the group and color names of ``Leds.set_color``.
+        """
+        handles = self._groups.get(group)
+        if handles is None:
+            self.leds.set_color(group, color, pct)
+            return
+        values = self.leds.led_colors[color] if isinstance(color, str) else color
+        for (handle, max_brightness), value in zip(handles, values):
+            handle.write(int(round(max_brightness * value * pct)))
+            self.writes += 1
+
+
+class SensorValue:
+    """
+    Reads one value of a sensor in a fixed mode through an open handle.
+    """
+
+    def __init__(self, sensor, mode, index=0, cache=attributes):
+        """
+        :param sensor: the ev3dev2 sensor
+        :param mode: the sensor mode, set once here, e.g. 'IR-PROX' or 'TOUCH'
+        :param index: the value index, ``value<index>`` is read
+        :param cache: the AttributeCache the value handle is taken from
+        """
+        self.sensor = sensor
+        self.mode = mode
+        self.index = index
+        sensor.mode = mode
+        self._handle = cache.get(sensor, 'value{}'.format(index))
+
+    def read(self):
+        if self._handle is None:
+            return self.sensor.value(self.index)
+        return self._handle.read_int()
+
+
+if __name__ == '__main__':
+    # Microbenchmark of the hot attribute accesses against a tmpfs-backed fake sysfs tree
+    import sys
+    import tempfile
+    import timeit
+
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    root = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    paths = {}
+    for device, name, value in (('leds/led0:green:brick-status', 'brightness', '0'),
+                                ('tacho-motor/motor0', 'speed_sp', '0'),
+                                ('lego-sensor/sensor0', 'value0', '42')):
+        os.makedirs(os.path.join(root, device))
+        paths[name] = os.path.join(root, device, name)
+        with open(paths[name], 'w') as attribute:
+            attribute.write(value)
+
+    def _reopen_write(path, value):
+        # Worst case: the attribute is reopened for every access
+        with open(path, 'w') as attribute:
+            attribute.write(str(value))
+
+    def _reopen_read(path):
+        with open(path) as attribute:
+            return int(attribute.read())
+
+    # ev3dev2 style: a cached buffered file object, seeked, written and flushed per access
+    files = {name: open(path, 'r' if name == 'value0' else 'w') for name, path in paths.items()}
+
+    def _seek_write(attribute, value):
+        attribute.seek(0)
+        attribute.write(str(value))
+        attribute.flush()
+
+    def _seek_read(attribute):
+        attribute.seek(0)
+        return int(attribute.read())
+
+    cache = AttributeCache()
+    handles = {name: cache.get(os.path.dirname(path), name, writable=name != 'value0')
+               for name, path in paths.items()}
+
+    cases = [
+        ('LED brightness write', lambda: _reopen_write(paths['brightness'], 255),
+         lambda: _seek_write(files['brightness'], 255), lambda: handles['brightness'].write(255)),
+        ('motor speed_sp write', lambda: _reopen_write(paths['speed_sp'], 750),
+         lambda: _seek_write(files['speed_sp'], 750), lambda: handles['speed_sp'].write(750)),
+        ('IR value0 read', lambda: _reopen_read(paths['value0']),
+         lambda: _seek_read(files['value0']), lambda: handles['value0'].read_int()),
+    ]
+    print("{:22s} {:>12s} {:>12s} {:>12s}".format('ops/s', 'reopen', 'seek+flush', 'pread/pwrite'))
+    for label, *variants in cases:
+        rates = [rounds / timeit.timeit(variant, number=rounds) for variant in variants]
+        print("{:22s} {:12.0f} {:12.0f} {:12.0f}".format(label, *rates))
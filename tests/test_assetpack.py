@@ -0,0 +1,75 @@
+import math
+import os
+import struct
+import wave
+
+from assetpack import CODEC_ADPCM, CODEC_PCM, AssetPack, BlockCache, build
+
+
+def _tone(path, frames=10000, framerate=22050, channels=1, hz=440.0):
+    samples = [int(12000 * math.sin(2 * math.pi * hz * i / framerate)) for i in range(frames)]
+    with wave.open(str(path), 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(framerate)
+        wav.writeframes(struct.pack('<{}h'.format(frames * channels),
+                                    *[sample for sample in samples for _ in range(channels)]))
+    return samples
+
+
+def test_adpcm_round_trip(tmp_path):
+    samples = _tone(tmp_path / 'bark.wav', frames=10001)
+    build(str(tmp_path / 'sounds.pack'), [str(tmp_path / 'bark.wav')], codec=CODEC_ADPCM, block_frames=1024)
+    pack = AssetPack(str(tmp_path / 'sounds.pack'))
+    clip = pack.clips['bark']
+    assert (clip.framerate, clip.channels, clip.size) == (22050, 1, 2 * 10001)
+    decoded = struct.unpack('<10001h', clip.read(0, clip.size))
+    # IMA ADPCM follows a sine this slow within a few hundred of 16 bit full scale
+    assert max(abs(a - b) for a, b in zip(decoded[100:], samples[100:])) < 600
+    # A read across a block boundary is the same as the whole clip's slice
+    assert clip.read(2040, 20) == clip.read(0, clip.size)[2040:2060]
+    assert clip.read(clip.size - 4, 100) == clip.read(0, clip.size)[-4:]
+    pack.close()
+
+
+def test_pcm_pack_is_lossless_and_mono(tmp_path):
+    samples = _tone(tmp_path / 'music.wav', frames=5000, channels=2)
+    build(str(tmp_path / 'sounds.pack'), [str(tmp_path / 'music.wav')], codec=CODEC_PCM)
+    pack = AssetPack(str(tmp_path / 'sounds.pack'))
+    clip = pack.clips['music']
+    assert clip.channels == 1
+    assert list(struct.unpack('<5000h', clip.read(0, clip.size))) == samples
+    pack.close()
+
+
+def test_block_cache_evicts_least_recently_used():
+    cache = BlockCache(budget=300)
+    for key in 'abc':
+        cache.get(key, lambda: bytes(100))
+    cache.get('a', lambda: bytes(100))
+    cache.get('d', lambda: bytes(100))
+    assert list(cache._blocks) == ['c', 'a', 'd']
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions'], stats['resident']) == (1, 4, 1, 300)
+
+
+def test_pack_is_rebuilt_when_a_wav_changes(tmp_path):
+    wav, path = str(tmp_path / 'bark.wav'), str(tmp_path / 'sounds.pack')
+    _tone(wav, frames=4000, hz=440.0)
+    first = AssetPack.open_or_build(path, [wav])
+    size = first.clips['bark'].size
+    first.close()
+    # Same size, other content, and a pack file that looks newer than the WAV
+    _tone(wav, frames=4000, hz=880.0)
+    os.utime(path, (os.path.getmtime(wav) + 60,) * 2)
+    built = os.path.getmtime(path)
+    second = AssetPack.open_or_build(path, [wav])
+    assert second.clips['bark'].size == size
+    assert os.path.getmtime(path) != built
+    # Unchanged WAVs keep the pack
+    key, built = second.key, os.path.getmtime(path)
+    second.close()
+    third = AssetPack.open_or_build(path, [wav])
+    assert third.key == key
+    assert os.path.getmtime(path) == built
+    third.close()
@@ -0,0 +1,97 @@
+import os
+import stat
+import struct
+import threading
+
+import pytest
+
+import audio
+from audio import AplaySink, AudioEngine, Clip, NullSink, mix
+
+
+def _pcm(*samples):
+    return struct.pack('<{}h'.format(len(samples)), *samples)
+
+
+def _clip(name, value, frames=2048):
+    return Clip(name, _pcm(*[value] * frames), 22050, 1)
+
+
+@pytest.fixture(params=['numpy', 'audioop'])
+def mixer(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(audio, 'numpy', None)
+    return request.param
+
+
+def test_mix_sums_with_saturation(mixer):
+    chunk = mix([(_pcm(1000, -1000, 30000, -30000), 1.0), (_pcm(500, 500, 30000, -30000), 1.0)], 8)
+    assert struct.unpack('<4h', chunk) == (1500, -500, 32767, -32768)
+
+
+def test_mix_pads_short_chunks_and_applies_gain(mixer):
+    chunk = mix([(_pcm(1000, 1000, 1000, 1000), 0.5), (_pcm(2000), 1.0)], 8)
+    assert struct.unpack('<4h', chunk) == (2500, 500, 500, 500)
+    assert mix([], 8) == bytes(8)
+
+
+def _engine(**options):
+    return AudioEngine(framerate=22050, channels=1, sink=NullSink(22050, 1, realtime=False), **options)
+
+
+def test_overlapping_clips_are_mixed():
+    sink = NullSink(22050, 1, realtime=False)
+    written = []
+    sink.write = written.append
+    engine = AudioEngine(framerate=22050, channels=1, sink=sink, chunk_frames=512)
+    engine.add(_clip('music', 100))
+    engine.add(_clip('bark', 200))
+    with engine._cond:
+        music = engine.play('music')
+        engine.play('bark')
+    assert music.wait(2.0)
+    engine.close()
+    assert set(struct.unpack('<512h', written[0])) == {300}
+
+
+def test_cancelled_clip_calls_on_done():
+    engine = _engine(chunk_frames=64)
+    engine.add(_clip('coffin_dance', 100, frames=22050 * 60))
+    finished = threading.Event()
+    done = engine.play('coffin_dance', on_done=finished.set)
+    engine.stop('coffin_dance')
+    assert done.is_set()
+    assert finished.wait(2.0)
+    assert engine.stats()['cancelled'] == 1
+    engine.close()
+
+
+def test_oldest_voice_makes_way_and_is_done():
+    engine = _engine(max_voices=2)
+    engine.add(_clip('song', 100, frames=22050 * 60))
+    calls = []
+    with engine._cond:
+        first = engine.play('song', on_done=lambda: calls.append('first'))
+        engine.play('song', on_done=lambda: calls.append('second'))
+        engine.play('song', on_done=lambda: calls.append('third'))
+    assert first.is_set()
+    engine.close()
+    # Closing cancels the other two, every voice gets its callback once
+    assert sorted(calls) == ['first', 'second', 'third']
+
+
+def test_aplay_is_restarted_after_it_exits(tmp_path, monkeypatch):
+    # A stand-in aplay that takes a little audio and exits, like one losing its sound card
+    aplay = tmp_path / 'aplay'
+    aplay.write_text("#!/bin/sh\nhead -c 4096 > /dev/null\n")
+    aplay.chmod(aplay.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', str(tmp_path) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setattr(audio, 'APLAY_RESTART_DELAY', 0.0)
+
+    sink = AplaySink(22050, 1, pipe_size=4096)
+    for _ in range(64):
+        sink.write(bytes(1024))
+    assert sink.restarts >= 1
+    sink.close()
@@ -0,0 +1,66 @@
+import array
+import math
+import wave
+
+import pytest
+
+import beats
+from beats import BeatIndex, analyse, index_path, load_for
+
+RATE = 22050
+
+
+def _click_track(path, bpm, seconds=8.0, first=0.37):
+    click = [int(12000 * math.sin(2 * math.pi * 1000 * i / RATE) * math.exp(-i / 200.0)) for i in range(800)]
+    samples = array.array('h', bytes(2 * int(RATE * seconds)))
+    t = first
+    while t < seconds - 0.1:
+        start = int(t * RATE)
+        samples[start:start + len(click)] = array.array('h', click)
+        t += 60.0 / bpm
+    with wave.open(str(path), 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(RATE)
+        wav.writeframes(samples.tobytes())
+
+
+@pytest.fixture(params=['numpy', 'plain'])
+def analysis(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(beats, 'numpy', None)
+    return request.param
+
+
+@pytest.mark.parametrize('bpm', [100, 126])
+def test_click_track_tempo_and_beats(tmp_path, analysis, bpm):
+    _click_track(tmp_path / 'click.wav', bpm)
+    index = analyse(str(tmp_path / 'click.wav'))
+    assert abs(index.bpm - bpm) < 1.5
+    period = 60.0 / bpm
+    for beat in index.beats:
+        phase = (beat - 0.37) / period
+        assert abs(phase - round(phase)) * period < 0.03
+    assert len(index.onsets) >= len(index.beats) - 1
+
+
+def test_index_round_trip_and_staleness(tmp_path):
+    wav = tmp_path / 'song.wav'
+    _click_track(wav, 120, seconds=4.0)
+    assert load_for(str(wav)) is None
+    BeatIndex(120.0, [0.37, 0.87], [0.37, 0.87, 1.37]).save(index_path(str(wav)), str(wav))
+    index = load_for(str(wav), verify=True)
+    assert index.bpm == 120.0
+    assert list(index.beats) == pytest.approx([0.37, 0.87])
+    assert list(index.onsets) == pytest.approx([0.37, 0.87, 1.37])
+
+    # The same size with other samples is only caught by the CRC-32
+    with open(str(wav), 'r+b') as changed:
+        changed.seek(-2, 2)
+        changed.write(b'\x01\x00')
+    assert load_for(str(wav)) is not None
+    assert load_for(str(wav), verify=True) is None
+    _click_track(wav, 120, seconds=5.0)
+    assert load_for(str(wav)) is None
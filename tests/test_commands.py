@@ -0,0 +1,88 @@
+import threading
+
+from commands import AliasIndex, Command, CommandExecutor, Direction, PRIORITY_MOVE, PRIORITY_STOP, normalize
+
+
+def test_aliases_resolve_exactly_and_normalized():
+    index = AliasIndex(Direction, Command)
+    assert index.lookup('forward') is Direction.FORWARD
+    assert index.lookup('  Go   LEFT ') is Direction.LEFT
+    assert index.lookup('komm') is Command.COME
+    assert 'brake' in index
+    assert index.misses == 0
+    assert index.lookup(['stop']) is None
+    assert normalize(' Dance  For me') == 'dance for me'
+
+
+def test_fuzzy_lookup_obeys_the_cutoff():
+    index = AliasIndex(Direction, Command)
+    assert index.lookup('sitt') is Command.SIT
+    assert index.lookup('dance for mee') is Command.DANCE
+    assert index.lookup('xylophone') is None
+    # A strict cutoff rejects the near miss the default one accepts
+    assert AliasIndex(Direction, Command, cutoff=0.95).lookup('sitt') is None
+    # Fuzzy results, matches and misses, are cached
+    misses = index.misses
+    assert index.lookup('SITT') is Command.SIT
+    assert index.lookup('xylophone') is None
+    assert index.misses == misses
+
+
+def test_fuzzy_cache_is_bounded():
+    index = AliasIndex(Direction, cache_size=4)
+    for i in range(10):
+        index.lookup('nowhere {}'.format(i))
+    assert len(index._fuzzy) <= 4
+
+
+def test_commands_run_in_priority_then_submission_order():
+    ran, gate = [], threading.Event()
+    executor = CommandExecutor()
+    executor.submit(gate.wait, 2.0, label='blocker')
+    executor.start()
+    try:
+        executor.submit(ran.append, 'command 1')
+        executor.submit(ran.append, 'move', priority=PRIORITY_MOVE)
+        executor.submit(ran.append, 'command 2')
+        executor.submit(ran.append, 'stop', priority=PRIORITY_STOP)
+        gate.set()
+        done = threading.Event()
+        executor.submit(done.set)
+        assert done.wait(2.0)
+    finally:
+        executor.stop()
+    assert ran == ['stop', 'move', 'command 1', 'command 2']
+
+
+def test_full_queue_drops_commands():
+    executor = CommandExecutor(maxsize=2)
+    assert executor.submit(print)
+    assert executor.submit(print)
+    assert not executor.submit(print)
+    assert executor.stats()['dropped'] == 1
+
+
+def test_preempt_drops_pending_and_cancels_running():
+    started, ran = threading.Event(), []
+
+    def long_move():
+        started.set()
+        # A blocking move waits on the cancel event instead of sleeping
+        ran.append(executor.cancel.wait(5.0))
+
+    executor = CommandExecutor()
+    executor.start()
+    try:
+        executor.submit(long_move)
+        assert started.wait(2.0)
+        executor.submit(ran.append, 'pending')
+        assert executor.preempt(lambda: 'stopped') == 'stopped'
+        stats = executor.stats()
+        assert (stats['preempted'], stats['cancelled']) == (1, 1)
+        # The next command runs with the cancel cleared
+        done = threading.Event()
+        executor.submit(lambda: ran.append(executor.cancel.is_set()) or done.set())
+        assert done.wait(2.0)
+    finally:
+        executor.stop()
+    assert ran == [True, False]
@@ -0,0 +1,37 @@
+from control import HeelController
+
+
+class _Wheels:
+    def __init__(self):
+        self.speeds = []
+
+    def run_forever(self, left, right):
+        self.speeds.append(left)
+
+    def stop(self, stop_action=None):
+        self.speeds.append(0)
+
+
+def _controller(wheels):
+    return HeelController(None, wheels, target=42, deadband=7, hysteresis=4, min_hold=0.5)
+
+
+def test_stop_within_min_hold_is_not_held():
+    wheels = _Wheels()
+    heel = _controller(wheels)
+    heel.update(80, 0.0)
+    assert heel.speed > 0
+    # The target is reached 0.1 s after the puppy started to move
+    heel.update(42, 0.1)
+    assert heel.speed == 0
+    assert wheels.speeds[-1] == 0
+
+
+def test_reversing_within_min_hold_is_held():
+    wheels = _Wheels()
+    heel = _controller(wheels)
+    heel.update(80, 0.0)
+    heel.update(10, 0.1)
+    assert heel.speed > 0
+    heel.update(10, 0.6)
+    assert heel.speed < 0
@@ -0,0 +1,61 @@
+from dance import DanceEngine
+
+
+class _Clock:
+    now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def _dance(engine, clock, until, cost=0.0, directives=None):
+    """
+    Runs the engine's task like the scheduler would, each step taking ``cost`` seconds.
+    :param directives: callables keyed by the number of steps after which they are called
+    """
+    steps = []
+
+    def step(beat):
+        steps.append((beat, round(clock.now, 6)))
+        clock.now += cost
+        if directives and len(steps) in directives:
+            directives.pop(len(steps))()
+
+    engine.step = step
+    task = engine.task()
+    while clock.now < until:
+        clock.now += next(task)
+    return steps
+
+
+def test_steps_stay_on_the_grid_whatever_they_cost():
+    clock = _Clock()
+    engine = DanceEngine(None, bpm=120, clock=clock)
+    steps = _dance(engine, clock, 102.9, cost=0.1)
+    assert steps == [(beat, 100.0 + beat * 0.5) for beat in range(6)]
+    assert engine.stats()['phase_error']['max'] == 0.0
+
+
+def test_tempo_change_re_anchors_the_grid():
+    clock = _Clock()
+    engine = DanceEngine(None, bpm=60, clock=clock)
+    steps = _dance(engine, clock, 103.4, directives={2: lambda: engine.set_tempo(120, start=102.25)})
+    assert [time for _, time in steps] == [100.0, 101.0, 102.0, 102.25, 102.75, 103.25]
+    assert engine.stats()['bpm'] == 120
+
+
+def test_late_beats_are_skipped():
+    clock = _Clock()
+    engine = DanceEngine(None, bpm=60, clock=clock)
+    steps = _dance(engine, clock, 103.5, cost=1.7)
+    assert [beat for beat, _ in steps] == [0, 2]
+    # Beat 3 is missed by the second step too
+    assert engine.stats()['skipped'] == 2
+
+
+def test_clip_beats_are_followed_then_extended_at_its_tempo():
+    clock = _Clock()
+    engine = DanceEngine(None, bpm=60, clock=clock)
+    engine.set_beats([0.2, 0.7, 1.3], bpm=100, start=100.0)
+    steps = _dance(engine, clock, 102.0)
+    assert [time for _, time in steps] == [100.2, 100.7, 101.3, 101.9]
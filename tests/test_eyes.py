@@ -0,0 +1,80 @@
+import os
+import random
+
+import pytest
+
+from eyes import EXPRESSIONS, EYES, EyeAnimator, EyeFrames, screen_geometry
+
+SIM = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sim')
+
+BLACK, WHITE = bytes(4), (0x00FFFFFF).to_bytes(4, 'little')
+
+
+@pytest.fixture
+def screen(monkeypatch):
+    # The simulated EV3 screen with the 32 bits per pixel XRGB framebuffer of ev3dev-stretch
+    monkeypatch.syspath_prepend(SIM)
+    from simworld import world
+    from ev3dev2.display import Display
+
+    monkeypatch.setattr(world, 'bits_per_pixel', 32)
+    monkeypatch.setattr(world, 'framebuffer', None)
+    display = Display()
+    yield display
+    display.mmap.close()
+    os.remove(world.framebuffer)
+
+
+def _pixel(frame, line_length, x, y):
+    return frame[y * line_length + 4 * x:y * line_length + 4 * x + 4]
+
+
+def test_frames_at_32_bits_per_pixel(screen):
+    xres, yres, line_length, bits_per_pixel = screen_geometry(screen)
+    assert (xres, yres, line_length, bits_per_pixel) == (178, 128, 712, 32)
+    frames = EyeFrames.build(xres, yres, line_length, bits_per_pixel)
+    animator = EyeAnimator(screen, frames)
+    animator.show('open')
+
+    shown = bytes(screen.mmap[:])
+    assert shown == frames.frames['open']
+    x0, y0, x1, y1 = EYES[0]
+    assert _pixel(shown, line_length, (x0 + x1) // 2, (y0 + y1) // 2) == BLACK
+    assert _pixel(shown, line_length, 0, 0) == WHITE
+
+    # Every pixel is the one of the 1 bit per pixel frame
+    packed = EyeFrames.build(xres, yres, (xres + 7) // 8).frames['angry']
+    animator.show('angry')
+    shown = bytes(screen.mmap[:])
+    for y in range(yres):
+        for x in range(xres):
+            black = packed[y * ((xres + 7) // 8) + x // 8] >> (x % 8) & 1
+            assert _pixel(shown, line_length, x, y) == (BLACK if black else WHITE)
+
+
+def test_expressions_at_32_bits_per_pixel(screen, tmp_path):
+    # The frames the gadget makes for the screen, then every mood's expression played by the eyes task
+    frames = EyeFrames.open_or_build(str(tmp_path / 'eyes.frames'), *screen_geometry(screen))
+    assert frames.bits_per_pixel == 32
+    animator = EyeAnimator(screen, frames, clock=lambda: 0.0, rng=random.Random(0))
+    task = animator.task()
+    for mood, sequence in sorted(EXPRESSIONS.items()):
+        animator.express(mood)
+        for name, _ in sequence:
+            next(task)
+            assert animator.current == name
+            assert bytes(screen.mmap[:]) == frames.frames[name]
+    task.close()
+
+
+def test_frame_file_is_kept_per_pixel_format(tmp_path):
+    path = str(tmp_path / 'eyes.frames')
+    frames = EyeFrames.open_or_build(path, 178, 128, 712, 32)
+    assert EyeFrames.load(path, 178, 128, 712, 32).frames == frames.frames
+    assert EyeFrames.load(path, 178, 128, 712, 1) is None
+    assert EyeFrames.load(path, 178, 128, 24, 1) is None
+
+
+def test_unknown_pixel_format():
+    with pytest.raises(ValueError):
+        EyeFrames.build(178, 128, 356, 12)
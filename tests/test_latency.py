@@ -0,0 +1,39 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def latency(monkeypatch):
+    monkeypatch.syspath_prepend(os.path.join(ROOT, 'sim'))
+    import latency
+    return latency
+
+
+def test_percentile_is_nearest_rank(latency):
+    values = [5, 1, 4, 2, 3, 10, 9, 8, 7, 6]
+    assert latency.percentile([], 50) is None
+    assert latency.percentile(values, 50) == 5
+    assert latency.percentile(values, 95) == 10
+    assert latency.percentile(values, 0) == 1
+
+
+def test_every_stage_is_measured(tmp_path):
+    gadget = tmp_path / 'gadget'
+    shutil.copytree(ROOT, str(gadget), ignore=shutil.ignore_patterns('.git', 'tests', 'skill-nodejs', '__pycache__',
+                                                                     'sounds.pack', 'eyes.frames', 'speech'))
+    output = subprocess.run([sys.executable, 'sim/latency.py', '--count', '3', '--rate', '20', '--settle', '0.5',
+                             '--loads', 'idle', '--classes', 'stop,forward'], cwd=str(gadget), check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=300).stdout.decode()
+    rows = [line.split() for line in output.splitlines() if line.startswith('idle')]
+    assert [(row[1], row[2]) for row in rows] == [(command, stage) for command in ('stop', 'forward')
+                                                  for stage in ('decode', 'dispatch', 'queue', 'actuator')]
+    # Every stage has its three percentiles, the actuator rows the throughput too
+    for row in rows:
+        assert all(float(value) >= 0 for value in row[3:])
+        assert len(row) == (7 if row[2] == 'actuator' else 6)
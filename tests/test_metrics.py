@@ -0,0 +1,112 @@
+import json
+import socket
+import threading
+
+import metrics
+from commands import _Timing
+from metrics import MetricsServer, Registry
+
+
+def test_prometheus_text_format():
+    registry = Registry()
+    registry.counter('gadget_directives_total', 'Control directives received', type='move').inc(2)
+    registry.gauge('gadget_command_queue_depth', 'Commands waiting to run').set(1.5)
+    latency = registry.histogram('gadget_directive_seconds', 'Time in the callback', buckets=(0.01, 0.1))
+    for seconds in (0.005, 0.05, 1.0):
+        latency.observe(seconds)
+    registry.collect('gadget_sensor_reads_total', 'Sensor reads by channel',
+                     lambda: {'proximity': 3, 'is_pressed': 5}, type='counter', label='channel')
+    assert registry.render().splitlines() == [
+        '# HELP gadget_command_queue_depth Commands waiting to run',
+        '# TYPE gadget_command_queue_depth gauge',
+        'gadget_command_queue_depth 1.5',
+        '# HELP gadget_directive_seconds Time in the callback',
+        '# TYPE gadget_directive_seconds histogram',
+        'gadget_directive_seconds_bucket{le="0.01"} 1',
+        'gadget_directive_seconds_bucket{le="0.1"} 2',
+        'gadget_directive_seconds_bucket{le="+Inf"} 3',
+        'gadget_directive_seconds_count 3',
+        'gadget_directive_seconds_sum 1.055',
+        '# HELP gadget_directives_total Control directives received',
+        '# TYPE gadget_directives_total counter',
+        'gadget_directives_total{type="move"} 2',
+        '# HELP gadget_sensor_reads_total Sensor reads by channel',
+        '# TYPE gadget_sensor_reads_total counter',
+        'gadget_sensor_reads_total{channel="is_pressed"} 5',
+        'gadget_sensor_reads_total{channel="proximity"} 3',
+    ]
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    registry.counter('gadget_errors_total', 'Errors', site='say "hi"\\').inc()
+    assert 'gadget_errors_total{site="say \\"hi\\"\\\\"} 1' in registry.render()
+
+
+def test_disabled_registry_hands_out_the_null_metric():
+    registry = Registry(enabled=False)
+    counter = registry.counter('gadget_directives_total', 'Control directives received')
+    counter.inc()
+    assert counter is metrics.NULL
+    timing = _Timing()
+    registry.attach(timing, 'gadget_command_wait_seconds', 'Time commands spent queued')
+    timing.add(0.1)
+    assert timing.histogram is None
+    assert registry.render() == '\n'
+
+
+def test_attached_timing_feeds_the_histogram_and_snapshot(tmp_path):
+    registry = Registry()
+    timing = _Timing()
+    registry.attach(timing, 'gadget_command_wait_seconds', 'Time commands spent queued')
+    timing.add(0.0002)
+    timing.add(0.3)
+    path = str(tmp_path / 'metrics.json')
+    registry.write_snapshot(path)
+    with open(path) as snapshot:
+        values = json.load(snapshot)['metrics']['gadget_command_wait_seconds']
+    count, total, counts = values[0], values[1], values[2:]
+    assert (count, total) == (2, 0.3002)
+    assert sum(counts) == 2 and len(counts) == len(metrics.LATENCY_BUCKETS) + 1
+
+
+def test_served_over_a_unix_socket(tmp_path):
+    registry = Registry()
+    registry.counter('gadget_plays_total', 'Clips played').inc(7)
+    path = str(tmp_path / 'metrics.sock')
+    server = MetricsServer(registry, path).start()
+    try:
+        client = socket.socket(socket.AF_UNIX)
+        client.connect(path)
+        client.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+        response = b''
+        while True:
+            data = client.recv(4096)
+            if not data:
+                break
+            response += data
+        client.close()
+    finally:
+        server.stop()
+    head, body = response.split(b'\r\n\r\n', 1)
+    assert head.startswith(b'HTTP/1.0 200')
+    assert b'gadget_plays_total 7' in body.splitlines()
+    assert metrics.parse_address(':9100') == ('localhost', 9100)
+    assert metrics.parse_address(path) == path
+
+
+def test_thread_cpu_seconds():
+    metrics.install()
+    run = threading.Thread.run
+    # A second install does not wrap Thread.run again
+    metrics.install()
+    assert threading.Thread.run is run
+    stop = threading.Event()
+    worker = threading.Thread(target=stop.wait, name='worker')
+    worker.start()
+    try:
+        times = metrics.thread_cpu_seconds()
+    finally:
+        stop.set()
+        worker.join()
+    assert 'worker' in times and threading.main_thread().name in times
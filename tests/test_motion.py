@@ -0,0 +1,123 @@
+import threading
+
+import pytest
+
+from motion import MotionPlayer, compile_timeline
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def _player(calls, clock, lift=None):
+    return MotionPlayer({
+        'wheels': lambda *setpoint: calls.append((clock(), 'wheels') + setpoint),
+        'medium': lambda *setpoint: calls.append((clock(), 'medium') + setpoint) or lift,
+    }, clock=clock, sleep=clock.sleep)
+
+
+def test_compile_unrolls_and_sorts():
+    timeline = compile_timeline('square', {'repeat': 2, 'steps': [
+        {'at': 2000, 'wheels': [525, 525], 'for': 2000},
+        {'at': 0, 'wheels': [525, 0], 'for': 2000},
+    ]})
+    assert timeline.length == 8.0
+    assert list(timeline.events()) == [(0.0, 'wheels', (525, 0, 2000)), (2.0, 'wheels', (525, 525, 2000)),
+                                       (4.0, 'wheels', (525, 0, 2000)), (6.0, 'wheels', (525, 525, 2000))]
+
+
+@pytest.mark.parametrize('routine', [
+    {'unit': 'minutes', 'steps': []},
+    [{'at': 0, 'wheels': [1, 1], 'medium': [1, 1]}],
+    [{'at': 0, 'wheels': [1, 2, 3], 'for': 4}],
+    {'unit': 'beat', 'steps': [{'at': 0.5, 'wheels': [1, 1]}]},
+])
+def test_malformed_routines(routine):
+    with pytest.raises(ValueError):
+        compile_timeline('bad', routine)
+
+
+def test_run_keeps_absolute_times():
+    calls, clock = [], _Clock()
+    player = _player(calls, clock)
+    timeline = compile_timeline('square', {'repeat': 2, 'steps': [{'at': 0, 'wheels': [525, 0], 'for': 2000}]})
+    assert player.run(timeline)
+    assert [at - 100.0 for at, *_ in calls] == [0.0, 2.0]
+    assert clock() == 104.0
+    assert player.stats()['plays'] == 1
+
+
+def test_step_without_run_time_lasts_as_long_as_its_actuator():
+    calls, clock = [], _Clock()
+    player = _player(calls, clock, lift=0.6)
+    sitdown = compile_timeline('sitdown', [{'at': 0, 'medium': [20, 0.5]}])
+    assert sitdown.length == 0
+    assert player.run(sitdown)
+    assert clock() == pytest.approx(100.6)
+
+
+def test_run_is_cancelled_between_events():
+    calls, clock = [], _Clock()
+    player = _player(calls, clock)
+    cancel = threading.Event()
+    cancel.set()
+    timeline = compile_timeline('come', [{'at': 0, 'wheels': [750, 750], 'for': 2500}])
+    assert not player.run(timeline, cancel)
+    assert player.stats()['preempted'] == 1
+
+
+def test_run_does_not_take_the_queued_timeline():
+    calls, clock = [], _Clock()
+    player = _player(calls, clock)
+    come = compile_timeline('come', [{'at': 0, 'wheels': [750, 750], 'for': 2500}])
+    sitdown = compile_timeline('sitdown', [{'at': 0, 'medium': [20, 0.5]}])
+    queued = player.play(come)
+    player.run(sitdown)
+    assert [name for _, name, *_ in calls] == ['medium']
+    assert not queued.is_set()
+    # The task plays what was queued
+    task = player.task()
+    for delay in task:
+        clock.sleep(delay)
+    assert queued.is_set()
+    assert [name for _, name, *_ in calls] == ['medium', 'wheels']
+
+
+def test_queued_timeline_replaced_before_it_started_is_done():
+    player = _player([], _Clock())
+    come = compile_timeline('come', [{'at': 0, 'wheels': [750, 750], 'for': 2500}])
+    first = player.play(come)
+    second = player.play(come)
+    assert first.is_set() and not second.is_set()
+
+
+def test_closing_the_task_interrupts_the_timeline():
+    calls, clock = [], _Clock()
+    player = _player(calls, clock)
+    done = player.play(compile_timeline('circle', [{'at': 0, 'wheels': [525, 52], 'for': 12000}]))
+    task = player.task()
+    assert next(task) == 12.0
+    task.close()
+    assert done.is_set()
+    assert player.stats()['preempted'] == 1
+    with pytest.raises(ValueError):
+        player.play(compile_timeline('dance', {'unit': 'beat', 'steps': [{'at': 0, 'wheels': [1, 1]}]}))
+
+
+def test_cue_loops_a_beat_timeline():
+    calls, clock = [], _Clock()
+    player = _player(calls, clock)
+    dance = compile_timeline('dance', {'unit': 'beat', 'steps': [
+        {'at': 0, 'wheels': [-400, 400], 'for': 150},
+        {'at': 1, 'wheels': [400, -400], 'for': 150},
+    ]})
+    for beat in range(4):
+        player.cue(dance, beat)
+    assert [setpoint[2] for setpoint in calls] == [-400, 400, -400, 400]
@@ -0,0 +1,101 @@
+from motors import MotorFacade, MotorPair
+
+
+class _Motor:
+    """
+    A motor without a sysfs directory, its attributes are plain properties.
+    """
+
+    def __init__(self, log, name):
+        object.__setattr__(self, 'log', log)
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'max_speed', 1050)
+
+    def __setattr__(self, attribute, value):
+        self.log.append((self.name, attribute, value))
+
+
+class _Clock:
+    now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _facade(log, clock, name='outB'):
+    return MotorFacade(_Motor(log, name), clock=clock)
+
+
+def test_repeated_timed_run_is_suppressed():
+    log, clock = [], _Clock()
+    motor = _facade(log, clock)
+    motor.run_timed(500, 1000)
+    assert log == [('outB', 'speed_sp', 500), ('outB', 'time_sp', 1000), ('outB', 'command', 'run-timed')]
+    # The same run again within the tolerance of its end is dropped
+    clock.now = 0.005
+    motor.run_timed(500, 995)
+    assert len(log) == 3
+    stats = motor.stats()
+    assert (stats['commands'], stats['suppressed'], stats['writes'], stats['writes_suppressed']) == (2, 1, 3, 3)
+
+
+def test_timed_run_at_the_same_speed_only_restarts_the_timer():
+    log, clock = [], _Clock()
+    motor = _facade(log, clock)
+    motor.run_timed(500, 1000)
+    clock.now = 0.5
+    del log[:]
+    motor.run_timed(500, 1000)
+    # The setpoints are already written, the command restarts the motor's timer
+    assert log == [('outB', 'command', 'run-timed')]
+    assert motor.stats()['merged'] == 1
+    # A shorter run that ends earlier is obeyed too
+    del log[:]
+    motor.run_timed(500, 200)
+    assert log == [('outB', 'time_sp', 200), ('outB', 'command', 'run-timed')]
+
+
+def test_stop_is_dropped_once_the_run_is_over():
+    log, clock = [], _Clock()
+    motor = _facade(log, clock)
+    motor.run_timed(500, 1000)
+    clock.now = 0.5
+    motor.stop(stop_action='brake')
+    assert log[-2:] == [('outB', 'stop_action', 'brake'), ('outB', 'command', 'stop')]
+    del log[:]
+    motor.stop(stop_action='brake')
+    assert log == []
+    motor.run_timed(500, 1000)
+    clock.now = 2.0
+    del log[:]
+    motor.stop()
+    assert log == []
+
+
+def test_run_forever_is_written_once():
+    log, clock = [], _Clock()
+    motor = _facade(log, clock)
+    motor.run_forever(300)
+    motor.run_forever(300)
+    motor.run_forever(-300)
+    assert log == [('outB', 'speed_sp', 300), ('outB', 'command', 'run-forever'),
+                   ('outB', 'speed_sp', -300), ('outB', 'command', 'run-forever')]
+    assert motor.speed(50) == 525
+
+
+def test_pair_writes_both_commands_after_the_setpoints():
+    log, clock = [], _Clock()
+    wheels = MotorPair(_facade(log, clock, 'outB'), _facade(log, clock, 'outC'))
+    wheels.run_timed(750, -750, 2500, stop_action='brake')
+    assert [entry[1] for entry in log[-2:]] == ['command', 'command']
+    assert all(entry[1] != 'command' for entry in log[:-2])
+    assert {entry[0] for entry in log[-2:]} == {'outB', 'outC'}
+    assert wheels.stats()['skew']['count'] == 1
+
+    # Only the wheel whose command changed is written
+    del log[:]
+    wheels.run_timed(750, 750, 2500)
+    assert [entry[0] for entry in log] == ['outC', 'outC']
+    assert wheels.stats()['skew']['count'] == 1
+    wheels.stop()
+    assert [entry[2] for entry in log[-2:]] == ['stop', 'stop']
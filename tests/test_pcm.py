@@ -0,0 +1,80 @@
+import math
+import random
+import struct
+
+import pytest
+
+import pcm
+
+audioop = pytest.importorskip('audioop')
+
+
+def _fragment(count, seed=0, channels=1):
+    rng = random.Random(seed)
+    # A loud sine with noise, clipping in the mixes below
+    samples = [int(max(-32768, min(32767, 30000 * math.sin(i / 7.0) + rng.randint(-3000, 3000))))
+               for i in range(count * channels)]
+    return struct.pack('<{}h'.format(len(samples)), *samples)
+
+
+@pytest.fixture(params=['numpy', 'plain'])
+def implementation(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(pcm, 'numpy', None)
+    return request.param
+
+
+@pytest.mark.parametrize('factor', [0.3, 1.0, 1.7])
+def test_mul(implementation, factor):
+    fragment = _fragment(1000)
+    assert pcm.mul(fragment, 2, factor) == audioop.mul(fragment, 2, factor)
+
+
+def test_add(implementation):
+    first, second = _fragment(1000, 1), _fragment(1000, 2)
+    assert pcm.add(first, second, 2) == audioop.add(first, second, 2)
+
+
+def test_tomono_and_tostereo(implementation):
+    stereo = _fragment(1000, channels=2)
+    assert pcm.tomono(stereo, 2, 0.5, 0.5) == audioop.tomono(stereo, 2, 0.5, 0.5)
+    mono = _fragment(1000)
+    assert pcm.tostereo(mono, 2, 1, 1) == audioop.tostereo(mono, 2, 1, 1)
+    assert pcm.tostereo(mono, 2, 0.5, 0.8) == audioop.tostereo(mono, 2, 0.5, 0.8)
+
+
+@pytest.mark.parametrize('channels, inrate, outrate', [(1, 44100, 22050), (1, 22050, 11025), (2, 16000, 22050)])
+def test_ratecv_of_a_whole_clip(implementation, channels, inrate, outrate):
+    # Interpolated between the same samples, without the state audioop keeps between fragments
+    fragment = _fragment(4000, channels=channels)
+    ours, _ = pcm.ratecv(fragment, 2, channels, inrate, outrate, None)
+    theirs, _ = audioop.ratecv(fragment, 2, channels, inrate, outrate, None)
+    assert len(ours) == len(theirs)
+    count = len(ours) // 2
+    pairs = zip(struct.unpack('<{}h'.format(count), ours), struct.unpack('<{}h'.format(count), theirs))
+    assert max(abs(a - b) for a, b in pairs) <= 1
+
+
+def test_only_16_bit_samples():
+    with pytest.raises(ValueError):
+        pcm.mul(bytes(4), 1, 1.0)
+
+
+def test_adpcm_is_bit_exact_in_chunks():
+    fragment = _fragment(5000)
+    ours, theirs = None, None
+    for start in range(0, len(fragment), 4096):
+        chunk = fragment[start:start + 4096]
+        encoded, ours = pcm.lin2adpcm(chunk, 2, ours)
+        expected, theirs = audioop.lin2adpcm(chunk, 2, theirs)
+        assert encoded == expected
+        assert ours == theirs
+        assert pcm.adpcm2lin(encoded, 2, None) == audioop.adpcm2lin(expected, 2, None)
+
+
+def test_rms(implementation):
+    fragment = _fragment(3000)
+    assert pcm.rms(fragment, 2) == audioop.rms(fragment, 2)
+    assert pcm.rms(b'', 2) == 0
@@ -0,0 +1,58 @@
+import collections
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import recording
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Simulated seconds the session waits for the gadget to start
+DELAY = 10
+
+
+def _simulate(directory, *args, **env):
+    subprocess.run([sys.executable] + list(args), cwd=directory, check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, env=dict(os.environ, **env), timeout=600)
+
+
+def _commands(path):
+    # The commands of every device in order, without their times
+    devices = collections.defaultdict(list)
+    with open(path) as lines:
+        for line in lines:
+            _, device, action, details = json.loads(line)
+            devices[device].append((action, details))
+    return dict(devices)
+
+
+def test_replay_repeats_every_command(tmp_path):
+    gadget = tmp_path / 'gadget'
+    shutil.copytree(ROOT, str(gadget), ignore=shutil.ignore_patterns('.git', 'tests', 'skill-nodejs', '__pycache__',
+                                                                     'sounds.pack', 'eyes.frames', 'speech'))
+    # The demo session drives, heels, barks and patrols, so every consumer of random numbers draws. The puppy
+    # is pressed while it heels and once it sits. How many dance steps make it in before a stop depends on the
+    # thread timing: the dances are left out, test_dance.py runs the beat grid on a fake clock. Starting the
+    # gadget takes several simulated seconds at 20 times real time, the session begins once it is up
+    with open(os.path.join(ROOT, 'sim', 'demo.jsonl')) as demo, open(str(gadget / 'session.jsonl'), 'w') as session:
+        for line in demo:
+            if line.startswith('#') or '"coffin"' in line or 'MusicData' in line:
+                continue
+            directive = json.loads(line)
+            directive['at'] += DELAY
+            session.write(json.dumps(directive) + '\n')
+    touches = '{}:{},{}:{}'.format(DELAY + 9, DELAY + 9.5, DELAY + 17, DELAY + 17.4)
+    _simulate(str(gadget), 'sim/run.py', '--speed', '20', '--seed', '0', '--touch', touches, '--linger', '2',
+              '--directives', 'session.jsonl', '--actuators', 'field.jsonl', 'new.py',
+              PUPPY_RECORD=str(gadget / 'session.rec'))
+    _, records = recording.read(str(gadget / 'session.rec'))
+    assert [value for _, kind, value in records if kind == recording.TOUCH] == [True, False, True, False]
+
+    for out in ('first.jsonl', 'second.jsonl'):
+        _simulate(str(gadget), 'sim/replay.py', 'run', 'session.rec', 'new.py', '--speed', '20', '--linger', '2',
+                  '--out', out)
+    field = _commands(str(gadget / 'field.jsonl'))
+    assert field
+    assert _commands(str(gadget / 'first.jsonl')) == field
+    assert _commands(str(gadget / 'second.jsonl')) == field
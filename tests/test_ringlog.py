@@ -0,0 +1,77 @@
+import io
+import logging
+
+from ringlog import RingHandler, RingLog
+
+
+def test_records_are_formatted_and_written_in_one_batch():
+    stream = io.StringIO()
+    ring = RingLog(capacity=8, stream=stream)
+    ring.log('dance', "beat {} at {:.1f}", 3, 0.5)
+    ring.log('dance', "bad {} {}", 1)
+    ring.flush()
+    assert stream.getvalue() == "beat 3 at 0.5\nbad {} {} (1,)\n"
+    assert ring.stats()['batches'] == 1
+    ring.flush()
+    assert ring.stats()['batches'] == 1
+
+
+def test_oldest_unwritten_records_are_dropped():
+    stream = io.StringIO()
+    ring = RingLog(capacity=4, stream=stream)
+    for i in range(10):
+        ring.log('heel', "{}", i)
+    ring.flush()
+    assert stream.getvalue().split() == ['6', '7', '8', '9']
+    assert ring.stats()['dropped'] == 6
+
+
+def test_sites_are_sampled_and_rate_limited():
+    stream = io.StringIO()
+    ring = RingLog(capacity=16, stream=stream)
+    ring.configure('sensors', every=3)
+    ring.configure('motors', rate=0.001, burst=2)
+    for i in range(7):
+        ring.log('sensors', "s{}", i)
+        ring.log('motors', "m{}", i)
+    ring.flush()
+    assert stream.getvalue().split() == ['s0', 'm0', 'm1', 's3', 's6']
+    sites = ring.stats()['sites']
+    assert sites['sensors'] == {'seen': 7, 'sampled': 4, 'limited': 0}
+    assert sites['motors'] == {'seen': 7, 'sampled': 0, 'limited': 5}
+
+
+def test_dump_keeps_written_records():
+    ring = RingLog(capacity=4, stream=io.StringIO())
+    for i in range(6):
+        ring.log('gadget', "record {}", i)
+    ring.flush()
+    dump = io.StringIO()
+    ring.dump(2, stream=dump)
+    lines = dump.getvalue().splitlines()
+    assert len(lines) == 2
+    assert lines[0].endswith("gadget   record 4") and lines[1].endswith("gadget   record 5")
+
+
+def test_handler_routes_logging_records_by_logger_name():
+    stream = io.StringIO()
+    ring = RingLog(capacity=8, stream=stream)
+    logger = logging.getLogger('test_ringlog')
+    logger.propagate = False
+    handler = RingHandler(ring)
+    logger.addHandler(handler)
+    try:
+        logger.warning("lost %d samples", 3)
+    finally:
+        logger.removeHandler(handler)
+    ring.flush()
+    assert stream.getvalue() == "lost 3 samples\n"
+    assert ring.stats()['records'] == 1
+
+
+def test_stop_writes_pending_records():
+    stream = io.StringIO()
+    ring = RingLog(capacity=8, stream=stream, interval=60).start()
+    ring.log('gadget', "bye")
+    ring.stop()
+    assert stream.getvalue() == "bye\n"
@@ -0,0 +1,113 @@
+import threading
+import time
+
+from scheduler import ModeScheduler
+
+
+def _wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_disabled_task_runs_its_finally_block():
+    closed = threading.Event()
+
+    def behaviour():
+        try:
+            while True:
+                yield 10.0
+        finally:
+            closed.set()
+
+    scheduler = ModeScheduler()
+    scheduler.add('heel', behaviour, enabled=True)
+    scheduler.start()
+    try:
+        _wait_for(lambda: scheduler.stats()['resumes']['heel'] == 1)
+        # Parked in its ten second sleep, it is closed by disable itself
+        scheduler.disable('heel')
+        assert closed.is_set()
+        assert not scheduler.is_enabled('heel')
+    finally:
+        scheduler.stop()
+
+
+def test_task_disabled_while_running_is_closed_by_the_run_loop():
+    running, release, closed = threading.Event(), threading.Event(), threading.Event()
+
+    def behaviour():
+        try:
+            running.set()
+            release.wait()
+            yield 10.0
+        finally:
+            closed.set()
+
+    scheduler = ModeScheduler()
+    scheduler.add('dance', behaviour, enabled=True)
+    scheduler.start()
+    try:
+        assert running.wait(2.0)
+        scheduler.disable('dance')
+        assert not closed.is_set()
+        release.set()
+        assert closed.wait(2.0)
+    finally:
+        release.set()
+        scheduler.stop()
+
+
+def test_enable_restarts_and_wake_resumes_early():
+    starts = []
+
+    def behaviour():
+        starts.append(time.monotonic())
+        while True:
+            yield 10.0
+
+    scheduler = ModeScheduler()
+    scheduler.add('patrol', behaviour)
+    scheduler.start()
+    try:
+        scheduler.enable('patrol')
+        _wait_for(lambda: scheduler.stats()['resumes']['patrol'] == 1)
+        scheduler.wake('patrol')
+        _wait_for(lambda: scheduler.stats()['resumes']['patrol'] == 2)
+        scheduler.disable('patrol')
+        scheduler.enable('patrol')
+        _wait_for(lambda: len(starts) == 2)
+    finally:
+        scheduler.stop()
+
+
+def test_failing_task_is_switched_off():
+    def behaviour():
+        yield 0.0
+        raise RuntimeError("boom")
+
+    scheduler = ModeScheduler()
+    scheduler.add('eyes', behaviour, enabled=True)
+    scheduler.start()
+    try:
+        _wait_for(lambda: not scheduler.is_enabled('eyes'))
+        assert scheduler.stats()['active'] == []
+    finally:
+        scheduler.stop()
+
+
+def test_parked_tasks_do_not_wake_the_thread():
+    def behaviour():
+        while True:
+            yield 0.01
+
+    scheduler = ModeScheduler()
+    for name in ('dance', 'patrol', 'heel'):
+        scheduler.add(name, behaviour)
+    scheduler.start()
+    try:
+        time.sleep(0.2)
+        assert scheduler.stats()['wakeups'] == 0
+    finally:
+        scheduler.stop()
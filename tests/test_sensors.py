@@ -0,0 +1,73 @@
+from sensors import RingBuffer, SensorSampler, TouchService
+
+
+class _Touch:
+    is_pressed = False
+
+
+def test_touch_edges_are_debounced():
+    presses, releases = [], []
+    touch = TouchService(_Touch(), on_press=lambda: presses.append(1), on_release=lambda: releases.append(1),
+                         rate=100, debounce=0.03)
+    # A two sample bounce is no press, three stable samples are
+    for value in (True, True, False, True, True, True, True):
+        touch.sample(value)
+    assert (len(presses), len(releases)) == (1, 0)
+    assert touch.pressed
+    for value in (False, False, False):
+        touch.sample(value)
+    assert (len(presses), len(releases)) == (1, 1)
+    assert touch.stats()['edges'] == 2
+
+
+def test_ring_buffer_window_wraps():
+    buffer = RingBuffer(4)
+    assert buffer.latest() is None
+    for i in range(6):
+        buffer.append(float(i), 10.0 * i)
+    assert buffer.latest() == (6, 5.0, 50.0)
+    times, values = buffer.window()
+    assert list(times) == [2.0, 3.0, 4.0, 5.0]
+    assert list(values) == [20.0, 30.0, 40.0, 50.0]
+    assert list(buffer.window(2)[1]) == [40.0, 50.0]
+    assert list(buffer.window(10)[1]) == [20.0, 30.0, 40.0, 50.0]
+    assert list(buffer.window(-1)[1]) == []
+
+
+def test_sampler_serves_reads_from_the_buffer():
+    readings = iter([30, 40])
+    tapped = []
+    sampler = SensorSampler()
+    sampler.tap('proximity', lambda timestamp, value: tapped.append(value))
+    sampler.add('proximity', lambda: next(readings), rate=10)
+    assert sampler.proximity is None
+    sampler.sample('proximity')
+    sampler.sample('proximity')
+    assert sampler.proximity == 40
+    assert list(sampler.window('proximity')[1]) == [30, 40]
+    assert tapped == [30, 40]
+    stats = sampler.stats()['proximity']
+    assert (stats['reads'], stats['served']) == (2, 3)
+
+
+def test_failed_read_is_skipped():
+    def read():
+        if failing:
+            raise OSError(19, "No such device")
+        return 42
+
+    failing = False
+    sampler = SensorSampler()
+    sampler.add('proximity', read, rate=10)
+    sampler.sample('proximity')
+    failing = True
+    sampler.sample('proximity')
+    sampler.sample('proximity')
+    assert sampler.proximity == 42
+    assert sampler.stats()['proximity']['errors'] == 2
+
+    # The sampler task shared by every channel keeps running through the errors
+    task = sampler.task()
+    assert next(task) >= 0
+    task.close()
+    assert sampler.stats()['proximity']['errors'] == 3
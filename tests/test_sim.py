@@ -0,0 +1,58 @@
+import math
+import os
+import time
+
+import pytest
+
+SIM = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sim')
+
+
+@pytest.fixture
+def sim(monkeypatch):
+    monkeypatch.syspath_prepend(SIM)
+    import run
+    import simworld
+    return run, simworld
+
+
+class _Clock:
+    now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_virtual_clock_runs_faster(sim):
+    _, simworld = sim
+    clock = simworld.VirtualClock(speed=20)
+    start, real_start = clock.monotonic(), time.monotonic()
+    clock.sleep(1.0)
+    real = time.monotonic() - real_start
+    assert real < 0.5
+    assert clock.monotonic() - start == pytest.approx(real * 20, rel=0.1)
+
+
+def test_motor_ramps_to_speed_and_stops_at_the_end_of_a_timed_run(sim, monkeypatch):
+    _, simworld = sim
+    clock = _Clock()
+    monkeypatch.setattr(simworld.time, 'monotonic', clock)
+    motor = simworld.MotorState('outB', max_speed=1050, acceleration=1000.0)
+    motor.run(2000, duration=2.0)
+    clock.now = 0.5
+    assert motor.read() == (pytest.approx(125.0), pytest.approx(500.0))
+    clock.now = 1.5
+    assert motor.read() == (pytest.approx(551.25 + 1050 * 0.45), 1050)
+    # Coasting after the run
+    clock.now = 2.5
+    assert motor.read()[1] == pytest.approx(550.0)
+    motor.stop('brake')
+    assert not motor.running
+
+
+def test_profiles(sim, tmp_path):
+    run, _ = sim
+    assert run.touch_profile('3:3.5,8:8.2') == [(3.0, 3.5), (8.0, 8.2)]
+    assert run.ir_profile('42 + 30 * sin(t / 2)')(math.pi) == pytest.approx(72.0)
+    directives = tmp_path / 'directives.jsonl'
+    directives.write_text('# comment\n{"at": 2.0, "payload": {"type": "command", "command": "heel"}}\n\n')
+    assert run.load_directives(str(directives)) == [{'at': 2.0, 'payload': {'type': 'command', 'command': 'heel'}}]
@@ -0,0 +1,60 @@
+import os
+
+from speech import SpeechCache, key, read_phrases
+
+
+def _renderer(rendered):
+    def render(text, path, voice, speed, volume):
+        rendered.append(text)
+        with open(path, 'wb') as wav:
+            wav.write(bytes(100))
+    return render
+
+
+def test_hits_do_not_render_again(tmp_path):
+    rendered = []
+    cache = SpeechCache(str(tmp_path), renderer=_renderer(rendered))
+    path = cache.get('Woof! Woof!')
+    assert os.path.basename(path) == key('Woof! Woof!')
+    assert cache.get('Woof! Woof!') == path
+    # Another voice is another entry
+    assert cache.get('Woof! Woof!', voice='de') != path
+    assert rendered == ['Woof! Woof!', 'Woof! Woof!']
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 2, 2)
+
+
+def test_least_recently_spoken_phrase_is_evicted(tmp_path):
+    rendered = []
+    cache = SpeechCache(str(tmp_path), budget=300, renderer=_renderer(rendered))
+    first, second, third = cache.warm(['one', 'two', 'three'])
+    # Saying the first phrase again makes the second the least recently used
+    cache.get('one')
+    cache.get('four')
+    assert [text for _, _, _, text in cache.entries()] == ['three', 'one', 'four']
+    assert not os.path.exists(second)
+    assert os.path.exists(first) and os.path.exists(third)
+    assert cache.stats()['evictions'] == 1
+    assert cache.resident == 300
+
+
+def test_recency_and_render_times_survive_a_restart(tmp_path):
+    rendered = []
+    cache = SpeechCache(str(tmp_path), renderer=_renderer(rendered))
+    for i, text in enumerate(['one', 'two', 'three']):
+        path = cache.get(text)
+        os.utime(path, (1000 + i, 1000 + i))
+    os.utime(cache.get('one'), (2000, 2000))
+
+    # A smaller budget on the next start drops the least recently spoken phrase
+    restarted = SpeechCache(str(tmp_path), budget=200, renderer=_renderer(rendered))
+    assert [text for _, _, _, text in restarted.entries()] == ['three', 'one']
+    assert all(seconds is not None for _, _, seconds, _ in restarted.entries())
+    restarted.get('three')
+    assert rendered == ['one', 'two', 'three']
+
+
+def test_phrase_list(tmp_path):
+    phrases = tmp_path / 'phrases.txt'
+    phrases.write_text("# Greeting\nHello, my name is Beipas!\n\n  Woof! Woof!  \n")
+    assert read_phrases(str(phrases)) == ['Hello, my name is Beipas!', 'Woof! Woof!']
@@ -0,0 +1,61 @@
+import threading
+
+import pytest
+
+from startup import Startup
+
+
+def test_result_waits_for_the_step():
+    release = threading.Event()
+    startup = Startup()
+    step = startup.background('sensors', lambda: release.wait(2.0) and {'ir': 'ir'})
+    assert not step.done() and not step.succeeded()
+    results = []
+    step.then(results.append)
+    release.set()
+    assert startup.result('sensors') == {'ir': 'ir'}
+    startup.wait()
+    assert step.succeeded()
+    assert results == [{'ir': 'ir'}]
+    # A callback added after the step finished is called right away
+    step.then(results.append)
+    assert len(results) == 2
+
+
+def test_failed_step_raises_on_result():
+    def fail():
+        raise OSError("no sensor on port 1")
+
+    startup = Startup()
+    step = startup.background('sensors', fail)
+    called = []
+    step.then(called.append)
+    with pytest.raises(OSError):
+        step.result()
+    assert step.done() and not step.succeeded()
+    assert called == []
+
+
+def test_step_waiting_on_another():
+    order = []
+    release = threading.Event()
+    startup = Startup()
+    startup.background('sensors', lambda: release.wait(2.0) and order.append('sensors'))
+    startup.background('heel', lambda: (startup.result('sensors'), order.append('heel')))
+    release.set()
+    startup.wait()
+    assert order == ['sensors', 'heel']
+
+
+def test_report_lists_phases_steps_and_marks():
+    clock = iter(float(tick) for tick in range(100))
+    startup = Startup(clock=lambda: next(clock))
+    with startup.phase('agt'):
+        pass
+    startup.mark('connectable')
+    report = startup.report()
+    assert report.startswith("Startup: connectable at ")
+    assert '  agt ' in report
+    stats = startup.stats()
+    assert set(stats['timings']) == {'imports', 'agt'}
+    assert set(stats['marks']) == {'connectable'}
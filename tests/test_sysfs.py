@@ -0,0 +1,93 @@
+import os
+
+from motors import MotorFacade
+from sysfs import AttributeCache, LedWriter, SensorValue
+
+
+def _device(root, name, **attributes):
+    path = os.path.join(str(root), name)
+    os.makedirs(path)
+    for attribute, value in attributes.items():
+        with open(os.path.join(path, attribute), 'w') as handle:
+            handle.write(value)
+    return path
+
+
+def _contents(path):
+    with open(path) as handle:
+        return handle.read()
+
+
+class _Device:
+    def __init__(self, path, **attributes):
+        self._path = path
+        self.__dict__.update(attributes)
+
+
+def test_handles_are_opened_once_and_shared(tmp_path):
+    path = _device(tmp_path, 'motor0', speed_sp='0', value0='42\n')
+    cache = AttributeCache()
+    handle = cache.get(path, 'speed_sp', writable=True)
+    assert cache.get(_Device(path), 'speed_sp', writable=True) is handle
+    assert cache.get(path, 'value0').read_int() == 42
+    assert cache.get(path, 'value0').read() == '42'
+    assert len(cache) == 2
+    handle.write(750)
+    assert _contents(os.path.join(path, 'speed_sp')) == '750'
+    cache.close()
+    assert len(cache) == 0 and handle.fd is None
+
+
+def test_devices_without_attribute_files_have_no_handle(tmp_path):
+    cache = AttributeCache()
+    assert cache.get(object(), 'speed_sp', writable=True) is None
+    assert cache.get(str(tmp_path), 'speed_sp', writable=True) is None
+    assert len(cache) == 0
+
+
+def test_encodings_are_bounded(tmp_path):
+    path = _device(tmp_path, 'led0', brightness='0')
+    handle = AttributeCache().get(path, 'brightness', writable=True)
+    handle.max_encodings = 2
+    for value in range(5):
+        handle.write(value)
+    assert len(handle._encoded) == 2
+    assert _contents(os.path.join(path, 'brightness')) == '4'
+
+
+def test_led_writer_scales_the_color_to_max_brightness(tmp_path):
+    red = _Device(_device(tmp_path, 'led0:red', brightness='0'), max_brightness=255)
+    green = _Device(_device(tmp_path, 'led0:green', brightness='0'), max_brightness=255)
+
+    class Leds:
+        led_groups = {'LEFT': (red, green)}
+        led_colors = {'AMBER': (1, 1), 'RED': (1, 0)}
+
+    leds = LedWriter(Leds(), cache=AttributeCache())
+    leds.set_color('LEFT', 'AMBER', pct=0.5)
+    assert (_contents(os.path.join(red._path, 'brightness')), _contents(os.path.join(green._path, 'brightness'))) \
+        == ('128', '128')
+    leds.set_color('LEFT', (0, 1))
+    assert _contents(os.path.join(green._path, 'brightness')) == '255'
+    assert leds.writes == 4
+
+
+def test_sensor_value_sets_the_mode_and_falls_back_to_the_sensor(tmp_path):
+    sensor = _Device(_device(tmp_path, 'sensor0', value0='17'))
+    value = SensorValue(sensor, 'IR-PROX', cache=AttributeCache())
+    assert sensor.mode == 'IR-PROX'
+    assert value.read() == 17
+
+    class Sensor:
+        def value(self, index):
+            return 23 + index
+
+    assert SensorValue(Sensor(), 'TOUCH', index=1, cache=AttributeCache()).read() == 24
+
+
+def test_facade_writes_through_the_handles(tmp_path):
+    path = _device(tmp_path, 'motor1', command='', speed_sp='', time_sp='', stop_action='')
+    motor = MotorFacade(_Device(path, max_speed=1050), clock=lambda: 0.0, cache=AttributeCache())
+    motor.run_timed(300, 1000, stop_action='hold')
+    assert [_contents(os.path.join(path, name)) for name in ('speed_sp', 'time_sp', 'stop_action', 'command')] \
+        == ['300', '1000', 'hold', 'run-timed']